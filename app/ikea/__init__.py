@@ -1,4 +1,5 @@
 from ikea.handler import IkeaHandler as Handler
+from ikea.handler import preload
 from ikea import config
 
 # this number is not respected by TF. The var is here for compability with other app modules
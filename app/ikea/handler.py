@@ -42,6 +42,9 @@ LABEL_MAP = pkg_resources.resource_filename(
     os.path.join(MODEL_DIR, 'ikea_label_map.pbtxt'))
 MIN_SCORE_THRESH = 0.5
 
+# model state loaded by preload() before workers are forked
+_preloaded = {}
+
 
 def create_detection_graph():
     detection_graph = tf.Graph()
@@ -54,6 +57,16 @@ def create_detection_graph():
     return detection_graph
 
 
+def preload():
+    """Load the detection graph and label map once so that forked workers share them.
+
+    Sessions hold threads, which do not survive fork, so each handler still creates its own.
+    """
+    _preloaded['detection_graph'] = create_detection_graph()
+    _preloaded['category_index'] = label_map_util.create_category_index_from_labelmap(
+        LABEL_MAP, use_display_name=True)
+
+
 def load_image_into_numpy_array(image):
     (im_width, im_height) = image.size
     return np.array(image.getdata()).reshape(
@@ -63,9 +76,13 @@ def load_image_into_numpy_array(image):
 class IkeaHandler(object):
     def __init__(self, tfconfig=None, im_h=200, im_w=300):
         self._fsm = fsm.IkeaFSM(im_h=im_h, im_w=im_w)
-        self.category_index = label_map_util.create_category_index_from_labelmap(
-            LABEL_MAP, use_display_name=True)
-        self.detection_graph = create_detection_graph()
+        if _preloaded:
+            self.category_index = _preloaded['category_index']
+            self.detection_graph = _preloaded['detection_graph']
+        else:
+            self.category_index = label_map_util.create_category_index_from_labelmap(
+                LABEL_MAP, use_display_name=True)
+            self.detection_graph = create_detection_graph()
         self.tensor_dict = self._construct_tensor_dict()
         self.sess = tf.Session(graph=self.detection_graph, config=tfconfig)
         self.image_tensor = self.detection_graph.get_tensor_by_name(
@@ -87,22 +104,15 @@ class IkeaHandler(object):
 
         return tensor_dict
 
-    def process(self, img):
+    def _to_image_np(self, img):
         img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
         image = Image.fromarray(img)
-        image_np = load_image_into_numpy_array(image)
-
-        output_dict = self.sess.run(
-            self.tensor_dict, feed_dict={self.image_tensor: np.expand_dims(image_np, 0)})
-
-        detection_classes = output_dict['detection_classes'][0].astype(
-            np.uint8)
-        detection_boxes = output_dict['detection_boxes'][0]
-        detection_scores = output_dict['detection_scores'][0]
+        return load_image_into_numpy_array(image)
 
+    def _format_detections(self, detection_classes, detection_boxes, detection_scores):
         detections_to_print = []
         for detection_class, box, score in zip(
-                detection_classes, detection_boxes, detection_scores):
+                detection_classes.astype(np.uint8), detection_boxes, detection_scores):
             if score > MIN_SCORE_THRESH:
                 detections_to_print.append(
                     '{} {}'.format(
@@ -114,6 +124,38 @@ class IkeaHandler(object):
             concatenated_detections = ', '.join(detections_to_print)
             return 'Detected Objects: {}'.format(concatenated_detections)
 
+    def process(self, img):
+        image_np = self._to_image_np(img)
+
+        output_dict = self.sess.run(
+            self.tensor_dict, feed_dict={self.image_tensor: np.expand_dims(image_np, 0)})
+
+        return self._format_detections(output_dict['detection_classes'][0],
+                                       output_dict['detection_boxes'][0],
+                                       output_dict['detection_scores'][0])
+
+    def process_batch(self, imgs):
+        """Detect objects in multiple images with one sess.run per image size.
+
+        Returns a list of results in the same order as imgs.
+        """
+        images_np = [self._to_image_np(img) for img in imgs]
+        # image_tensor takes a batch of images of the same size
+        shape_to_indices = {}
+        for (idx, image_np) in enumerate(images_np):
+            shape_to_indices.setdefault(image_np.shape, []).append(idx)
+
+        results = [None] * len(imgs)
+        for indices in shape_to_indices.values():
+            output_dict = self.sess.run(
+                self.tensor_dict,
+                feed_dict={self.image_tensor: np.stack([images_np[idx] for idx in indices])})
+            for (batch_idx, idx) in enumerate(indices):
+                results[idx] = self._format_detections(output_dict['detection_classes'][batch_idx],
+                                                       output_dict['detection_boxes'][batch_idx],
+                                                       output_dict['detection_scores'][batch_idx])
+        return results
+
     def add_symbolic_state_for_instruction(self, symbolic_state):
         """Get current instruction from symbolic states.
         This is a stateful action, the order of symbolic_state passed
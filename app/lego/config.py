@@ -134,6 +134,16 @@ BLOCK_DETECTION_OFFSET = 2
 # Depending on the other algorithms, this is usually not needed.
 OPT_FINE_BOARD = False
 
+# If True, the board located in a previous frame of the same stream is reused
+# as long as the board area still looks the same. Saves running _locate_board on steady frames.
+BOARD_TRACKING = os.getenv('LEGO_BOARD_TRACKING', "False").lower() == 'true'
+# Low resolution board crop used for the check, as a ratio of the reconstructed board size
+BOARD_TRACK_SCALE = 0.25
+# Max mean absolute difference (grey scale) between the board crops to consider the board unmoved
+BOARD_TRACK_DIFF_TH = 8
+# Force a full board detection after this many consecutive tracked frames
+BOARD_TRACK_MAX_SKIP = 30
+
 # Treat background pixels differently
 OPT_NOTHING = False
 
@@ -143,6 +153,11 @@ BM_WINDOW_MIN_COUNT = 1
 # The percentage of right pixels in each block must be higher than this threshold
 WORST_RATIO_BLOCK_THRESH = 0.6
 
+# How to reconstruct bitmap from color cumsums
+# 'vectorized': evaluate all offset candidates and all blocks at once with numpy
+# 'loop': the original per-block python loops. Slow, kept for reference
+BITMAP_ENGINE = 'vectorized'
+
 # If True, do perspective correction first, then color normalization
 # If False, do perspective correction after color has been normalized
 # Not used anymore...
@@ -178,19 +193,27 @@ def setup(is_streaming):
 PROFILE_ON = os.getenv('PROFILE', "False").lower() == 'true'
 PROFILE_FILEPATH = os.getenv('PROFILE_FILEPATH', 'lego-profile.txt')
 
+# Callables called with (function name, wall clock seconds) after every profiled stage,
+# e.g. to feed the worker's latency histograms. Independent of PROFILE_ON.
+STAGE_RECORDERS = []
 
-def profile(on=PROFILE_ON, output_filepath=PROFILE_FILEPATH):
-    from wcautils import ioutils
 
+def profile(on=PROFILE_ON, output_filepath=PROFILE_FILEPATH):
     def wrapper(func):
         @wraps(func)
         def timed(*args, **kw):
-            if on:
-                ts = time.clock()
+            if not on and not STAGE_RECORDERS:
+                return func(*args, **kw)
+            ts = time.clock()
+            wall_ts = time.time()
             result = func(*args, **kw)
-            result_pkl = ioutils.serialize_list(*result)
+            wall_te = time.time()
+            te = time.clock()
+            for recorder in STAGE_RECORDERS:
+                recorder(func.__name__, wall_te - wall_ts)
             if on:
-                te = time.clock()
+                from wcautils import ioutils
+                result_pkl = ioutils.serialize_list(*result)
                 with open(output_filepath, 'a') as f:
                     f.write("{},{},{}\n".format(func.__name__,
                                                 round((te-ts)*1000), len(result_pkl)))
@@ -54,7 +54,7 @@ class NumpyCompatibleEncoder(json.JSONEncoder):
 
 
 class LegoHandler(object):
-    def __init__(self):
+    def __init__(self, board_tracking=config.BOARD_TRACKING):
         super(LegoHandler, self).__init__()
         self.is_first_frame = True
         self.commited_bitmap = np.zeros((1, 1), np.int)  # basically nothing
@@ -68,10 +68,29 @@ class LegoHandler(object):
                         'same_as_prev': 0,
                         'diff_from_prev': 0,
                         }
+        # board trackers keyed by client stream
+        self._board_tracking = board_tracking
+        self._board_trackers = {}
 
     def __repr__(self):
         return "Lego Handler"
 
+    @property
+    def per_stream_state(self):
+        """Whether process() keeps state for each client stream."""
+        return self._board_tracking
+
+    def get_board_tracker(self, stream_id=None):
+        if stream_id not in self._board_trackers:
+            self._board_trackers[stream_id] = lc.BoardTracker()
+        return self._board_trackers[stream_id]
+
+    def board_skip_rate(self):
+        """Fraction of frames that skipped full board detection."""
+        tracked = sum([t.stats['tracked'] for t in self._board_trackers.values()])
+        located = sum([t.stats['located'] for t in self._board_trackers.values()])
+        return float(tracked) / max(tracked + located, 1)
+
     def process_for_instruction(self, img):
         if self.is_first_frame and not config.RECOGNIZE_ONLY:  # do something special when the task begins
             result, img_guidance = self.task.get_first_guidance()
@@ -148,14 +167,19 @@ class LegoHandler(object):
 
         return json.dumps(result)
 
-    def process(self, img):
-        """Statelessly process the image.
+    def process(self, img, stream_id=None):
+        """Process the image.
 
-        For lego, return the extracted bitmap
+        For lego, return the extracted bitmap.
+        Stateless unless board tracking is on, in which case the board location
+        is remembered for each client stream.
 
         Arguments:
             img {[type]} -- [description]
 
+        Keyword Arguments:
+            stream_id {string} -- client stream the image belongs to (default: {None})
+
         Returns:
             [type] -- [description]
         """
@@ -163,7 +187,11 @@ class LegoHandler(object):
         if img.shape != (config.IMAGE_WIDTH, config.IMAGE_HEIGHT, 3):
             img = cv2.resize(
                 img, (config.IMAGE_WIDTH, config.IMAGE_HEIGHT), interpolation=cv2.INTER_AREA)
-        rtn_msg, bitmap = lc.process(img, stretch_ratio, display_list)
+        board_tracker = None
+        if self._board_tracking:
+            board_tracker = self.get_board_tracker(stream_id)
+        rtn_msg, bitmap = lc.process(
+            img, stretch_ratio, display_list, board_tracker=board_tracker)
         if rtn_msg['status'] == 'success':
             result = bitmap
         else:
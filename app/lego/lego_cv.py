@@ -646,7 +646,7 @@ def _locate_board(img, stretch_ratio, display_list):
     closest_cnt = zc.get_closest_contour(contours, hierarchy, in_board_p, min_span = config.BD_BLOCK_SPAN, hierarchy_req = 'inner')
     if closest_cnt is None or (not zc.is_roughly_convex(closest_cnt)):
         rtn_msg = {'status' : 'fail', 'message' : 'Cannot locate board border, maybe not the full board is in the scene. Failed at stage 1'}
-        return (rtn_msg, None, None, None)
+        return (rtn_msg, None, None, None, None)
     hull = cv2.convexHull(closest_cnt)
     mask_board = np.zeros(mask_black.shape, dtype=np.uint8)
     cv2.drawContours(mask_board, [hull], 0, 255, -1)
@@ -661,7 +661,7 @@ def _locate_board(img, stretch_ratio, display_list):
     closest_cnt = zc.get_closest_contour(contours, hierarchy, in_board_p, min_span = config.BD_BLOCK_SPAN, hierarchy_req = 'inner')
     if closest_cnt is None or (not zc.is_roughly_convex(closest_cnt)):
         rtn_msg = {'status' : 'fail', 'message' : 'Cannot locate board border, maybe not the full board is in the scene. Failed at stage 2'}
-        return (rtn_msg, None, None, None)
+        return (rtn_msg, None, None, None, None)
     hull = cv2.convexHull(closest_cnt)
     mask_board = np.zeros(mask_black.shape, dtype=np.uint8)
     cv2.drawContours(mask_board, [hull], 0, 255, -1)
@@ -680,7 +680,7 @@ def _locate_board(img, stretch_ratio, display_list):
     board_area = cv2.contourArea(hull)
     if board_area < config.BOARD_MIN_AREA:
         rtn_msg = {'status' : 'fail', 'message' : 'Detected board too small'}
-        return (rtn_msg, None, None, None)
+        return (rtn_msg, None, None, None, None)
 
     M = cv2.moments(hull)
     board_center = (int(M['m01']/M['m00']), int(M['m10']/M['m00'])) # in (row, col) format
@@ -693,7 +693,7 @@ def _locate_board(img, stretch_ratio, display_list):
     corners = get_corner_pts(board_border, board_perimeter, board_center, method = 'line')
     if corners is None:
         rtn_msg = {'status' : 'fail', 'message' : 'Cannot locate exact four board corners, probably because of occlusion'}
-        return (rtn_msg, None, None, None)
+        return (rtn_msg, None, None, None, None)
 
     thickness = int(calc_thickness(corners, stretch_ratio) * 0.8) # TODO: should be able to be more accurate
     #print "Brick thickness: %d pixels" % thickness
@@ -713,7 +713,7 @@ def _locate_board(img, stretch_ratio, display_list):
         perspective_mtx = cv2.getPerspectiveTransform(corners, target_points)
 
     rtn_msg = {'status' : 'success'}
-    return (rtn_msg, img_board, perspective_mtx, thickness)
+    return (rtn_msg, img_board, perspective_mtx, thickness, hull)
 
 def _detect_lego(img_board, display_list, method = 'edge', edge_th = [80, 160], mask_black_dots = None, mask_lego_rough = None, add_color = True):
     if method == 'edge':
@@ -1010,7 +1010,12 @@ def _get_rectangular_area(img_board, img_correct, rotation_mtx, display_list):
     rtn_msg = {'status' : 'success'}
     return (rtn_msg, img_lego_rect)
 
-def _img2bitmap(img, color_cumsums, n_rows, n_cols, lego_color):
+def _img2bitmap_loop(img, color_cumsums, n_rows, n_cols, lego_color):
+    '''
+    Reference implementation of _img2bitmap which walks through every offset candidate and every block in python
+    '''
+    if isinstance(color_cumsums, np.ndarray):
+        color_cumsums = dict(zip(config.COLOR_ORDER, color_cumsums))
     height, width, _ = img.shape
     img_plot = None
     bitmap = np.zeros((n_rows, n_cols), dtype = int)
@@ -1103,6 +1108,102 @@ def _img2bitmap(img, color_cumsums, n_rows, n_cols, lego_color):
 
     return best_bitmap, best_ratio, best_plot, best_offset
 
+def _bitmap_offsets():
+    '''
+    All (top, bottom, left, right) offset candidates to try when fitting a grid to the Lego image
+    '''
+    offset_range = {'t' : 0,
+                    'b' : int(round(config.BRICK_HEIGHT / 3)),
+                    'l' : int(round(config.BRICK_WIDTH / 3)),
+                    'r' : int(round(config.BRICK_WIDTH / 3))}
+    offsets = []
+    for height_offset_t in xrange(0, offset_range['t'] + 1, 2):
+        for height_offset_b in xrange(0, offset_range['b'] + 1, 2):
+            for width_offset_l in xrange(0, offset_range['l'] + 1, 2):
+                for width_offset_r in xrange(0, offset_range['r'] + 1, 2):
+                    offsets.append((height_offset_t, height_offset_b, width_offset_l, width_offset_r))
+    return offsets
+
+def _block_edges(length, offset, n_blocks):
+    block_size = float(length) / n_blocks
+    return [int(round(block_size * i)) + offset for i in xrange(n_blocks + 1)]
+
+def _img2bitmap_vectorized(img, color_cumsums, n_rows, n_cols, lego_color):
+    '''
+    Same as _img2bitmap_loop, but evaluates all offset candidates and all blocks at once.
+    @color_cumsums is the stacked integral image of shape (n_colors, H + 1, W + 1) in the order of config.COLOR_ORDER
+    '''
+    if isinstance(color_cumsums, dict):
+        color_cumsums = np.array([color_cumsums[color_key] for color_key in config.COLOR_ORDER])
+    height, width, _ = img.shape
+    offsets = _bitmap_offsets()
+    n_offsets = len(offsets)
+
+    # block borders for every offset candidate, in shape (n_offsets, n_rows, 1) and (n_offsets, 1, n_cols)
+    row_edges = np.array([_block_edges(height - t - b, t, n_rows) for (t, b, l, r) in offsets])
+    col_edges = np.array([_block_edges(width - l - r, l, n_cols) for (t, b, l, r) in offsets])
+    i_start = row_edges[:, :-1, np.newaxis]; i_end = row_edges[:, 1:, np.newaxis]
+    j_start = col_edges[:, np.newaxis, :-1]; j_end = col_edges[:, np.newaxis, 1:]
+
+    def block_sums(i_start, i_end, j_start, j_end):
+        # gather over the stacked integral image, result is in shape (n_colors, n_offsets, n_rows, n_cols)
+        return color_cumsums[:, i_end, j_end] - color_cumsums[:, i_start, j_end] \
+             - color_cumsums[:, i_end, j_start] + color_cumsums[:, i_start, j_start]
+
+    # focus more on center part
+    o = config.BLOCK_DETECTION_OFFSET
+    counts = block_sums(i_start + o, i_end - o, j_start + o, j_end - o)
+    bitmaps = np.argmax(counts[:-1], axis = 0)
+    # percentage correct for center part of block
+    n_pixels_block_center = counts.sum(axis = 0) + 0.00000001
+    n_good_pixels_block_center = np.choose(bitmaps, counts[:-1])
+    ratio_block_center = n_good_pixels_block_center / n_pixels_block_center
+    # accumulate in the same order as the loop version so that results are bit-exact
+    n_pixels_center = np.add.accumulate(n_pixels_block_center.reshape(n_offsets, -1), axis = 1)[:, -1]
+    n_good_pixels_center = n_good_pixels_block_center.reshape(n_offsets, -1).sum(axis = 1)
+
+    # percentage correct for entire block, unsure pixels are half right
+    block_counts = block_sums(i_start, i_end, j_start, j_end)
+    n_good_pixels_block = np.choose(bitmaps, block_counts[:-1]) + block_counts[-1] / 2.0
+    n_good_pixels = n_good_pixels_block.reshape(n_offsets, -1).sum(axis = 1)
+    n_pixels_block = (j_end - j_start) * (i_end - i_start)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        ratio_block = n_good_pixels_block / n_pixels_block
+    if config.OPT_NOTHING:
+        ratio_block = np.where(bitmaps == 0, ratio_block * 0.9, ratio_block)
+    ratio_block = ratio_block * 0.34 + ratio_block_center * 0.66
+    worst_ratio_block = np.fmin(np.fmin.reduce(ratio_block.reshape(n_offsets, -1), axis = 1), 1)
+
+    n_pixels = np.array([(height - t - b) * (width - l - r) for (t, b, l, r) in offsets])
+    ratio = n_good_pixels / n_pixels * 0.34 + n_good_pixels_center / n_pixels_center * 0.66
+
+    # the first offset candidate with the highest ratio wins, as in the loop version
+    is_valid = np.logical_and(worst_ratio_block > config.WORST_RATIO_BLOCK_THRESH, ratio > 0)
+    if not is_valid.any():
+        return None, 0, None, None
+    best_idx = np.argmax(np.where(is_valid, ratio, -np.inf))
+    best_bitmap = bitmaps[best_idx].astype(int)
+    best_ratio = ratio[best_idx]
+    best_offset = offsets[best_idx]
+
+    best_plot = None
+    if 'plot_line' in config.DISPLAY_LIST:
+        if lego_color is not None:
+            best_plot = lego_color.copy()
+        else:
+            best_plot = img.copy()
+        for i in row_edges[best_idx]:
+            cv2.line(best_plot, (0, i), (width - 1, i), (255, 255, 0), 1)
+        for j in col_edges[best_idx]:
+            cv2.line(best_plot, (j, 0), (j, height - 1), (255, 255, 0), 1)
+
+    return best_bitmap, best_ratio, best_plot, best_offset
+
+def _img2bitmap(img, color_cumsums, n_rows, n_cols, lego_color):
+    if config.BITMAP_ENGINE == 'loop':
+        return _img2bitmap_loop(img, color_cumsums, n_rows, n_cols, lego_color)
+    return _img2bitmap_vectorized(img, color_cumsums, n_rows, n_cols, lego_color)
+
 @config.profile()
 def _reconstruct_lego(img_lego, img_board, img_board_ns, rotation_mtx, display_list):
     def _lego_outof_board(mask_lego, img_board, rotation_mtx, borders):
@@ -1161,23 +1262,16 @@ def _reconstruct_lego(img_lego, img_board, img_board_ns, rotation_mtx, display_l
     unsure = np.invert(zc.super_bitwise_or((nothing, white, green, red, yellow, blue, black)))
 
     ## calculate cumulative sum for color pixels to speed up sum operation
-    nothing_cumsum = zc.calc_cumsum(nothing)
-    white_cumsum = zc.calc_cumsum(white)
-    green_cumsum = zc.calc_cumsum(green)
-    yellow_cumsum = zc.calc_cumsum(yellow)
-    red_cumsum = zc.calc_cumsum(red)
-    blue_cumsum = zc.calc_cumsum(blue)
-    black_cumsum = zc.calc_cumsum(black)
-    unsure_cumsum = zc.calc_cumsum(unsure)
-    color_cumsums = {'nothing' : nothing_cumsum,
-                     'white'   : white_cumsum,
-                     'green'   : green_cumsum,
-                     'yellow'  : yellow_cumsum,
-                     'red'     : red_cumsum,
-                     'blue'    : blue_cumsum,
-                     'black'   : black_cumsum,
-                     'unsure'  : unsure_cumsum
-                    }
+    color_masks = {'nothing' : nothing,
+                   'white'   : white,
+                   'green'   : green,
+                   'yellow'  : yellow,
+                   'red'     : red,
+                   'blue'    : blue,
+                   'black'   : black,
+                   'unsure'  : unsure
+                  }
+    color_cumsums = zc.calc_stacked_cumsum([color_masks[color_key] for color_key in config.COLOR_ORDER])
     # generate an image with each pixel as its assigned color, for debug purpose
     lego_color = None
     if 'lego_color' in display_list:
@@ -1222,11 +1316,80 @@ def _reconstruct_lego(img_lego, img_board, img_board_ns, rotation_mtx, display_l
     rtn_msg = {'status' : 'success'}
     return (rtn_msg, best_bitmap)
 
-def process(img, stretch_ratio, display_list):
+class BoardTracker(object):
+    '''
+    Remembers where the board is in a video stream, so that steady frames can skip _locate_board.
+    The board located by the last full detection is reused as long as a low resolution, grey scale
+    board crop of the new frame stays close to the crop taken at detection time.
+    '''
+    def __init__(self):
+        self.stats = {'tracked' : 0, 'located' : 0}
+        self.reset()
+
+    def reset(self):
+        self.hull = None
+        self.mask_board = None
+        self.perspective_mtx = None
+        self.thickness = None
+        self.board_small = None
+        self.n_skipped = 0
+
+    def _get_board_small(self, img, perspective_mtx):
+        img_board = cv2.warpPerspective(img, perspective_mtx, (config.BOARD_RECONSTRUCT_WIDTH, config.BOARD_RECONSTRUCT_HEIGHT))
+        bw_board = cv2.cvtColor(img_board, cv2.COLOR_BGR2GRAY)
+        return cv2.resize(bw_board, (0, 0), fx = config.BOARD_TRACK_SCALE, fy = config.BOARD_TRACK_SCALE, interpolation = cv2.INTER_AREA)
+
+    def is_board_steady(self, img):
+        if self.perspective_mtx is None or self.n_skipped >= config.BOARD_TRACK_MAX_SKIP:
+            return False
+        if self.mask_board.shape != img.shape[0:2]:
+            return False
+        board_small = self._get_board_small(img, self.perspective_mtx)
+        diff = cv2.absdiff(board_small, self.board_small).mean()
+        return diff < config.BOARD_TRACK_DIFF_TH
+
+    def update(self, img, rtn_msg, img_board, perspective_mtx, thickness, hull):
+        self.stats['located'] += 1
+        if rtn_msg['status'] != 'success':
+            self.reset()
+            return
+        self.hull = hull
+        self.mask_board = np.zeros(img.shape[0:2], dtype=np.uint8)
+        cv2.drawContours(self.mask_board, [hull], 0, 255, -1)
+        self.perspective_mtx = perspective_mtx
+        self.thickness = thickness
+        self.board_small = self._get_board_small(img, perspective_mtx)
+        self.n_skipped = 0
+
+@config.profile()
+def _track_board(img, board_tracker):
+    '''
+    Cheap replacement of _locate_board which reuses the board found in a previous frame by @board_tracker
+    '''
+    if not board_tracker.is_board_steady(img):
+        rtn_msg = {'status' : 'fail', 'message' : 'Board moved or not located yet'}
+        return (rtn_msg, None, None, None, None)
+    board_tracker.stats['tracked'] += 1
+    board_tracker.n_skipped += 1
+    img_board = np.zeros(img.shape, dtype=np.uint8)
+    img_board = cv2.bitwise_and(img, img, dst = img_board, mask = board_tracker.mask_board)
+    rtn_msg = {'status' : 'success'}
+    return (rtn_msg, img_board, board_tracker.perspective_mtx, board_tracker.thickness, board_tracker.hull)
+
+def process(img, stretch_ratio, display_list, board_tracker = None):
+    '''
+    If @board_tracker is given, the board location of previous frames in the same stream is reused when possible
+    '''
     ######################## detect board ######################################
-    out = _locate_board(img, stretch_ratio, display_list)
+    out = None
+    if board_tracker is not None:
+        out = _track_board(img, board_tracker)
+    if out is None or out[0]['status'] != 'success':
+        out = _locate_board(img, stretch_ratio, display_list)
+        if board_tracker is not None:
+            board_tracker.update(img, *out)
     rtn_msg = out[0]
-    extra = out[1:]
+    extra = out[1:4]
     if rtn_msg['status'] != 'success':
         return (rtn_msg, None)
 
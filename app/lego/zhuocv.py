@@ -391,6 +391,19 @@ def calc_cumsum(input_array):
 
     return new_cumsum
 
+def calc_stacked_cumsum(input_arrays):
+    '''
+    Same as calc_cumsum, but for a list of 2D arrays with the same shape.
+    Returns the stacked cumulative sums in shape (len(@input_arrays), height + 1, width + 1)
+    '''
+    input_arrays = np.array(input_arrays)
+    n_arrays, height, width = input_arrays.shape
+    cumsum = np.cumsum(np.cumsum(input_arrays, axis=1), axis=2)
+    new_cumsum = np.zeros((n_arrays, height + 1, width + 1))
+    new_cumsum[:,1:,1:] = cumsum
+
+    return new_cumsum
+
 def skeletonize(mask):
     import skimage.morphology
     skeleton = skimage.morphology.skeletonize(mask > 0)
@@ -1,2 +1,5 @@
 from handler import PingpongHandler as Handler
+from pingpong import config
 OMP_NUM_THREADS = 2
+# max(width, height) the handler works at. Workers may decode frames at a reduced size down to this
+WORKING_MAX_WH = config.IMAGE_MAX_WH
@@ -115,6 +115,8 @@ class PingpongHandler(object):
         self.last_played = "nothing"
 
         self.seen_opponent = False
+        # frames with a table, and those of them without a usable previous frame
+        self.stats = {'processed': 0, 'reference_fallback': 0}
 
     def __repr__(self):
         return "Pingpong Handler"
@@ -141,6 +143,7 @@ class PingpongHandler(object):
             return rtn_msg['message']
 
         img_rotated, mask_table, rotation_matrix = objects
+        self.stats['processed'] += 1
         current_frame_info = {'time': frame_time,
                               'img': img,
                               'img_rotated': img_rotated,
@@ -151,6 +154,7 @@ class PingpongHandler(object):
         ball_stat = None
         if self.prev_frame_info is None or frame_time - self.prev_frame_info['time'] > 300:
             LOG.info(LOG_TAG + "previous frame not good")
+            self.stats['reference_fallback'] += 1
             rtn_msg, objects = pc.find_pingpong(
                 img, None, mask_table, None, rotation_matrix, display_list)
             if rtn_msg['status'] != 'success':
@@ -209,6 +213,10 @@ class PingpongHandler(object):
             else:
                 return 'Found table, pingpong, and opponent. idle'
 
+    def reference_fallback_rate(self):
+        """Fraction of frames processed without a good previous frame."""
+        return float(self.stats['reference_fallback']) / max(self.stats['processed'], 1)
+
     def add_symbolic_state_for_instruction(self, symbolic_state):
         """Get current instruction from symbolic states.
         This is a stateful action, the order of symbolic_state passed
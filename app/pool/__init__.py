@@ -1,2 +1,5 @@
 from handler import PoolHandler as Handler
+from pool import config
 OMP_NUM_THREADS = 4
+# max(width, height) the handler works at. Workers may decode frames at a reduced size down to this
+WORKING_MAX_WH = config.IMAGE_MAX_WH
@@ -37,11 +37,15 @@ def get_slow_exponential(slow_decay_st, expo_decay_st, half_life):
 lego_util = get_slow_exponential(600, 2700, (2700 - 600) / 4.0)
 
 # threshold based on Zhuo's SEC'17 paper
-func_dict = {
-    'lego': get_slow_exponential(600, 2700, (2700 - 600) / 4.0),
+# (slow_decay_st, expo_decay_st, half_life) in ms
+slow_exponential_params = {
+    'lego': (600, 2700, (2700 - 600) / 4.0),
     # decay twice faster
-    'pingpong': get_slow_exponential(150, 230, (230 - 150) / 8.0),
-    'pool': get_slow_exponential(95, 105, (105 - 95) / 4.0),
-    'face': get_slow_exponential(370, 1000, (1000 - 370) / 4.0),
-    'ikea': get_slow_exponential(600, 2700, (2700 - 600) / 4.0),
+    'pingpong': (150, 230, (230 - 150) / 8.0),
+    'pool': (95, 105, (105 - 95) / 4.0),
+    'face': (370, 1000, (1000 - 370) / 4.0),
+    'ikea': (600, 2700, (2700 - 600) / 4.0),
 }
+
+func_dict = {app: get_slow_exponential(*params)
+             for (app, params) in slow_exponential_params.items()}
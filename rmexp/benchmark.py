@@ -0,0 +1,815 @@
+#!/usr/bin/env python
+"""Micro benchmarks of performance-critical code paths on recorded traces.
+
+Each benchmark is exposed as a fire command, e.g.
+python rmexp/benchmark.py lego-bitmap --video-uri data/lego-trace/1/video.mp4
+"""
+from __future__ import absolute_import, division, print_function
+
+import collections
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+
+import cv2
+import fire
+import numpy as np
+from logzero import logger
+
+
+def _read_frames(video_uri, max_frames=None):
+    cam = cv2.VideoCapture(video_uri)
+    frames = []
+    while max_frames is None or len(frames) < max_frames:
+        has_frame, img = cam.read()
+        if not has_frame or img is None:
+            break
+        frames.append(img)
+    cam.release()
+    logger.info('read {} frames from {}'.format(len(frames), video_uri))
+    return frames
+
+
+def _summarize(name, cpu_ms, **extra):
+    cpu_ms = np.array(cpu_ms)
+    stats = {
+        'name': name,
+        'frames': len(cpu_ms),
+        'mean_ms': round(float(np.mean(cpu_ms)), 3),
+        'p50_ms': round(float(np.percentile(cpu_ms, 50)), 3),
+        'p95_ms': round(float(np.percentile(cpu_ms, 95)), 3),
+    }
+    stats.update(extra)
+    print(json.dumps(stats))
+    return stats
+
+
+def lego_bitmap(video_uri, max_frames=300, engines=('loop', 'vectorized')):
+    """Per-frame CPU of lego_cv.process using different bitmap reconstruction engines.
+
+    Every engine runs over the same decoded frames. The symbolic states produced
+    by all engines are checked to be identical.
+    """
+    from lego import config
+    from lego import lego_cv as lc
+
+    frames = _read_frames(video_uri, max_frames)
+    frames = [cv2.resize(img, (config.IMAGE_WIDTH, config.IMAGE_HEIGHT),
+                         interpolation=cv2.INTER_AREA) for img in frames]
+    stretch_ratio = float(16) / 9 * config.IMAGE_HEIGHT / config.IMAGE_WIDTH
+
+    results = {}
+    for engine in engines:
+        config.BITMAP_ENGINE = engine
+        cpu_ms, bitmaps = [], []
+        for img in frames:
+            ts = time.clock()
+            rtn_msg, bitmap = lc.process(img, stretch_ratio, [])
+            cpu_ms.append((time.clock() - ts) * 1000)
+            bitmaps.append(bitmap.tolist() if bitmap is not None else None)
+        _summarize('lego_cv.process[{}]'.format(engine), cpu_ms)
+        results[engine] = bitmaps
+
+    reference = results[engines[0]]
+    for engine in engines[1:]:
+        mismatches = sum(
+            [a != b for (a, b) in zip(reference, results[engine])])
+        logger.info('{} frames differ between {} and {}'.format(
+            mismatches, engines[0], engine))
+
+
+def lego_board_tracking(video_uri, max_frames=300):
+    """Per-frame CPU of LegoHandler.process with and without board tracking.
+
+    Also reports the fraction of frames that skipped _locate_board and how many
+    symbolic states differ from full detection on every frame.
+    """
+    import lego
+
+    frames = _read_frames(video_uri, max_frames)
+    results = {}
+    for board_tracking in (False, True):
+        handler = lego.Handler(board_tracking=board_tracking)
+        cpu_ms, states = [], []
+        for img in frames:
+            ts = time.clock()
+            states.append(handler.process(img, stream_id=video_uri))
+            cpu_ms.append((time.clock() - ts) * 1000)
+        _summarize('LegoHandler.process[board_tracking={}]'.format(
+            board_tracking), cpu_ms)
+        results[board_tracking] = states
+        if board_tracking:
+            logger.info('board detection skip rate: {:.3f}'.format(
+                handler.board_skip_rate()))
+
+    mismatches = sum([a != b for (a, b) in zip(results[False], results[True])])
+    logger.info('{} frames differ with board tracking'.format(mismatches))
+
+
+def ikea_batch(video_uri, max_frames=240, batch_sizes=(1, 2, 4, 8)):
+    """Throughput and per-batch latency of IkeaHandler.process_batch across batch sizes.
+
+    Run with CUDA_VISIBLE_DEVICES= to measure on CPU.
+    """
+    import ikea
+
+    frames = _read_frames(video_uri, max_frames)
+    handler = ikea.Handler()
+    # warm up the session
+    handler.process_batch(frames[:max(batch_sizes)])
+    for batch_size in batch_sizes:
+        latency_ms = []
+        start = time.time()
+        for idx in range(0, len(frames), batch_size):
+            ts = time.time()
+            handler.process_batch(frames[idx:idx + batch_size])
+            latency_ms.append((time.time() - ts) * 1000)
+        fps = len(frames) / (time.time() - start)
+        _summarize('IkeaHandler.process_batch[{}]'.format(batch_size), latency_ms,
+                   throughput_fps=round(fps, 3))
+
+
+def jpeg_decode(video_uri, app, max_frames=300):
+    """Per-frame CPU of decoding client JPEGs at full size or reduced to the app's WORKING_MAX_WH.
+
+    Both paths end with the same resize to the working size. Also reports the mean absolute
+    pixel difference between the two.
+    """
+    import importlib
+    from rmexp import cvutils
+
+    max_wh = importlib.import_module(app).WORKING_MAX_WH
+    frames = _read_frames(video_uri, max_frames)
+    # encoded the same way as client.VideoClient
+    encoded = [cv2.imencode('.jpg', img)[1].tostring() for img in frames]
+    logger.info('frame size {}, scale down by {} for {}'.format(
+        cvutils.jpeg_size(encoded[0]), cvutils.get_reduced_scale(
+            cvutils.jpeg_size(encoded[0]), max_wh), app))
+
+    results = {}
+    for reduced in (False, True):
+        cpu_ms, imgs = [], []
+        for buf in encoded:
+            ts = time.clock()
+            img = cvutils.decode_jpeg(buf, max_wh=max_wh if reduced else None)
+            img = cvutils.resize_to_max_wh(img, max_wh)
+            cpu_ms.append((time.clock() - ts) * 1000)
+            imgs.append(img)
+        _summarize('decode[{}, reduced={}]'.format(app, reduced), cpu_ms)
+        results[reduced] = imgs
+
+    diffs = [np.mean(np.abs(a.astype(np.int16) - b)) for (a, b) in zip(results[False], results[True])
+             if a.shape == b.shape]
+    logger.info('{} frames differ in shape. mean abs pixel difference: {:.3f}'.format(
+        len(encoded) - len(diffs), np.mean(diffs) if diffs else float('nan')))
+
+
+def frame_filter(video_uri, app, max_frames=None, trace_id=None, measure_server=False, **params):
+    """Frames, bandwidth and server CPU a client-side frame filter saves, and its client CPU.
+
+    Frames are filtered in order like a client sending every frame of the trace. params
+    override the app's thresholds in framefilter.app_filter_params. If measure_server is True,
+    the app's handler is timed on the sent frames to estimate the server CPU saved. If trace_id
+    is given, the instruction delay caused by dropped frames is computed with dataset_analysis
+    from the trace's symbolic states in the database.
+    """
+    from rmexp import cvutils
+    from rmexp.client import framefilter
+
+    frames = _read_frames(video_uri, max_frames)
+    # encoded the same way as client.VideoClient
+    encoded = [cv2.imencode('.jpg', img)[1].tostring() for img in frames]
+    ff = framefilter.make_frame_filter(app, **params)
+    cpu_ms, sent = [], []
+    for buf in encoded:
+        ts = time.clock()
+        sent.append(ff(buf))
+        cpu_ms.append((time.clock() - ts) * 1000)
+
+    total_bytes = ff.stats['sent_bytes'] + ff.stats['dropped_bytes']
+    extra = {
+        'sent': ff.stats['sent'],
+        'blurry': ff.stats['blurry'],
+        'duplicate': ff.stats['duplicate'],
+        'bandwidth_saved': round(ff.stats['dropped_bytes'] / total_bytes, 3),
+    }
+    if measure_server:
+        import importlib
+        handler = importlib.import_module(app).Handler()
+        server_ms = []
+        for buf in [buf for (buf, s) in zip(encoded, sent) if s][:30]:
+            img = cvutils.decode_jpeg(buf)
+            ts = time.clock()
+            handler.process(img)
+            server_ms.append((time.clock() - ts) * 1000)
+        # server CPU saved per second of video at 30 fps
+        extra['server_ms'] = round(float(np.mean(server_ms)), 3)
+        extra['server_cpu_saved'] = round((len(encoded) - ff.stats['sent']) * extra['server_ms'] /
+                                          (len(encoded) * 1000. / 30.), 3)
+    if trace_id is not None:
+        from rmexp import dataset_analysis
+        delays, missed = dataset_analysis.get_frame_filter_inst_delay(app, trace_id, sent)
+        extra['inst_delay_mean_ms'] = round(float(np.mean(delays)), 3) if delays else None
+        extra['inst_delay_max_ms'] = round(float(np.max(delays)), 3) if delays else None
+        extra['inst_missed'] = missed
+    return _summarize('frame_filter[{}]'.format(app), cpu_ms, **extra)
+
+
+class _SimSocket(object):
+    """Stands in for the broker socket. Returns NACKed tokens to simulated clients."""
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.nacked = 0
+
+    def send_multipart(self, msg):
+        self.tokens[int(msg[0])] += 1
+        self.nacked += 1
+
+
+class _SimBroker(object):
+    def __init__(self, tokens):
+        self.socket = _SimSocket(tokens)
+
+
+def _jain_index(values):
+    values = np.array(values, dtype=float)
+    if not values.any():
+        return 0.
+    return values.sum() ** 2 / (len(values) * (values ** 2).sum())
+
+
+def trace_frames(video_uri, max_frames=300, n_rounds=10):
+    """Per-frame CPU of an emulated client getting JPEG frames from a directory of files or a packed trace.
+
+    Both are made in a temporary directory from the first max_frames frames of video_uri.
+    Also reports the CPU of creating a client, which counts the frames of a directory with glob.
+    """
+    import shutil
+    import tempfile
+    from rmexp.client.video import RTImageSequenceClient
+    from rmexp.dataset import packedtrace
+
+    frames = _read_frames(video_uri, max_frames)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        image_dir = os.path.join(tmp_dir, 'video-images')
+        os.mkdir(image_dir)
+        encoded = [cv2.imencode('.jpg', img)[1].tostring() for img in frames]
+        for (idx, frame) in enumerate(encoded):
+            # RTImageSequenceClient numbers files from 1
+            with open(os.path.join(image_dir, '{:010d}.jpg'.format(idx + 1)), 'wb') as f:
+                f.write(frame)
+        packed_dir = os.path.join(tmp_dir, packedtrace.PACKED_DNAME)
+        packedtrace.pack_frames(encoded, packed_dir)
+
+        for (name, uri) in (('video-images', image_dir), ('packed', packed_dir)):
+            ts = time.clock()
+            vc = RTImageSequenceClient('lego', uri, loop=True)
+            init_ms = (time.clock() - ts) * 1000
+            cpu_ms = []
+            for idx in range(n_rounds * len(encoded)):
+                ts = time.clock()
+                _, frame_bytes = vc._get_frame_bytes(idx)
+                cpu_ms.append((time.clock() - ts) * 1000)
+                assert len(frame_bytes) == len(encoded[idx % len(encoded)])
+            _summarize('trace_frames[{}]'.format(name), cpu_ms, init_ms=round(init_ms, 3))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def rt_video_clients(video_uri, n_clients=50, duration=10, reply_ms=300, keyframe_seek=True):
+    """Client host CPU of n_clients RTVideoClients emulating 30 FPS cameras in one process.
+
+    Each client gets a frame every reply_ms, like a client waiting for replies, so it
+    fast-forwards over the frames captured meanwhile. Clients start at random positions.
+    If keyframe_seek is False, clients grab every skipped frame instead of seeking to keyframes.
+    """
+    import random
+    from rmexp.client.video import RTVideoClient
+    from rmexp.dataset import videoindex
+
+    random.seed(0)
+    # clients build the index on first use. build it ahead so that their first frames are not skewed
+    videoindex.build(video_uri)
+    clients = [RTVideoClient('lego', video_uri, loop=True, random_start=True) for _ in range(n_clients)]
+    if not keyframe_seek:
+        for vc in clients:
+            index = vc._video_index()
+            if index is not None:
+                index.keyframes = index.keyframes[:1]
+    interval = reply_ms / 1000.
+    start = time.time()
+    # clients are spread over the interval
+    due = [start + interval * idx / n_clients for idx in range(n_clients)]
+    cpu_ms = []
+    cpu_start = time.clock()
+    while time.time() - start < duration:
+        idx = int(np.argmin(due))
+        time.sleep(max(0., due[idx] - time.time()))
+        ts = time.clock()
+        clients[idx].get_frame()
+        cpu_ms.append((time.clock() - ts) * 1000)
+        due[idx] += interval
+    cpu_util = (time.clock() - cpu_start) / (time.time() - start)
+    return _summarize('rt_video_clients[{}]'.format('seek' if keyframe_seek else 'grab'), cpu_ms,
+                      n_clients=n_clients, cpu_util=round(cpu_util, 3))
+
+
+def _simulate_broker_queue(queue_type, app, n_clients, n_workers, service_ms,
+                           fps, tokens_cap, duration, utility_threshold):
+    """Discrete event simulation of token clients sharing workers through one broker queue.
+
+    Returns (delivered utility per second, list of end-to-end latencies in ms,
+    #NACKs, #replies per client).
+    """
+    import heapq
+    from rmexp import app_utility_func, gabriel_pb2
+    from rmexp.broker import brokerqueue
+
+    now = [0.]
+    tokens = [tokens_cap] * n_clients
+    broker = _SimBroker(tokens)
+    if queue_type == 'list':
+        queue = []
+    elif queue_type == 'latency-optimized':
+        queue = brokerqueue.LatencyOptimizedTokenQueue(broker, service_name=app)
+    elif queue_type == 'per-client':
+        queue = brokerqueue.PerClientFreshnessTokenQueue(broker, service_name=app)
+    elif queue_type == 'edf':
+        queue = brokerqueue.DeadlineTokenQueue(
+            broker, service_name=app, utility_threshold=utility_threshold,
+            expected_service_ms=service_ms, clock=lambda: now[0])
+    else:
+        raise ValueError('unknown queue type {}'.format(queue_type))
+
+    util_fn = app_utility_func.func_dict[app]
+    rs = np.random.RandomState(0)
+    # (time, seq, kind, payload)
+    events = [(rs.uniform(0, 1. / fps), client_id, 'frame', client_id)
+              for client_id in range(n_clients)]
+    heapq.heapify(events)
+    seq = n_clients
+    idle_workers = n_workers
+    utility, latencies = 0., []
+    replies = [0] * n_clients
+
+    while events:
+        ts, _, kind, payload = heapq.heappop(events)
+        if ts > duration:
+            break
+        now[0] = ts
+        if kind == 'frame':
+            client_id = payload
+            if tokens[client_id] > 0:
+                tokens[client_id] -= 1
+                gabriel_msg = gabriel_pb2.Message()
+                gabriel_msg.timestamp = ts
+                queue.append([str(client_id), '',
+                              gabriel_msg.SerializeToString()])
+            heapq.heappush(events, (ts + 1. / fps, seq, 'frame', client_id))
+        else:
+            client_id, capture_ts = payload
+            tokens[client_id] += 1
+            replies[client_id] += 1
+            idle_workers += 1
+            latency_ms = (ts - capture_ts) * 1000.
+            latencies.append(latency_ms)
+            utility += util_fn(latency_ms)
+        seq += 1
+
+        if queue_type == 'edf':
+            queue.drop_expired()
+        while idle_workers > 0 and queue:
+            msg = queue.pop(0)
+            gabriel_msg = gabriel_pb2.Message()
+            gabriel_msg.ParseFromString(msg[-1])
+            idle_workers -= 1
+            heapq.heappush(events, (ts + service_ms / 1000., seq, 'done',
+                                    (int(msg[0]), gabriel_msg.timestamp)))
+            seq += 1
+
+    return utility / duration, latencies, broker.socket.nacked, replies
+
+
+def broker_queues(app='lego', n_clients=8, n_workers=2, service_ms=None, fps=30,
+                  tokens_cap=30, duration=120, utility_threshold=0.9,
+                  queue_types=('list', 'latency-optimized', 'per-client', 'edf')):
+    """Delivered utility of broker queue types under overload, in simulated time.
+
+    By default the service time is chosen so that clients offer 2x what the workers can process.
+    Fairness across clients is reported as Jain's index of per-client reply rates
+    (1 is perfectly fair, 1/n_clients is a single client being served).
+    """
+    if service_ms is None:
+        service_ms = 2. * n_workers * 1000. / (n_clients * fps)
+    logger.info('offered load: {:.2f}x of capacity'.format(
+        n_clients * fps * service_ms / 1000. / n_workers))
+    for queue_type in queue_types:
+        utility_per_sec, latencies, nacked, replies = _simulate_broker_queue(
+            queue_type, app, n_clients, n_workers, service_ms, fps, tokens_cap, duration,
+            utility_threshold)
+        _summarize('broker_queue[{}]'.format(queue_type), latencies,
+                   utility_per_sec=round(utility_per_sec, 3), nacked=nacked,
+                   fairness=round(_jain_index(replies), 3),
+                   min_client_fps=round(min(replies) / duration, 3))
+
+
+def _simulate_broker_routing(service_type, n_clients, n_workers, service_ms, fps,
+                             tokens_cap, duration, spill_ms, reference_gap_ms=300):
+    """Discrete event simulation of token clients sharing stateful workers.
+
+    A worker falls back to reprocessing a reference frame, as PingpongHandler does, when its
+    previous frame is from another client or more than reference_gap_ms older.
+    Returns (list of end-to-end latencies in ms, reference fallback rate, service).
+    """
+    import heapq
+    from rmexp.broker import mdbroker
+
+    now = [0.]
+    clock = lambda: now[0]
+    if service_type == 'normal':
+        service = mdbroker.Service('sim')
+    elif service_type == 'sticky':
+        service = mdbroker.StickyService('sim', spill_ms=spill_ms, clock=clock)
+    else:
+        raise ValueError('unknown service type {}'.format(service_type))
+
+    rs = np.random.RandomState(0)
+    workers = [mdbroker.Worker('{:04x}'.format(idx), str(idx), 0)
+               for idx in range(n_workers)]
+    for worker in workers:
+        service.add_waiting_worker(worker)
+    # worker --> (client, capture ts) of its previous frame
+    last_frame = {}
+    tokens = [tokens_cap] * n_clients
+    events = [(rs.uniform(0, 1. / fps), client_id, 'frame', client_id)
+              for client_id in range(n_clients)]
+    heapq.heapify(events)
+    seq = n_clients
+    latencies, fallbacks = [], 0
+
+    while events:
+        ts, _, kind, payload = heapq.heappop(events)
+        if ts > duration:
+            break
+        now[0] = ts
+        if kind == 'frame':
+            client_id = payload
+            if tokens[client_id] > 0:
+                tokens[client_id] -= 1
+                service.add_request(['client-{}'.format(client_id), '', ts])
+            heapq.heappush(events, (ts + 1. / fps, seq, 'frame', client_id))
+        else:
+            worker, client_id, capture_ts = payload
+            tokens[client_id] += 1
+            latencies.append((ts - capture_ts) * 1000.)
+            service.post_worker_processing(None, worker)
+            service.add_waiting_worker(worker)
+        seq += 1
+
+        while service.is_ready_to_send():
+            msg, worker = service.get_ready_to_send()
+            client_id, capture_ts = int(msg[0].split('-')[1]), msg[-1]
+            prev = last_frame.get(worker)
+            if (prev is None or prev[0] != client_id
+                    or (capture_ts - prev[1]) * 1000. > reference_gap_ms):
+                fallbacks += 1
+            last_frame[worker] = (client_id, capture_ts)
+            proc_s = rs.lognormal(np.log(service_ms), 0.3) / 1000.
+            heapq.heappush(events, (ts + proc_s, seq, 'done',
+                                    (worker, client_id, capture_ts)))
+            seq += 1
+
+    return latencies, float(fallbacks) / max(len(latencies), 1), service
+
+
+def broker_routing(n_clients=4, n_workers=4, service_ms=None, fps=30, tokens_cap=1,
+                   duration=120, spill_ms=100, service_types=('normal', 'sticky')):
+    """Reference frame fallbacks and reply latency of sticky client-to-worker routing, in simulated time.
+
+    By default the service time is chosen so that workers are 80% utilized.
+    PingpongHandler keeps one previous frame per process, so affinity only avoids fallbacks
+    as long as there are no more clients than workers.
+    """
+    if service_ms is None:
+        service_ms = 0.8 * n_workers * 1000. / (n_clients * fps)
+    logger.info('mean service time: {:.1f} ms'.format(service_ms))
+    for service_type in service_types:
+        latencies, fallback_rate, service = _simulate_broker_routing(
+            service_type, n_clients, n_workers, service_ms, fps, tokens_cap, duration, spill_ms)
+        extra = {'reference_fallback_rate': round(fallback_rate, 3)}
+        if hasattr(service, 'spill_rate'):
+            extra['spill_rate'] = round(service.spill_rate, 3)
+        _summarize('broker_routing[{}]'.format(service_type), latencies, **extra)
+
+
+def _simulate_autoscaler(service_type, n_workers, service_ms, rates, phase_s, expected_latency_ms,
+                         seed=0):
+    """Discrete event simulation of an adaptive worker pool under Poisson arrivals.
+
+    The arrival rate steps through rates, spending phase_s seconds at each.
+    Returns (list of latencies in ms, list of (time, #active workers) at every change).
+    """
+    import heapq
+    import logzero
+    from rmexp.broker import mdbroker
+
+    # pools log every worker they activate or deactivate
+    logzero.loglevel(logging.WARN)
+    now = [0.]
+    clock = lambda: now[0]
+    if service_type == 'adaptive':
+        # Scaler compares its expected latency to processing latencies in seconds
+        service = mdbroker.AdaptiveWorkerPoolService(
+            'sim', {'throughput': max(rates), 'latency': expected_latency_ms / 1000.}, clock=clock)
+    elif service_type in ('predictive', 'predictive-no-hysteresis'):
+        expected_stats = {'throughput': max(rates), 'latency': expected_latency_ms}
+        scaler_kwargs = {}
+        if service_type == 'predictive-no-hysteresis':
+            scaler_kwargs = {'min_utilization': 0.8, 'scale_down_delay': 0.}
+        service = mdbroker.PredictiveWorkerPoolService('sim', expected_stats, clock=clock)
+        # a perfect offline profile
+        service._scaler = mdbroker.PredictiveScaler(
+            service, expected_stats, latency_profile=lambda cpu, memory: service_ms, clock=clock,
+            **scaler_kwargs)
+    else:
+        raise ValueError('unknown service type {}'.format(service_type))
+
+    rs = np.random.RandomState(seed)
+    for idx in range(n_workers):
+        service.add_waiting_worker(mdbroker.Worker('{:04x}'.format(idx), str(idx), 0),
+                                   add_to_active_if_new=(idx == 0))
+    duration = phase_s * len(rates)
+    events = [(rs.exponential(1. / rates[0]), 0, 'request', None)]
+    seq = 1
+    latencies = []
+    active = [(0., len(service._active_pool))]
+
+    while events:
+        ts, _, kind, payload = heapq.heappop(events)
+        if ts > duration:
+            break
+        now[0] = ts
+        if kind == 'request':
+            service.add_request(['client', '', ts])
+            rate = rates[min(int(ts // phase_s), len(rates) - 1)]
+            heapq.heappush(events, (ts + rs.exponential(1. / rate), seq, 'request', None))
+        else:
+            worker, arrival_ts = payload
+            latencies.append((ts - arrival_ts) * 1000.)
+            service.post_worker_processing(None, worker)
+            service.add_waiting_worker(worker)
+        seq += 1
+
+        while service.is_ready_to_send():
+            msg, worker = service.get_ready_to_send()
+            proc_s = rs.lognormal(np.log(service_ms), 0.3) / 1000.
+            heapq.heappush(events, (ts + proc_s, seq, 'done', (worker, msg[-1])))
+            seq += 1
+        if len(service._active_pool) != active[-1][1]:
+            active.append((ts, len(service._active_pool)))
+
+    active.append((duration, active[-1][1]))
+    return latencies, active
+
+
+def _autoscaler_stats(latencies, active, expected_latency_ms):
+    steps = np.diff([n for (_, n) in active])
+    steps = steps[steps != 0]
+    times = np.array([ts for (ts, _) in active])
+    counts = np.array([n for (_, n) in active])
+    return {
+        'scaling_actions': len(steps),
+        'reversals': int(np.sum(np.sign(steps[1:]) != np.sign(steps[:-1]))),
+        'mean_active_workers': round(float(np.sum(np.diff(times) * counts[:-1]) / times[-1]), 2),
+        'slo_violations': round(float(np.mean(np.array(latencies) > expected_latency_ms)), 3),
+    }
+
+
+def autoscaler(n_workers=8, service_ms=100., rates=(5, 25, 10, 40, 15), phase_s=60,
+               expected_latency_ms=300., seed=0,
+               service_types=('adaptive', 'predictive-no-hysteresis', 'predictive')):
+    """Latency and worker pool oscillation of autoscaling policies, in simulated time.
+
+    Requests arrive open loop with a Poisson rate that steps through rates (requests per second),
+    starting with a single active worker. Reversals count how often the pool changes
+    from growing to shrinking or back. Requests slower than expected_latency_ms are SLO violations.
+    """
+    for service_type in service_types:
+        latencies, active = _simulate_autoscaler(
+            service_type, n_workers, service_ms, rates, phase_s, expected_latency_ms, seed=seed)
+        _summarize('autoscaler[{}]'.format(service_type), latencies,
+                   **_autoscaler_stats(latencies, active, expected_latency_ms))
+
+
+class _EmulatedRouterSocket(object):
+    """Stands in for the broker's ROUTER socket, with emulated workers and clients behind it.
+
+    Workers reply to requests and clients send their next request as soon as they get
+    a reply or a NACK. Messages in connect are received first and in order.
+    Then pending messages are received in random order, so workers finish out of order.
+    """
+
+    def __init__(self, rs):
+        self.rs = rs
+        self.connect = collections.deque()
+        self.inbox = []
+        self.received = 0
+
+    def recv_multipart(self, copy=True):
+        if self.connect:
+            self.received += 1
+            return self.connect.popleft()
+        # swap-pop a random message in O(1)
+        idx = self.rs.randint(len(self.inbox))
+        self.inbox[idx], self.inbox[-1] = self.inbox[-1], self.inbox[idx]
+        self.received += 1
+        return self.inbox.pop()
+
+    def send_multipart(self, msg):
+        from rmexp.broker import MDP
+
+        address = msg[0]
+        if msg[2] == MDP.C_CLIENT:
+            self.inbox.append([address, '', MDP.C_CLIENT, 'sim', 'frame'])
+        elif msg[3] == MDP.W_REQUEST:
+            # [worker, '', W_WORKER, W_REQUEST, client, '', body]
+            self.inbox.append([address, '', MDP.W_WORKER, MDP.W_REPLY, msg[4], '', msg[-1]])
+
+
+class _EmulatedPoller(object):
+    """Feeds the emulated socket to mediate() and times each loop iteration after warmup messages."""
+
+    def __init__(self, socket, n_messages, warmup):
+        self.socket = socket
+        self.n_messages = n_messages
+        self.warmup = warmup
+        self.loop_ms = []
+        self._last_poll = None
+
+    def poll(self, timeout=None):
+        now = time.time()
+        if self.socket.received > self.warmup:
+            self.loop_ms.append((now - self._last_poll) * 1000.)
+        self._last_poll = now
+        if (self.socket.received >= self.n_messages + self.warmup
+                or not (self.socket.connect or self.socket.inbox)):
+            # makes mediate() return
+            raise KeyboardInterrupt
+        return [(self.socket, 1)]
+
+
+def _emulate_broker_fleet(service_type, queue_type, n_workers, n_clients, n_messages):
+    """Run the broker's mediate() loop against n_workers emulated workers and n_clients clients.
+
+    Returns the ms spent on each loop iteration after all workers and clients have connected.
+    """
+    import logzero
+    from rmexp.broker import MDP, brokerqueue, mdbroker
+
+    # the broker logs every new worker
+    logzero.loglevel(logging.WARN)
+    service_types = {
+        'normal': mdbroker.Service,
+        'adaptive': mdbroker.AdaptiveWorkerPoolService,
+        'sticky': mdbroker.StickyService,
+    }
+    queue_types = {
+        'list': brokerqueue.FifoTokenQueue,
+        'latency-optimized': brokerqueue.LatencyOptimizedTokenQueue,
+        'per-client': brokerqueue.PerClientFreshnessTokenQueue,
+    }
+    broker = mdbroker.MajorDomoBroker(
+        service_types[service_type], {'sim': {'throughput': 30, 'latency': 1e-3}},
+        service_queue_type=queue_types[queue_type])
+    broker.socket.close()
+    rs = np.random.RandomState(0)
+    broker.socket = _EmulatedRouterSocket(rs)
+    broker.poller = _EmulatedPoller(broker.socket, n_messages, warmup=n_workers + n_clients)
+    broker.socket.connect.extend(
+        ['worker-{}'.format(idx), '', MDP.W_WORKER, MDP.W_READY, 'sim', 'False']
+        for idx in range(n_workers))
+    broker.socket.connect.extend(
+        ['client-{}'.format(idx), '', MDP.C_CLIENT, 'sim', 'frame']
+        for idx in range(n_clients))
+    broker.mediate()
+    broker.ctx.term()
+    return broker.poller.loop_ms
+
+
+def broker_fleet(fleet_sizes=(1000, 3000, 10000), clients_per_worker=1, n_messages=100000,
+                 service_types=('normal', 'adaptive', 'sticky'), queue_type='list'):
+    """Throughput of the broker's mediate() loop with large emulated worker fleets.
+
+    Workers and clients are emulated behind a fake socket and respond instantly,
+    so the loop's own bookkeeping is all that is measured.
+    """
+    for service_type in service_types:
+        for n_workers in fleet_sizes:
+            n_clients = int(n_workers * clients_per_worker)
+            loop_ms = _emulate_broker_fleet(
+                service_type, queue_type, n_workers, n_clients, n_messages)
+            _summarize('broker_fleet[{}, {} workers, {} clients]'.format(
+                service_type, n_workers, n_clients), loop_ms,
+                msgs_per_sec=round(1000. * len(loop_ms) / sum(loop_ms)))
+
+
+def _cpu_seconds(pid, main_thread_only=False):
+    """User plus system CPU time of a process, or of its main thread, from /proc."""
+    path = '/proc/{0}/task/{0}/stat' if main_thread_only else '/proc/{0}/stat'
+    with open(path.format(pid), 'r') as f:
+        # fields after the parenthesized command name, starting from state
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+
+
+def _echo_worker(broker_uri, service, stop):
+    from rmexp.broker.mdwrkapi import MajorDomoWorker
+
+    worker = MajorDomoWorker(broker_uri, service)
+    reply = None
+    while not stop.is_set():
+        request = worker.recv(reply)
+        if request is None:
+            break
+        reply = ['ok']
+
+
+def broker_forwarding(video_uri=None, n_messages=2000, outstanding=4, jpeg_quality=95,
+                      broker_uri='tcp://127.0.0.1:5599', zero_copy=(False, True)):
+    """Broker CPU per request forwarded from a client to a worker, with and without zero-copy frames.
+
+    Requests are gabriel messages carrying 1080p JPEG frames, read from video_uri or
+    synthesized if it is None. A real broker runs in its own process and its CPU time is
+    read from /proc, both in total and for the thread running mediate(). The worker echoes
+    a small reply.
+    """
+    from rmexp import gabriel_pb2
+    from rmexp.broker import mdbroker
+    from rmexp.broker.mdcliapi2 import MajorDomoClient
+
+    if video_uri is not None:
+        frames = _read_frames(video_uri, 30)
+    else:
+        rs = np.random.RandomState(0)
+        gradient = np.linspace(0, 200, 1920).astype(np.uint8)[np.newaxis, :, np.newaxis]
+        frames = [np.clip(gradient + rs.randint(0, 8, (1080, 1920, 3)), 0, 255).astype(np.uint8)
+                  for _ in range(4)]
+    frames = [cv2.resize(img, (1920, 1080)) for img in frames]
+    bodies = []
+    for (idx, img) in enumerate(frames):
+        gabriel_msg = gabriel_pb2.Message()
+        gabriel_msg.data = cv2.imencode(
+            '.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality])[1].tostring()
+        gabriel_msg.index = str(idx)
+        bodies.append(gabriel_msg)
+    logger.info('mean request size {:.0f} KB'.format(
+        np.mean([len(body.data) for body in bodies]) / 1024.))
+
+    for zc in zero_copy:
+        # workers of earlier runs may linger until their heartbeat expires
+        service = 'forward-{}'.format(zc)
+        broker = multiprocessing.Process(target=mdbroker.main, kwargs={
+            'broker_uri': broker_uri, 'zero_copy': zc})
+        broker.daemon = True
+        broker.start()
+        stop = threading.Event()
+        worker = threading.Thread(target=_echo_worker, args=(broker_uri, service, stop))
+        worker.daemon = True
+        worker.start()
+        client = MajorDomoClient(broker_uri)
+
+        latencies = []
+        sent_at = collections.deque()
+        n_warmup = 100
+        for idx in range(n_warmup + n_messages + outstanding):
+            if idx == n_warmup + outstanding:
+                cpu_start = _cpu_seconds(broker.pid)
+                main_cpu_start = _cpu_seconds(broker.pid, main_thread_only=True)
+            if idx < n_warmup + n_messages:
+                body = bodies[idx % len(bodies)]
+                body.timestamp = time.time()
+                client.send(service, body.SerializeToString())
+                sent_at.append(time.time())
+            if idx >= outstanding:
+                reply = client.recv(5000)
+                assert reply is not None, 'no reply from broker'
+                latencies.append((time.time() - sent_at.popleft()) * 1000.)
+        cpu_s = _cpu_seconds(broker.pid) - cpu_start
+        main_cpu_s = _cpu_seconds(broker.pid, main_thread_only=True) - main_cpu_start
+
+        stop.set()
+        broker.terminate()
+        broker.join()
+        _summarize('broker_forwarding[zero_copy={}]'.format(zc), latencies[n_warmup:],
+                   broker_cpu_us_per_msg=round(1e6 * cpu_s / n_messages, 1),
+                   # excludes zmq's I/O thread, which moves the bytes in and out of sockets
+                   broker_main_thread_cpu_us_per_msg=round(1e6 * main_cpu_s / n_messages, 1))
+
+
+if __name__ == "__main__":
+    fire.Fire()
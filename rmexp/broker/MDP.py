@@ -8,3 +8,6 @@ W_REPLY = 'W_REPLY'
 W_REQUEST = 'W_REQUEST'
 W_WORKER = 'W_WORKER'
 
+# multi-frame requests and replies for workers that process frames in batches
+W_BATCH_REQUEST = 'W_BATCH_REQUEST'
+W_BATCH_REPLY = 'W_BATCH_REPLY'
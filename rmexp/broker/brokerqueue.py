@@ -2,12 +2,90 @@
 Broker Queues for mdbroker
 """
 
+import collections
 import fire
+import heapq
+import itertools
 import logging
+import struct
 import sys
 import time
 import zmq
 import MDP
+from collections import OrderedDict
+
+from rmexp import app_utility_func, gabriel_pb2
+
+# Requests NACKed by a queue are returned to clients as this service type
+RETURN_TO_CLIENT_SERVICE_TYPE = 'NACK'
+
+_TIMESTAMP_FIELD_NUMBER = gabriel_pb2.Message.DESCRIPTOR.fields_by_name['timestamp'].number
+
+
+def _read_varint(buf, pos):
+    result = shift = 0
+    while True:
+        b = ord(buf[pos])
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+
+
+def peek_timestamp(body):
+    """Read the timestamp of a serialized gabriel message without parsing the whole message.
+
+    body can be anything supporting the buffer interface, e.g. a zmq.Frame.
+    Only field keys are decoded, so the image data is skipped over rather than copied.
+    Returns None if the message has no timestamp.
+    """
+    buf = memoryview(body)
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        key, pos = _read_varint(buf, pos)
+        field_number, wire_type = key >> 3, key & 0x7
+        if field_number == _TIMESTAMP_FIELD_NUMBER and wire_type == 1:
+            return struct.unpack_from('<d', buf, pos)[0]
+        if wire_type == 0:
+            _, pos = _read_varint(buf, pos)
+        elif wire_type == 1:
+            pos += 8
+        elif wire_type == 2:
+            length, pos = _read_varint(buf, pos)
+            pos += length
+        elif wire_type == 5:
+            pos += 4
+        else:
+            raise ValueError('unsupported wire type {}'.format(wire_type))
+    return None
+
+
+def send_nack(broker, msg):
+    """NACK a queued request so that the client gets its token back.
+
+    msg is a queued request: [client, '', body...]
+    """
+    client = msg[0]
+    broker.socket.send_multipart(
+        [client, '', MDP.C_CLIENT, RETURN_TO_CLIENT_SERVICE_TYPE, ''])
+
+
+class FifoTokenQueue(collections.deque):
+    """First-in-first-out queue.
+
+    Behaves like the plain list queue popped from the front, but pop is O(1).
+    """
+
+    def __init__(self, broker=None, service_name=None):
+        super(FifoTokenQueue, self).__init__()
+
+    def pop(self, *args, **kwargs):
+        """Pop the oldest request.
+        Any positional index is ignored.
+        """
+        return self.popleft()
 
 
 class LatencyOptimizedTokenQueue(object):
@@ -18,25 +96,25 @@ class LatencyOptimizedTokenQueue(object):
     with out dispatching them to workers.
     """
 
-    def __init__(self, broker):
+    def __init__(self, broker, service_name=None):
         super(LatencyOptimizedTokenQueue, self).__init__()
         self.broker = broker
         self.requests = []
-        self.return_to_client_service_type = 'NACK'
+        self.return_to_client_service_type = RETURN_TO_CLIENT_SERVICE_TYPE
+        self.nacked = 0
 
     def pop(self, *args, **kwargs):
         item = self.requests.pop()
         # send NACK to clients
-        while len(self.requests) > 0:
-            msg = self.requests.pop(0)
-            client = msg.pop(0)
-            empty = msg.pop(0)
-            msg = ['']
-            msg = [client, '', MDP.C_CLIENT,
-                   self.return_to_client_service_type] + msg
-            self.broker.socket.send_multipart(msg)
+        for msg in self.requests:
+            send_nack(self.broker, msg)
+        self.nacked += len(self.requests)
+        del self.requests[:]
         return item
 
+    def __len__(self):
+        return len(self.requests)
+
     def __bool__(self):
         return len(self.requests) > 0
 
@@ -50,3 +128,126 @@ class LatencyOptimizedTokenQueue(object):
         def wrapper(*args, **kwargs):
             return attr(*args, **kwargs)
         return wrapper
+
+
+class PerClientFreshnessTokenQueue(object):
+    """Queue that keeps only the newest request of each client.
+
+    When a client sends a new request while its previous one is still queued,
+    the previous one is NACKed right away to refill the client token.
+    Clients are served round-robin in the order they started waiting,
+    so no client is starved by others sending more often.
+    Both append and pop are O(1).
+    """
+
+    def __init__(self, broker, service_name=None):
+        super(PerClientFreshnessTokenQueue, self).__init__()
+        self.broker = broker
+        self.nacked = 0
+        # client identity --> newest request
+        self._requests = OrderedDict()
+
+    def append(self, msg):
+        client = msg[0]
+        stale_msg = self._requests.get(client)
+        if stale_msg is not None:
+            send_nack(self.broker, stale_msg)
+            self.nacked += 1
+        # replacing an existing key keeps the client's place in the round
+        self._requests[client] = msg
+
+    def pop(self, *args, **kwargs):
+        """Pop the newest request of the client that has waited the longest.
+        Any positional index is ignored.
+        """
+        if not self._requests:
+            raise IndexError('pop from empty queue')
+        return self._requests.popitem(last=False)[1]
+
+    def __len__(self):
+        return len(self._requests)
+
+    def __bool__(self):
+        return len(self._requests) > 0
+
+    __nonzero__ = __bool__
+
+
+class DeadlineTokenQueue(object):
+    """Earliest-deadline-first queue.
+
+    The deadline of a request is its capture timestamp plus the latency at which
+    the utility of the service's application starts to decay.
+    Requests whose expected utility, i.e. the utility at the time the worker
+    would finish them, has dropped below utility_threshold are NACKed
+    to refill client tokens instead of being sent to workers, when drop_expired
+    is called before dispatching. Both append and pop are O(log n).
+
+    expected_service_ms defaults to the service's expected latency in the
+    broker's service_expected_stats_config, or 0 if there is none.
+    """
+
+    def __init__(self, broker, service_name=None, utility_threshold=0.9,
+                 expected_service_ms=None, clock=time.time):
+        super(DeadlineTokenQueue, self).__init__()
+        self.broker = broker
+        self.utility_threshold = utility_threshold
+        if expected_service_ms is None:
+            expected_stats = (getattr(broker, 'service_expected_stats_config', None) or {}).get(
+                service_name, {})
+            expected_service_ms = expected_stats.get('latency', 0.)
+        self.expected_service_ms = float(expected_service_ms)
+        self.nacked = 0
+        self._clock = clock
+        self._heap = []
+        # tie breaker to keep FIFO order among requests with the same deadline
+        self._seq = itertools.count()
+        # services that are not apps have no deadline and are never NACKed
+        self._util_fn = app_utility_func.func_dict.get(service_name)
+        self._slack = 0.
+        if service_name in app_utility_func.slow_exponential_params:
+            self._slack = app_utility_func.slow_exponential_params[service_name][0] / 1000.
+
+    def _get_timestamp(self, msg):
+        try:
+            timestamp = peek_timestamp(msg[-1])
+        except Exception:
+            return self._clock()
+        return timestamp or self._clock()
+
+    def drop_expired(self):
+        """NACK requests at the head of the queue that are no longer useful.
+
+        Deadlines within a service have the same slack, so expired requests
+        are always at the head of the heap.
+        """
+        if self._util_fn is None:
+            return
+        now = self._clock()
+        while self._heap:
+            timestamp, msg = self._heap[0][2:]
+            expected_latency_ms = 1000. * (now - timestamp) + self.expected_service_ms
+            if self._util_fn(expected_latency_ms) >= self.utility_threshold:
+                break
+            heapq.heappop(self._heap)
+            send_nack(self.broker, msg)
+            self.nacked += 1
+
+    def append(self, msg):
+        timestamp = self._get_timestamp(msg)
+        heapq.heappush(self._heap,
+                       (timestamp + self._slack, next(self._seq), timestamp, msg))
+
+    def pop(self, *args, **kwargs):
+        """Pop the request with the earliest deadline.
+        Any positional index is ignored.
+        """
+        return heapq.heappop(self._heap)[-1]
+
+    def __len__(self):
+        return len(self._heap)
+
+    def __bool__(self):
+        return len(self._heap) > 0
+
+    __nonzero__ = __bool__
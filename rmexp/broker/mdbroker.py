@@ -7,8 +7,14 @@ Based on Java example by Arkadiusz Orzechowski
 Modified by Junjue Wang
 """
 
+import bisect
+import collections
 import enum
+import hashlib
+import heapq
+import itertools
 import logging
+import math
 import sys
 import time
 from binascii import hexlify
@@ -26,20 +32,192 @@ from zhelpers import dump
 
 logzero.loglevel(logging.INFO)
 
+
+def _frame_bytes(frame):
+    """Contents of a small envelope or header frame, received as zmq.Frame or bytes."""
+    return frame.bytes if isinstance(frame, zmq.Frame) else frame
+
+
+class RateMeter(object):
+    """Counts events and their rate over the last `window` whole seconds in O(1) per event."""
+
+    def __init__(self, window=5, clock=time.time):
+        super(RateMeter, self).__init__()
+        self.window = window
+        self.total = 0
+        self._clock = clock
+        # ring of per-second counts, one more than the window for the current second
+        self._seconds = [None] * (window + 1)
+        self._counts = [0] * (window + 1)
+
+    def add(self, n=1):
+        self.total += n
+        second = int(self._clock())
+        idx = second % len(self._counts)
+        if self._seconds[idx] != second:
+            self._seconds[idx] = second
+            self._counts[idx] = 0
+        self._counts[idx] += n
+
+    @property
+    def rate(self):
+        now = int(self._clock())
+        return sum(count for (second, count) in zip(self._seconds, self._counts)
+                   if second is not None and now - self.window <= second < now) / float(self.window)
+
+
+class WaitingWorkers(object):
+    """Multiset of waiting workers, with one entry for each free pipeline slot of a worker.
+
+    Unlike a list, membership tests and removals are O(1).
+    Iterating yields each waiting worker once.
+    """
+
+    def __init__(self):
+        super(WaitingWorkers, self).__init__()
+        # worker --> number of free slots
+        self._slots = {}
+        self._len = 0
+
+    def append(self, worker):
+        self._slots[worker] = self._slots.get(worker, 0) + 1
+        self._len += 1
+
+    def remove(self, worker):
+        """Remove one entry of the worker."""
+        n = self._slots.pop(worker)
+        if n > 1:
+            self._slots[worker] = n - 1
+        self._len -= 1
+
+    def discard(self, worker):
+        """Remove all entries of the worker, if any."""
+        self._len -= self._slots.pop(worker, 0)
+
+    def __contains__(self, worker):
+        return worker in self._slots
+
+    def __iter__(self):
+        return iter(self._slots)
+
+    def __len__(self):
+        return self._len
+
+    def __bool__(self):
+        return self._len > 0
+
+    __nonzero__ = __bool__
+
+
+class WaitingQueue(object):
+    """Queue of waiting workers, with one entry for each free pipeline slot of a worker.
+
+    Like a deque, but removing all entries of a worker is O(1). Entries are tagged with
+    a token of their worker that changes when it is removed, and entries with an old
+    token are skipped when they come up, like entries of MajorDomoBroker.expiries.
+    Iterating yields each worker once per free slot.
+    """
+
+    def __init__(self):
+        super(WaitingQueue, self).__init__()
+        # (worker, token) for each free slot, and skipped entries
+        self._entries = collections.deque()
+        # worker --> [its current token, number of free slots]
+        self._workers = {}
+        self._token_seq = itertools.count()
+        self._len = 0
+
+    def append(self, worker):
+        state = self._workers.get(worker)
+        if state is None:
+            state = self._workers[worker] = [next(self._token_seq), 0]
+        state[1] += 1
+        self._entries.append((worker, state[0]))
+        self._len += 1
+
+    def _take(self, entry):
+        worker = entry[0]
+        state = self._workers.get(worker)
+        if state is None or state[0] != entry[1]:
+            return None
+        state[1] -= 1
+        if not state[1]:
+            del self._workers[worker]
+        self._len -= 1
+        return worker
+
+    def popleft(self):
+        while True:
+            worker = self._take(self._entries.popleft())
+            if worker is not None:
+                return worker
+
+    def pop(self):
+        while True:
+            worker = self._take(self._entries.pop())
+            if worker is not None:
+                return worker
+
+    def discard(self, worker):
+        """Remove all entries of the worker, if any."""
+        state = self._workers.pop(worker, None)
+        if state is not None:
+            self._len -= state[1]
+        # keep skipped entries from piling up when the queue is seldom drained
+        if len(self._entries) > 2 * self._len + 64:
+            self._entries = collections.deque(
+                (w, token) for (w, token) in self._entries
+                if w in self._workers and self._workers[w][0] == token)
+
+    def __iter__(self):
+        for (worker, (_, slots)) in self._workers.iteritems():
+            for _ in xrange(slots):
+                yield worker
+
+    def __len__(self):
+        return self._len
+
+    def __bool__(self):
+        return self._len > 0
+
+    __nonzero__ = __bool__
+
+
 class Service(object):
     """a single Service"""
     name = None  # Service name
-    _requests = None  # List of client requests
-    _waiting = None  # List of waiting workers
+    _requests = None  # Queue of client requests
+    _waiting = None  # Queue of waiting workers
+    waiting_type = WaitingQueue  # Type of _waiting
+
+    batch_size = 1  # Largest batch size of the service's workers
+    requests_since = None  # When the request queue last became non-empty
+    dispatch_meter = None  # Requests sent to workers
 
     def __init__(self, name, requests_queue=None, **kwargs):
         self.name = name
-        self._requests = [] if requests_queue is None else requests_queue
-        self._waiting = []
+        self._requests = brokerqueue.FifoTokenQueue() if requests_queue is None else requests_queue
+        self._waiting = self.waiting_type()
+        self.dispatch_meter = RateMeter()
 
     def add_request(self, msg):
+        if not self._requests:
+            self.requests_since = time.time()
         self._requests.append(msg)
 
+    def drop_expired_requests(self):
+        """NACK queued requests that are no longer useful, if the queue expires them."""
+        drop_expired = getattr(self._requests, 'drop_expired', None)
+        if drop_expired is not None:
+            drop_expired()
+
+    def get_more_requests(self, n):
+        """Pop up to n more requests to batch with the one from get_ready_to_send."""
+        msgs = []
+        while len(msgs) < n and self._requests:
+            msgs.append(self._requests.pop(0))
+        return msgs
+
     def add_waiting_worker(self, worker, **kwargs):
         """This is called both when a worker is first initiazlied.
         And when a worker has finished processing a request.
@@ -47,17 +225,34 @@ class Service(object):
         self._waiting.append(worker)
 
     def get_ready_to_send(self):
-        return self._requests.pop(0), self._waiting.pop(0)
+        return self._requests.pop(0), self._waiting.popleft()
 
     def is_ready_to_send(self):
         return self._requests and self._waiting
 
     def remove_worker(self, worker):
-        self._waiting.remove(worker)
+        # a worker is waiting once for each free pipeline slot
+        self._waiting.discard(worker)
 
     def post_worker_processing(self, *args, **kwargs):
         pass
 
+    def get_stats(self):
+        """Queue and dispatch metrics reported by mmi.stats."""
+        return {
+            'queue_depth': len(self._requests),
+            'nacked': getattr(self._requests, 'nacked', 0),
+            'free_slots': len(self._waiting),
+            'waiting_workers': len(set(self._waiting)),
+            'dispatched': self.dispatch_meter.total,
+            'dispatch_rate': self.dispatch_meter.rate,
+        }
+
+
+def _latencies_ms(worker_latencies):
+    """{worker identity: ms} of per-worker latencies in seconds."""
+    return {worker.identity: round(1e3 * latency, 3) for (worker, latency) in worker_latencies.iteritems()}
+
 
 class Scaler(object):
     Event = enum.Enum('Event', 'send recv')
@@ -65,30 +260,31 @@ class Scaler(object):
     Metric_latency = 'latency'
     Action = enum.Enum('Action', 'up down')
 
-    def __init__(self, service, expected_stats, measurement_time_interval=1):
+    def __init__(self, service, expected_stats, measurement_time_interval=1, clock=time.time):
         super(Scaler, self).__init__()
         self.service = service
+        self._clock = clock
         self._expected_throughput = expected_stats[self.Metric_throughput]
         self._expected_latency = expected_stats[self.Metric_latency]
         # time interval over throuput is defined. by default 1s
         # throughput
         self._measurement_time_interval = float(measurement_time_interval)
-        self._requests_in_time_interval = []
+        self._requests_in_time_interval = collections.deque()
         self._start_time = None
         # latency
         self._sent_to_worker_ts = {}
         self._worker_proc_latency = {}
         # scaling interval
-        self._last_scale_ts = time.time()
+        self._last_scale_ts = self._clock()
         self._min_scale_interval = 3
 
     def add_stats(self, action, items):
         msg, worker = items
         if action == self.Event.send:
-            self._sent_to_worker_ts[worker] = time.time()
+            self._sent_to_worker_ts[worker] = self._clock()
             self._count_request()
         elif action == self.Event.recv:
-            proc_latency = time.time() - self._sent_to_worker_ts[worker]
+            proc_latency = self._clock() - self._sent_to_worker_ts[worker]
             if worker in self._worker_proc_latency:
                 last_proc_latency = self._worker_proc_latency[worker]
                 # a averaging window approach
@@ -99,12 +295,12 @@ class Scaler(object):
                 "Unrecognized add_stats action: {}".format(action))
 
     def _count_request(self):
-        ts = time.time()
+        ts = self._clock()
         if self._start_time is None:
             self._start_time = ts
         while self._requests_in_time_interval:
             if ts - self._requests_in_time_interval[0] > self._measurement_time_interval:
-                self._requests_in_time_interval.pop(0)
+                self._requests_in_time_interval.popleft()
             else:
                 break
         self._requests_in_time_interval.append(ts)
@@ -118,12 +314,14 @@ class Scaler(object):
         return self._measurement_time_interval
 
     def scale(self):
-        if time.time() - self._last_scale_ts < self._min_scale_interval:
+        if self._clock() - self._last_scale_ts < self._min_scale_interval:
             return
         action = None
         # scale up condition
         active_worker_latencies = [
             v for (k, v) in self._worker_proc_latency.iteritems() if k in self.service._active_pool]
+        if not active_worker_latencies:
+            return
         avg_latency = sum(active_worker_latencies) / float(len(active_worker_latencies))
         if avg_latency > 2. * self._expected_latency:
             self.service.inc_worker()
@@ -133,20 +331,144 @@ class Scaler(object):
             self.service.dec_worker()
 
 
+class PredictiveScaler(Scaler):
+    """Sizes the active worker pool from the load of a service instead of reacting to its latency.
+
+    The number of active workers is predicted from the request arrival rate (capped at the
+    expected throughput), the queue depth and the processing time of a request. Arrival rate and
+    queue depth are averaged over about rate_time_constant seconds, so bursts do not trigger scaling. Until
+    min_samples requests have been processed, the processing time comes from the offline
+    latency(cpu, memory) profile at the workers' resources, if there is one. Expected latency
+    and profiled latencies are in ms.
+
+    Workers are activated as soon as they would be more than max_utilization busy or the queue
+    could not be drained within the expected latency. They are deactivated only once they would be
+    less than min_utilization busy for scale_down_delay seconds.
+    """
+    Metric_cpu = 'cpu'
+    Metric_memory = 'memory'
+    Metric_latency_profile = 'latency_profile'
+
+    def __init__(self, service, expected_stats, latency_profile=None, clock=time.time,
+                 max_utilization=0.8, min_utilization=0.5, scale_down_delay=5.,
+                 rate_time_constant=2., min_samples=10):
+        """latency_profile: latency_ms(cpu, memory) function, e.g. from
+        data/profile/latency-<exp>-<app>.pkl. Loaded from the path at expected_stats['latency_profile'] if None.
+        """
+        super(PredictiveScaler, self).__init__(service, expected_stats, clock=clock)
+        self.max_utilization = max_utilization
+        self.min_utilization = min_utilization
+        self.scale_down_delay = scale_down_delay
+        self.min_samples = min_samples
+        if latency_profile is None and expected_stats.get(self.Metric_latency_profile):
+            latency_profile = load_latency_profile(expected_stats[self.Metric_latency_profile])
+        self._profiled_latency = None
+        if latency_profile is not None:
+            self._profiled_latency = 1e-3 * float(latency_profile(
+                expected_stats.get(self.Metric_cpu, 1.), expected_stats.get(self.Metric_memory, 2.)))
+        # exponentially decaying count of arrivals, i.e. the arrival rate
+        self._rate_time_constant = float(rate_time_constant)
+        self._arrival_rate = 0.
+        self._arrival_ts = None
+        self._queue_depth = 0.
+        self._queue_depth_ts = None
+        self._observed_latency = None
+        self._samples = 0
+        self._down_since = None
+
+    def add_stats(self, action, items):
+        if action == self.Event.recv:
+            sent_ts = self._sent_to_worker_ts.get(items[1])
+            if sent_ts is not None:
+                proc_latency = self._clock() - sent_ts
+                if self._observed_latency is not None:
+                    proc_latency = 0.9 * self._observed_latency + 0.1 * proc_latency
+                self._observed_latency = proc_latency
+                self._samples += 1
+        super(PredictiveScaler, self).add_stats(action, items)
+
+    def add_arrival(self):
+        self._arrival_rate = self.arrival_rate + 1. / self._rate_time_constant
+        self._arrival_ts = self._clock()
+
+    @property
+    def arrival_rate(self):
+        if self._arrival_ts is None:
+            return 0.
+        return self._arrival_rate * math.exp(
+            -(self._clock() - self._arrival_ts) / self._rate_time_constant)
+
+    def _update_queue_depth(self):
+        now = self._clock()
+        if self._queue_depth_ts is not None:
+            weight = math.exp(-(now - self._queue_depth_ts) / self._rate_time_constant)
+            self._queue_depth = weight * self._queue_depth + (1. - weight) * len(self.service._requests)
+        self._queue_depth_ts = now
+
+    @property
+    def service_time(self):
+        """Expected processing time of a request in seconds, or None if unknown."""
+        if self._samples < self.min_samples and self._profiled_latency is not None:
+            return self._profiled_latency
+        return self._observed_latency
+
+    def desired_workers(self, utilization):
+        """Active workers needed for each to be at most utilization busy and to drain the queue in time."""
+        service_time = self.service_time
+        if service_time is None:
+            return None
+        rate = self.arrival_rate
+        if self._expected_throughput:
+            rate = min(rate, self._expected_throughput)
+        # drain the queue within what is left of the expected latency,
+        # or within one processing time if the expected latency cannot be met anyway
+        drain_time = max(1e-3 * self._expected_latency - service_time, service_time)
+        workers = (rate * service_time / utilization
+                   + self._queue_depth * service_time / drain_time)
+        return max(1, int(math.ceil(workers - 1e-9)))
+
+    def scale(self):
+        self._update_queue_depth()
+        n_up = self.desired_workers(self.max_utilization)
+        if n_up is None:
+            return
+        now = self._clock()
+        active = len(self.service._active_pool)
+        if active < n_up:
+            for _ in range(n_up - active):
+                self.service.inc_worker()
+            self._down_since = None
+            self._last_scale_ts = now
+            return
+        n_down = self.desired_workers(self.min_utilization)
+        if active <= n_down:
+            self._down_since = None
+        elif self._down_since is None:
+            self._down_since = now
+        elif now - self._down_since >= self.scale_down_delay:
+            for _ in range(active - n_down):
+                self.service.dec_worker()
+            self._down_since = None
+            self._last_scale_ts = now
+
+
 class AdaptiveWorkerPoolService(Service):
     """A Service that would adapt its active worker pool."""
 
     # define criteria to scale up and scale down
     # handle token
+    scaler_type = Scaler
 
-    def __init__(self, name, expected_stats=None, requests_queue=None):
+    def __init__(self, name, expected_stats=None, requests_queue=None, clock=time.time):
         super(AdaptiveWorkerPoolService, self).__init__(name,
                                                         requests_queue=requests_queue)
         self._dormant_pool = set()
         self._active_pool = set()
+        # dormant worker --> number of its free slots, which are waiting once it is activated
+        self._parked = collections.Counter()
         assert expected_stats, '{} needs non-empty expected_stats'.format(
             self.__class__.__name__)
-        self._scaler = Scaler(self, expected_stats)
+        self._scaler = self.scaler_type(self, expected_stats, clock=clock)
 
     def get_ready_to_send(self):
         worker = self._waiting.pop()
@@ -187,19 +509,279 @@ class AdaptiveWorkerPoolService(Service):
 
         if worker in self._active_pool:
             self._waiting.append(worker)
+        else:
+            self._parked[worker] += 1
+
+    def remove_worker(self, worker):
+        super(AdaptiveWorkerPoolService, self).remove_worker(worker)
+        self._active_pool.discard(worker)
+        self._dormant_pool.discard(worker)
+        self._parked.pop(worker, None)
+        self._scaler._worker_proc_latency.pop(worker, None)
+        self._scaler._sent_to_worker_ts.pop(worker, None)
 
     # TODO(junjuew): still need to determine how to refill/drain tokens
     # when incr or dec workers
     def inc_worker(self):
         if self._dormant_pool:
             logger.info('increased 1 worker')
-            self._active_pool.add(self._dormant_pool.pop())
+            worker = self._dormant_pool.pop()
+            self._active_pool.add(worker)
+            for _ in range(self._parked.pop(worker, 0)):
+                self._waiting.append(worker)
 
     def dec_worker(self):
         # make sure there is at least 1 worker running
         if len(self._active_pool) > 1:
             logger.info('decreased 1 worker')
-            self._dormant_pool.add(self._active_pool.pop())
+            worker = self._active_pool.pop()
+            self._dormant_pool.add(worker)
+            # its free slots wait until it is activated again
+            n_waiting = len(self._waiting)
+            super(AdaptiveWorkerPoolService, self).remove_worker(worker)
+            self._parked[worker] += n_waiting - len(self._waiting)
+
+    def get_stats(self):
+        stats = super(AdaptiveWorkerPoolService, self).get_stats()
+        stats.update({
+            'active_workers': len(self._active_pool),
+            'dormant_workers': len(self._dormant_pool),
+            'throughput': self._scaler.throughput,
+            'proc_latency_ms': _latencies_ms(self._scaler._worker_proc_latency),
+        })
+        return stats
+
+
+class PredictiveWorkerPoolService(AdaptiveWorkerPoolService):
+    """AdaptiveWorkerPoolService whose active pool is sized by a PredictiveScaler."""
+
+    scaler_type = PredictiveScaler
+
+    def add_request(self, msg):
+        super(PredictiveWorkerPoolService, self).add_request(msg)
+        self._scaler.add_arrival()
+        self._scaler.scale()
+
+    def get_stats(self):
+        stats = super(PredictiveWorkerPoolService, self).get_stats()
+        service_time = self._scaler.service_time
+        stats.update({
+            'arrival_rate': round(self._scaler.arrival_rate, 3),
+            'service_time_ms': round(1e3 * service_time, 3) if service_time is not None else None,
+        })
+        return stats
+
+
+class StickyService(Service):
+    """A Service that routes requests of the same client to the same worker.
+
+    A new client is assigned to the first worker at or after its position
+    on a consistent hash ring that serves fewer than LOAD_FACTOR times the
+    average number of clients (consistent hashing with bounded loads).
+    The client then sticks to that worker, so that stateful handlers see
+    its consecutive frames. Clients move only when their worker leaves, or
+    when they have been silent for CLIENT_TIMEOUT seconds.
+    When the preferred worker is busy, a request is held for it if it would
+    start within spill_ms. Otherwise, or once a held request has waited
+    spill_ms, it spills over to the next idle worker on the ring.
+    """
+    VIRTUAL_NODES = 64
+    LOAD_FACTOR = 1.25
+    CLIENT_TIMEOUT = 10
+    # membership tests and removal of any waiting worker in O(1)
+    waiting_type = WaitingWorkers
+
+    def __init__(self, name, expected_stats=None, requests_queue=None, spill_ms=100, clock=time.time):
+        super(StickyService, self).__init__(name, requests_queue=requests_queue)
+        self._spill = spill_ms / 1000.
+        self._clock = clock
+        # sorted hashes of virtual nodes and the workers they belong to
+        self._ring_hashes = []
+        self._ring_workers = []
+        # workers joined since the ring was last built, and whether workers have left since then
+        self._ring_joined = []
+        self._ring_stale = False
+        # worker --> deque of (hold ts, msg). Only workers with held requests are kept
+        self._held = {}
+        self._sent_ts = {}
+        self._proc_latency = {}
+        # client --> assigned worker, worker --> number of assigned clients
+        self._client_worker = {}
+        self._worker_clients = collections.Counter()
+        # client --> last request ts, least recently seen first
+        self._client_seen = collections.OrderedDict()
+        self._next = None
+        self.stats = {'sticky': 0, 'spilled': 0}
+
+    @staticmethod
+    def _hash(key):
+        return int(hashlib.md5(key).hexdigest()[:8], 16)
+
+    def _virtual_nodes(self, worker):
+        return [(self._hash('{}#{}'.format(worker.identity, idx)), worker)
+                for idx in range(self.VIRTUAL_NODES)]
+
+    def _update_ring(self):
+        """Apply workers joining and leaving to the ring.
+
+        Changes are applied lazily, at the next ring lookup, so that a whole fleet
+        connecting at once costs one sort rather than a list insert per virtual node.
+        """
+        if self._ring_stale or len(self._ring_joined) > 4:
+            nodes = sorted(node for worker in self._proc_latency for node in self._virtual_nodes(worker))
+            self._ring_hashes = [h for (h, _) in nodes]
+            self._ring_workers = [w for (_, w) in nodes]
+        else:
+            for worker in self._ring_joined:
+                for (h, w) in self._virtual_nodes(worker):
+                    pos = bisect.bisect(self._ring_hashes, h)
+                    self._ring_hashes.insert(pos, h)
+                    self._ring_workers.insert(pos, w)
+        self._ring_joined = []
+        self._ring_stale = False
+
+    def _ring_walk(self, client):
+        """Workers in ring order starting from the client's position."""
+        if self._ring_joined or self._ring_stale:
+            self._update_ring()
+        start = bisect.bisect(self._ring_hashes, self._hash(client))
+        n = len(self._ring_workers)
+        for idx in xrange(n):
+            yield self._ring_workers[(start + idx) % n]
+
+    def _assign(self, client, worker):
+        old_worker = self._client_worker.pop(client, None)
+        if old_worker is not None:
+            self._worker_clients[old_worker] -= 1
+        if worker is not None:
+            self._client_worker[client] = worker
+            self._worker_clients[worker] += 1
+
+    def _preferred_worker(self, client, now):
+        # move the client to the most recently seen end
+        self._client_seen.pop(client, None)
+        self._client_seen[client] = now
+        worker = self._client_worker.get(client)
+        if worker is not None:
+            return worker
+        while True:
+            (c, ts) = next(self._client_seen.iteritems())
+            if now - ts <= self.CLIENT_TIMEOUT:
+                break
+            del self._client_seen[c]
+            self._assign(c, None)
+        max_load = math.ceil(
+            self.LOAD_FACTOR * (len(self._client_worker) + 1) / len(self._proc_latency))
+        for worker in self._ring_walk(client):
+            if self._worker_clients[worker] < max_load:
+                self._assign(client, worker)
+                return worker
+
+    def _expected_wait(self, worker, now):
+        proc_latency = self._proc_latency.get(worker, 0.)
+        elapsed = now - self._sent_ts.get(worker, now)
+        return max(proc_latency - elapsed, 0.) + len(self._held.get(worker, ())) * proc_latency
+
+    def _pop_held(self, worker):
+        held = self._held[worker]
+        msg = held.popleft()[1]
+        if not held:
+            del self._held[worker]
+        return msg
+
+    def _spill_to(self, client):
+        for worker in self._ring_walk(client):
+            if worker in self._waiting:
+                return worker
+
+    def _schedule(self):
+        """Find the next (msg, worker) pair to send, or None."""
+        if not self._waiting:
+            return None
+        # requests held for a worker that is now idle
+        for worker in self._held:
+            if worker in self._waiting:
+                self.stats['sticky'] += 1
+                return self._pop_held(worker), worker
+        now = self._clock()
+        # requests that have been held for too long
+        for (worker, held) in self._held.iteritems():
+            if now - held[0][0] > self._spill:
+                msg = self._pop_held(worker)
+                self.stats['spilled'] += 1
+                return msg, self._spill_to(msg[0])
+        while self._requests:
+            msg = self._requests.pop(0)
+            preferred = self._preferred_worker(msg[0], now)
+            if preferred in self._waiting:
+                self.stats['sticky'] += 1
+                return msg, preferred
+            if self._expected_wait(preferred, now) <= self._spill:
+                self._held.setdefault(preferred, collections.deque()).append((now, msg))
+                continue
+            self.stats['spilled'] += 1
+            return msg, self._spill_to(msg[0])
+        return None
+
+    def is_ready_to_send(self):
+        if self._next is None:
+            self._next = self._schedule()
+        return self._next is not None
+
+    def get_ready_to_send(self):
+        msg, worker = self._next
+        self._next = None
+        self._waiting.remove(worker)
+        self._sent_ts[worker] = self._clock()
+        return msg, worker
+
+    def add_waiting_worker(self, worker, **kwargs):
+        if worker not in self._proc_latency:
+            self._proc_latency[worker] = 0.
+            self._ring_joined.append(worker)
+        self._waiting.append(worker)
+
+    def post_worker_processing(self, msg, worker):
+        sent_ts = self._sent_ts.pop(worker, None)
+        if sent_ts is None:
+            # another request of a pipelined worker
+            return
+        proc_latency = self._clock() - sent_ts
+        last_proc_latency = self._proc_latency[worker]
+        if last_proc_latency:
+            # a averaging window approach
+            proc_latency = 0.9 * last_proc_latency + 0.1 * proc_latency
+        self._proc_latency[worker] = proc_latency
+
+    def remove_worker(self, worker):
+        self._waiting.discard(worker)
+        if self._proc_latency.pop(worker, None) is not None:
+            self._ring_stale = True
+        self._sent_ts.pop(worker, None)
+        for client in [c for (c, w) in self._client_worker.iteritems() if w is worker]:
+            self._assign(client, None)
+        self._worker_clients.pop(worker, None)
+        # requests scheduled or held for the worker go back to the queue
+        if self._next is not None:
+            self._requests.append(self._next[0])
+            self._next = None
+        for (_, msg) in self._held.pop(worker, ()):
+            self._requests.append(msg)
+
+    @property
+    def spill_rate(self):
+        total = self.stats['sticky'] + self.stats['spilled']
+        return self.stats['spilled'] / float(total) if total else 0.
+
+    def get_stats(self):
+        stats = super(StickyService, self).get_stats()
+        stats.update(self.stats)
+        stats.update({
+            'held': sum(len(held) for held in self._held.itervalues()),
+            'clients': len(self._client_worker),
+            'proc_latency_ms': _latencies_ms(self._proc_latency),
+        })
+        return stats
 
 
 class Worker(object):
@@ -208,6 +790,8 @@ class Worker(object):
     address = None  # Address to route to
     service = None  # Owning service, if known
     expiry = None  # expires at this point, unless heartbeat
+    batch_size = 1  # max number of requests per W_BATCH_REQUEST
+    pipeline_depth = 1  # max number of requests outstanding at the worker
 
     def __init__(self, identity, address, lifetime):
         self.identity = identity
@@ -234,25 +818,40 @@ class MajorDomoBroker(object):
     poller = None  # our Poller
 
     heartbeat_at = None  # When to send HEARTBEAT
+    started_at = None  # When the broker started
     services = None  # known services
     workers = None  # known workers
-    waiting = None  # idle workers
+    waiting = None  # idle workers --> number of their free pipeline slots
+    expiries = None  # heap of (when to check, seq, worker), one entry per known worker
 
     verbose = False  # Print activity to stdout
 
     # ---------------------------------------------------------------------
 
-    def __init__(self, service_type, service_expected_stats_config=None, verbose=False, service_queue_type=list):
-        """Initialize broker state."""
+    def __init__(self, service_type, service_expected_stats_config=None, verbose=False,
+                 service_queue_type=brokerqueue.FifoTokenQueue, batch_wait_ms=0, zero_copy=True,
+                 ctx=None, socket_type=zmq.ROUTER):
+        """Initialize broker state.
+
+        batch_wait_ms: how long requests may wait for a full batch when batching workers are idle
+        zero_copy: receive messages as zmq.Frame objects and forward payload frames without copying them
+        ctx, socket_type: context and type of the socket to clients & workers.
+            A shard of a ShardedBroker uses a PAIR socket in the front's context.
+        """
         self.verbose = verbose
+        self.zero_copy = zero_copy
+        self.batch_wait = 1e-3 * batch_wait_ms
         self.service_type = service_type
         self.service_expected_stats_config = service_expected_stats_config
         self.services = {}
         self.workers = {}
-        self.waiting = []
+        self.waiting = {}
+        self.expiries = []
+        self._expiry_seq = itertools.count()
         self.heartbeat_at = time.time() + 1e-3*self.HEARTBEAT_INTERVAL
-        self.ctx = zmq.Context()
-        self.socket = self.ctx.socket(zmq.ROUTER)
+        self.started_at = time.time()
+        self.ctx = ctx or zmq.Context()
+        self.socket = self.ctx.socket(socket_type)
         self.socket.linger = 0
         self.poller = zmq.Poller()
         self.poller.register(self.socket, zmq.POLLIN)
@@ -270,20 +869,24 @@ class MajorDomoBroker(object):
     def mediate(self):
         """Main broker work happens here"""
         while True:
+            poll_timeout = self.HEARTBEAT_INTERVAL
+            if self.batch_wait:
+                poll_timeout = min(poll_timeout, 1e3 * self.batch_wait)
             try:
-                items = self.poller.poll(self.HEARTBEAT_INTERVAL)
+                items = self.poller.poll(poll_timeout)
             except KeyboardInterrupt:
                 break  # Interrupted
             if items:
-                msg = self.socket.recv_multipart()
+                msg = self.socket.recv_multipart(copy=not self.zero_copy)
                 if self.verbose:
                     logger.info("I: received message:")
                     logger.info(dump(msg))
 
-                sender = msg.pop(0)
-                empty = msg.pop(0)
+                # only envelope and header frames are read. Payload frames are forwarded as received
+                sender = _frame_bytes(msg.pop(0))
+                empty = _frame_bytes(msg.pop(0))
                 assert empty == ''
-                header = msg.pop(0)
+                header = _frame_bytes(msg.pop(0))
 
                 if (MDP.C_CLIENT == header):
                     self.process_client(sender, msg)
@@ -295,6 +898,10 @@ class MajorDomoBroker(object):
 
             self.purge_workers()
             self.send_heartbeats()
+            if self.batch_wait:
+                # send out batches whose wait window has passed
+                for service in self.services.values():
+                    self.dispatch(service, None)
 
     def destroy(self):
         """Disconnect all workers, destroy context."""
@@ -305,7 +912,7 @@ class MajorDomoBroker(object):
     def process_client(self, sender, msg):
         """Process a request coming from a client."""
         assert len(msg) >= 2  # Service name + body
-        service = msg.pop(0)
+        service = _frame_bytes(msg.pop(0))
         # Set reply return address to client sender
         msg = [sender, ''] + msg
         if service.startswith(self.INTERNAL_SERVICE_PREFIX):
@@ -317,7 +924,7 @@ class MajorDomoBroker(object):
         """Process message sent to us by a worker."""
         assert len(msg) >= 1  # At least, command
 
-        command = msg.pop(0)
+        command = _frame_bytes(msg.pop(0))
 
         worker_ready = hexlify(sender) in self.workers
 
@@ -325,21 +932,29 @@ class MajorDomoBroker(object):
 
         if (MDP.W_READY == command):
             assert len(msg) >= 1  # At least, a service name
+            msg = [_frame_bytes(frame) for frame in msg]
             service = msg.pop(0)
             dormant = ('true' == msg.pop(0).lower())
+            # optional for workers that do not batch or pipeline
+            worker.batch_size = int(msg.pop(0)) if msg else 1
+            worker.pipeline_depth = int(msg.pop(0)) if msg else 1
             # Not first command in session or Reserved service name
             if (worker_ready or service.startswith(self.INTERNAL_SERVICE_PREFIX)):
                 self.delete_worker(worker, True)
             else:
                 # Attach worker to service and mark as idle
                 worker.service = self.require_service(service)
-                self.worker_waiting(worker, add_to_active_if_new=(not dormant))
+                worker.service.batch_size = max(
+                    worker.service.batch_size, worker.batch_size)
+                # one waiting entry for each request the worker can take
+                for _ in range(worker.pipeline_depth):
+                    self.worker_waiting(worker, add_to_active_if_new=(not dormant))
 
         elif (MDP.W_REPLY == command):
             if (worker_ready):
                 # Remove & save client return envelope and insert the
                 # protocol header and service name, then rewrap envelope.
-                client = msg.pop(0)
+                client = _frame_bytes(msg.pop(0))
                 empty = msg.pop(0)  # ?
                 msg = [client, '', MDP.C_CLIENT, worker.service.name] + msg
                 worker.service.post_worker_processing(msg, worker)
@@ -352,6 +967,21 @@ class MajorDomoBroker(object):
             else:
                 self.delete_worker(worker, True)
 
+        elif (MDP.W_BATCH_REPLY == command):
+            if (worker_ready):
+                # [client, '', reply] for each request of the batch
+                replies = [[_frame_bytes(client), '', MDP.C_CLIENT, worker.service.name, reply]
+                           for (client, reply) in zip(msg[0::3], msg[2::3])]
+                worker.service.post_worker_processing(replies, worker)
+                for reply in replies:
+                    self.socket.send_multipart(reply)
+                if self.verbose:
+                    logger.info(
+                        "I: sending {} replies to clients from worker {}".format(len(replies), sender))
+                self.worker_waiting(worker)
+            else:
+                self.delete_worker(worker, True)
+
         elif (MDP.W_HEARTBEAT == command):
             if (worker_ready):
                 worker.expiry = time.time() + 1e-3*self.HEARTBEAT_EXPIRY
@@ -372,6 +1002,8 @@ class MajorDomoBroker(object):
 
         if worker.service is not None:
             worker.service.remove_worker(worker)
+        self.waiting.pop(worker, None)
+        # its entry in expiries is dropped when it comes up
         self.workers.pop(worker.identity)
 
     def require_worker(self, address):
@@ -382,6 +1014,7 @@ class MajorDomoBroker(object):
         if (worker is None):
             worker = Worker(identity, address, self.HEARTBEAT_EXPIRY)
             self.workers[identity] = worker
+            heapq.heappush(self.expiries, (worker.expiry, next(self._expiry_seq), worker))
             if self.verbose:
                 logger.info("I: registering new worker: %s", identity)
 
@@ -393,9 +1026,10 @@ class MajorDomoBroker(object):
         service = self.services.get(name)
         if (service is None):
             if self.service_queue_type is list:
-                requests_queue = []
+                # same order as a list, without O(n) pops from the front
+                requests_queue = brokerqueue.FifoTokenQueue()
             else:
-                requests_queue = self.service_queue_type(self)
+                requests_queue = self.service_queue_type(self, service_name=name)
             service_expected_stats = self.service_expected_stats_config[
                 name] if name in self.service_expected_stats_config else None
             service = self.service_type(
@@ -412,18 +1046,54 @@ class MajorDomoBroker(object):
         self.socket.bind(endpoint)
         logger.info("I: MDP broker/0.1.1 is active at %s", endpoint)
 
+    def connect(self, endpoint):
+        """Connect broker to endpoint, e.g. to take traffic from a ShardedBroker front."""
+        self.socket.connect(endpoint)
+
     def service_internal(self, service, msg):
-        """Handle internal service according to 8/MMI specification"""
+        """Handle internal service according to 8/MMI specification
+
+        mmi.stats replies with the return code followed by the JSON encoded get_stats() of the
+        service named in the request, or of all services if the request is empty.
+        """
         returncode = "501"
+        reply = []
         if "mmi.service" == service:
-            name = msg[-1]
+            name = _frame_bytes(msg[-1])
             returncode = "200" if name in self.services else "404"
+        elif "mmi.stats" == service:
+            name = _frame_bytes(msg[-1])
+            if name and name not in self.services:
+                returncode = "404"
+            else:
+                returncode = "200"
+                reply = [json.dumps(self.get_stats(name or None), separators=(',', ':'))]
         msg[-1] = returncode
 
         # insert the protocol header and service name after the routing envelope ([client, ''])
-        msg = msg[:2] + [MDP.C_CLIENT, service] + msg[2:]
+        msg = msg[:2] + [MDP.C_CLIENT, service] + msg[2:] + reply
         self.socket.send_multipart(msg)
 
+    def get_stats(self, name=None):
+        """Live metrics of the broker and its services, or only of the named service."""
+        names = [name] if name is not None else self.services.keys()
+        services = {}
+        for name in names:
+            service = self.services[name]
+            stats = service.get_stats()
+            stats['workers'] = sum(1 for w in self.workers.itervalues() if w.service is service)
+            # services without a dormant pool have all their workers active
+            stats.setdefault('active_workers', stats['workers'])
+            stats.setdefault('dormant_workers', 0)
+            services[name] = stats
+        return {
+            'ts': time.time(),
+            'uptime': time.time() - self.started_at,
+            'workers': len(self.workers),
+            'waiting_workers': len(self.waiting),
+            'services': services,
+        }
+
     def send_heartbeats(self):
         """Send heartbeats to idle workers if it's time"""
         if (time.time() > self.heartbeat_at):
@@ -435,21 +1105,31 @@ class MajorDomoBroker(object):
     def purge_workers(self):
         """Look for & kill expired workers.
 
-        Workers are oldest to most recent, so we stop at the first alive worker.
+        Only waiting workers expire, busy workers do not heartbeat.
+        Expiries are refreshed without touching the heap. Instead, a worker's entry
+        is pushed back when it comes up, so we stop at the first entry that is not due.
         """
-        while self.waiting:
-            w = self.waiting[0]
-            if w.expiry < time.time():
+        now = time.time()
+        while self.expiries and self.expiries[0][0] < now:
+            w = heapq.heappop(self.expiries)[-1]
+            if self.workers.get(w.identity) is not w:
+                # deleted already
+                continue
+            if w.expiry >= now:
+                check_at = w.expiry
+            elif w not in self.waiting:
+                # expires no earlier than a heartbeat expiry after it starts waiting again
+                check_at = now + 1e-3*self.HEARTBEAT_EXPIRY
+            else:
                 logger.info("I: deleting expired worker: %s", w.identity)
                 self.delete_worker(w, False)
-                self.waiting.pop(0)
-            else:
-                break
+                continue
+            heapq.heappush(self.expiries, (check_at, next(self._expiry_seq), w))
 
     def worker_waiting(self, worker, add_to_active_if_new=False):
         """This worker is now waiting for work."""
         # Queue to broker and service waiting lists
-        self.waiting.append(worker)
+        self.waiting[worker] = self.waiting.get(worker, 0) + 1
         worker.service.add_waiting_worker(
             worker, add_to_active_if_new=add_to_active_if_new)
         worker.expiry = time.time() + 1e-3*self.HEARTBEAT_EXPIRY
@@ -461,10 +1141,26 @@ class MajorDomoBroker(object):
         if msg is not None:  # Queue message if any
             service.add_request(msg)
         self.purge_workers()
-        while service.is_ready_to_send():
+        service.drop_expired_requests()
+        while service.is_ready_to_send() and not self.wait_for_batch(service):
             msg, worker = service.get_ready_to_send()
-            self.waiting.remove(worker)
-            self.send_to_worker(worker, MDP.W_REQUEST, None, msg)
+            free_slots = self.waiting.pop(worker) - 1
+            if free_slots:
+                self.waiting[worker] = free_slots
+            if worker.batch_size > 1:
+                msgs = [msg] + service.get_more_requests(worker.batch_size - 1)
+                service.dispatch_meter.add(len(msgs))
+                self.send_to_worker(worker, MDP.W_BATCH_REQUEST, None,
+                                    [frame for msg in msgs for frame in msg])
+            else:
+                service.dispatch_meter.add()
+                self.send_to_worker(worker, MDP.W_REQUEST, None, msg)
+
+    def wait_for_batch(self, service):
+        """Whether to hold requests a bit longer so that a batching worker gets a fuller batch."""
+        return (self.batch_wait > 0 and service.batch_size > 1
+                and len(service._requests) < service.batch_size
+                and time.time() - service.requests_since < self.batch_wait)
 
     def send_to_worker(self, worker, command, option, msg=None):
         """Send message to worker.
@@ -526,20 +1222,30 @@ def load_stats(fpath):
             logger.error('Error loading service exptected stats')
     return service_expected_stats_config
 
-def main(broker_uri="tcp://*:5555", verbose=False, service_type='normal', service_queue_type='list', 
-    service_expected_stats_config_fpath=None):
-    """create and start new broker"""
+def load_latency_profile(fpath):
+    """latency_ms(cpu, memory) function pickled by rmexp.profile"""
+    import cPickle as pickle
+    with open(fpath, 'rb') as f:
+        return pickle.load(f)
+
+def broker_kwargs(verbose=False, service_type='normal', service_queue_type='list',
+    service_expected_stats_config_fpath=None, batch_wait_ms=0, zero_copy=True):
+    """MajorDomoBroker arguments from command line options"""
     service_expected_stats_config = load_stats(service_expected_stats_config_fpath)
     service_type_maps = {
         'normal': Service,
-        'adaptive': AdaptiveWorkerPoolService
+        'adaptive': AdaptiveWorkerPoolService,
+        'predictive': PredictiveWorkerPoolService,
+        'sticky': StickyService,
     }
     assert service_type in service_type_maps.keys(), 'service_type must be a value of {}'.format(
         service_type_maps.keys()
     )
     service_queue_maps = {
         'latency-optimized': brokerqueue.LatencyOptimizedTokenQueue,
-        'list': list
+        'per-client': brokerqueue.PerClientFreshnessTokenQueue,
+        'edf': brokerqueue.DeadlineTokenQueue,
+        'list': brokerqueue.FifoTokenQueue,
     }
     service_queue_type = service_queue_type.lower()
     assert service_queue_type in service_queue_maps.keys(), 'service_queue_type must be a value of {}'.format(
@@ -547,12 +1253,26 @@ def main(broker_uri="tcp://*:5555", verbose=False, service_type='normal', servic
     )
     logger.info("Using queye type: {}".format(service_queue_type))
 
-    broker = MajorDomoBroker(
+    return dict(
         service_type=service_type_maps[service_type], 
         service_expected_stats_config=service_expected_stats_config,
         service_queue_type=service_queue_maps[service_queue_type],
         verbose=verbose, 
+        batch_wait_ms=batch_wait_ms,
+        zero_copy=zero_copy,
         )
+
+def main(broker_uri="tcp://*:5555", verbose=False, service_type='normal', service_queue_type='list', 
+    service_expected_stats_config_fpath=None, batch_wait_ms=0, zero_copy=True):
+    """create and start new broker"""
+    broker = MajorDomoBroker(**broker_kwargs(
+        verbose=verbose,
+        service_type=service_type,
+        service_queue_type=service_queue_type,
+        service_expected_stats_config_fpath=service_expected_stats_config_fpath,
+        batch_wait_ms=batch_wait_ms,
+        zero_copy=zero_copy,
+        ))
     broker.bind(broker_uri)
     broker.mediate()
 
@@ -25,10 +25,11 @@ class MajorDomoClient(object):
     poller = None
     verbose = False
 
-    def __init__(self, broker, verbose=False):
+    def __init__(self, broker, verbose=False, ctx=None):
+        """ctx: zmq context to create the socket in, e.g. one shared by many clients of a process"""
         self.broker = broker
         self.verbose = verbose
-        self.ctx = zmq.Context()
+        self.ctx = ctx or zmq.Context()
         self.poller = zmq.Poller()
         logging.basicConfig(format="%(asctime)s %(message)s", datefmt="%Y-%m-%d %H:%M:%S",
                             level=logging.INFO)
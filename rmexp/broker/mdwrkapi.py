@@ -42,12 +42,18 @@ class MajorDomoWorker(object):
     # Return address, if any
     reply_to = None
 
-    def __init__(self, broker, service, dormant=False, verbose=False):
+    def __init__(self, broker, service, dormant=False, verbose=False, batch_size=1, pipeline_depth=1,
+                 ctx=None):
+        """ctx: zmq context to create the socket in, e.g. one shared with an inproc broker"""
         self.broker = broker
         self.service = service
         self.verbose = verbose
         self.dormant = dormant
-        self.ctx = zmq.Context()
+        # max number of requests the broker may send in one W_BATCH_REQUEST
+        self.batch_size = batch_size
+        # max number of requests the broker may have outstanding at this worker
+        self.pipeline_depth = pipeline_depth
+        self.ctx = ctx or zmq.Context()
         self.poller = zmq.Poller()
         logging.basicConfig(format="%(asctime)s %(message)s", datefmt="%Y-%m-%d %H:%M:%S",
                             level=logging.INFO)
@@ -66,10 +72,12 @@ class MajorDomoWorker(object):
             logging.info("I: connecting to broker at %s...", self.broker)
 
         # Register service with broker
-        self.send_to_broker(MDP.W_READY, self.service, [bytes(self.dormant)])
+        self.send_to_broker(MDP.W_READY, self.service, [
+                            bytes(self.dormant), bytes(self.batch_size), bytes(self.pipeline_depth)])
 
         # If liveness hits zero, queue is considered disconnected
         self.liveness = self.HEARTBEAT_LIVENESS
+        self.heard_at = time.time()
         self.heartbeat_at = time.time() + 1e-3 * self.heartbeat
 
     def send_to_broker(self, command, option=None, msg=None):
@@ -103,6 +111,50 @@ class MajorDomoWorker(object):
 
         self.expect_reply = True
 
+        msg = self._wait_for_request()
+        if msg is None:
+            return None
+        # We should pop and save as many addresses as there are
+        # up to a null part, but for now, just save one...
+        self.reply_to = msg.pop(0)
+        # pop empty
+        empty = msg.pop(0)
+        assert empty == ''
+        return msg  # We have a request to process
+
+    def recv_batch(self, replies=None):
+        """Send replies, if any, to broker and wait for next batch of requests.
+
+        Each request and reply is a single frame. Frames of a batch are sent as
+        [client, '', frame] triplets.
+        replies must be in the order of the last batch of requests.
+        Returns a list of requests.
+        """
+        assert replies is not None or not self.expect_reply
+
+        if replies is not None:
+            assert len(replies) == len(self.reply_to)
+            msg = []
+            for (client, reply) in zip(self.reply_to, replies):
+                # None: no reply wanted for this request
+                if reply is not None:
+                    msg.extend([client, '', reply])
+            self.send_to_broker(MDP.W_BATCH_REPLY, msg=msg)
+
+        self.expect_reply = True
+
+        msg = self._wait_for_request()
+        if msg is None:
+            return None
+        assert len(msg) % 3 == 0
+        self.reply_to = msg[0::3]
+        return msg[2::3]
+
+    def _wait_for_request(self):
+        """Wait for the next W_REQUEST or W_BATCH_REQUEST.
+
+        Returns the message following the command, or None if interrupted.
+        """
         while True:
             # Poll socket for a reply, with timeout
             try:
@@ -111,39 +163,9 @@ class MajorDomoWorker(object):
                 break  # Interrupted
 
             if items:
-                msg = self.worker.recv_multipart()
-                if self.verbose:
-                    logging.info("I: received message from broker: ")
-                    dump(msg)
-
-                self.liveness = self.HEARTBEAT_LIVENESS
-                # Don't try to handle errors, just assert noisily
-                assert len(msg) >= 3
-
-                empty = msg.pop(0)
-                assert empty == ''
-
-                header = msg.pop(0)
-                assert header == MDP.W_WORKER
-
-                command = msg.pop(0)
-                if command == MDP.W_REQUEST:
-                    # We should pop and save as many addresses as there are
-                    # up to a null part, but for now, just save one...
-                    self.reply_to = msg.pop(0)
-                    # pop empty
-                    empty = msg.pop(0)
-                    assert empty == ''
-
-                    return msg  # We have a request to process
-                elif command == MDP.W_HEARTBEAT:
-                    # Do nothing for heartbeats
-                    pass
-                elif command == MDP.W_DISCONNECT:
-                    self.reconnect_to_broker()
-                else:
-                    logging.error("E: invalid input message: ")
-                    dump(msg)
+                msg = self._handle_message(self.worker.recv_multipart())
+                if msg is not None:
+                    return msg
 
             else:
                 self.liveness -= 1
@@ -165,6 +187,76 @@ class MajorDomoWorker(object):
         logging.warn("W: interrupt received, killing worker...")
         return None
 
+    def _handle_message(self, msg):
+        """Handle a message from the broker.
+
+        Returns the message following the command for requests, otherwise None.
+        """
+        if self.verbose:
+            logging.info("I: received message from broker: ")
+            dump(msg)
+
+        self.liveness = self.HEARTBEAT_LIVENESS
+        self.heard_at = time.time()
+        # Don't try to handle errors, just assert noisily
+        assert len(msg) >= 3
+
+        empty = msg.pop(0)
+        assert empty == ''
+
+        header = msg.pop(0)
+        assert header == MDP.W_WORKER
+
+        command = msg.pop(0)
+        if command in (MDP.W_REQUEST, MDP.W_BATCH_REQUEST):
+            return msg
+        elif command == MDP.W_HEARTBEAT:
+            # Do nothing for heartbeats
+            pass
+        elif command == MDP.W_DISCONNECT:
+            self.reconnect_to_broker()
+        else:
+            logging.error("E: invalid input message: ")
+            dump(msg)
+        return None
+
+    def add_wakeup_fd(self, fd):
+        """Make poll_request also return when fd becomes readable."""
+        self.poller.register(fd, zmq.POLLIN)
+
+    def poll_request(self, timeout=None):
+        """Wait up to timeout ms for a request, without sending a reply first.
+
+        Used by workers that keep up to pipeline_depth requests in flight
+        and answer them with send_reply.
+        Returns (reply_to, request), or None on timeout, heartbeats or wake ups.
+        """
+        items = dict(self.poller.poll(self.timeout if timeout is None else timeout))
+        request = None
+        if self.worker in items:
+            request = self._handle_message(self.worker.recv_multipart())
+        elif time.time() - self.heard_at > 1e-3 * self.timeout * self.HEARTBEAT_LIVENESS:
+            if self.verbose:
+                logging.warn("W: disconnected from broker - retrying...")
+            time.sleep(1e-3*self.reconnect)
+            self.reconnect_to_broker()
+
+        # Send HEARTBEAT if it's time
+        if time.time() > self.heartbeat_at:
+            self.send_to_broker(MDP.W_HEARTBEAT)
+            self.heartbeat_at = time.time() + 1e-3*self.heartbeat
+
+        if request is None:
+            return None
+        reply_to = request.pop(0)
+        empty = request.pop(0)
+        assert empty == ''
+        return reply_to, request
+
+    def send_reply(self, reply_to, reply):
+        """Send the reply to a request returned by poll_request."""
+        self.send_to_broker(MDP.W_REPLY, msg=[reply_to, ''] + reply)
+
     def destroy(self):
         # context.destroy depends on pyzmq >= 2.1.10
         self.ctx.destroy(0)
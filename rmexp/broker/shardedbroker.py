@@ -0,0 +1,251 @@
+"""
+Sharded Majordomo Protocol broker
+
+A front ROUTER socket speaks MDP to clients and workers exactly like MajorDomoBroker,
+so MajorDomoClient and MajorDomoWorker connect to it as before. Each service gets its
+own MajorDomoBroker shard, with its own request queue, workers and Scaler, running
+in a thread or a process. The front reads only envelope and header frames to pick
+a shard and passes messages on as received. Shards send their outgoing messages back
+to the front, which routes them to clients and workers.
+"""
+
+import itertools
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import fire
+import zmq
+from logzero import logger
+
+# local
+import MDP
+from mdbroker import MajorDomoBroker, broker_kwargs
+
+
+class ShardBroker(MajorDomoBroker):
+    """MajorDomoBroker serving one service behind a ShardedBroker front."""
+
+    def delete_worker(self, worker, disconnect):
+        # the front forgets a worker once it sees it disconnected,
+        # so also tell workers that were purged silently
+        super(ShardBroker, self).delete_worker(worker, True)
+
+
+def run_shard(endpoint, kwargs, ctx=None):
+    """Serve the front's traffic for one service on endpoint."""
+    broker = ShardBroker(ctx=ctx, socket_type=zmq.PAIR, **kwargs)
+    broker.connect(endpoint)
+    broker.mediate()
+
+
+class ShardedBroker(object):
+    """Front of a broker with one dispatch loop per service.
+
+    In thread mode, shards talk to the front over inproc sockets and frames are passed
+    without copying, but shards share the GIL. In process mode they talk over ipc sockets
+    and dispatch runs in parallel on multiple cores.
+    """
+
+    INTERNAL_SERVICE_PREFIX = MajorDomoBroker.INTERNAL_SERVICE_PREFIX
+    HEARTBEAT_INTERVAL = MajorDomoBroker.HEARTBEAT_INTERVAL  # msecs
+
+    # mmi.stats requests the front sends to all shards come from identities starting with this.
+    # Identities zmq generates are five bytes starting with a zero byte.
+    GATHER_PREFIX = b'\x00gather-'
+
+    def __init__(self, kwargs, shard_mode='thread', ctx=None):
+        """kwargs: MajorDomoBroker arguments for every shard
+        ctx: zmq context of the front socket and thread shards, e.g. one shared with inproc clients
+        """
+        assert shard_mode in ('thread', 'process'), 'shard_mode must be thread or process'
+        self.kwargs = kwargs
+        self.shard_mode = shard_mode
+        self.started_at = time.time()
+        self.ctx = ctx or zmq.Context()
+        self.socket = self.ctx.socket(zmq.ROUTER)
+        self.socket.linger = 0
+        self.poller = zmq.Poller()
+        self.poller.register(self.socket, zmq.POLLIN)
+        self.shards = {}  # service name --> socket to its shard
+        self.shard_runners = []  # threads or processes running the shards
+        self.worker_shards = {}  # worker address --> socket to the shard of its service
+        self.gathers = {}  # gather identity --> [client address, shards yet to reply, their stats]
+        self._gather_seq = itertools.count()
+        self._ipc_dir = tempfile.mkdtemp(prefix='mdbroker-') if shard_mode == 'process' else None
+
+    def bind(self, endpoint):
+        self.socket.bind(endpoint)
+        logger.info("I: sharded MDP broker/0.1.1 is active at %s", endpoint)
+
+    def require_shard(self, service):
+        """Finds the shard of the service (starts it if necessary)."""
+        shard = self.shards.get(service)
+        if shard is not None:
+            return shard
+        idx = len(self.shards)
+        if self.shard_mode == 'thread':
+            endpoint = 'inproc://mdbroker-shard-{}'.format(idx)
+            runner = threading.Thread(target=run_shard, args=(endpoint, self.kwargs, self.ctx))
+        else:
+            endpoint = 'ipc://{}'.format(os.path.join(self._ipc_dir, 'shard-{}'.format(idx)))
+            runner = multiprocessing.Process(target=run_shard, args=(endpoint, self.kwargs))
+        shard = self.ctx.socket(zmq.PAIR)
+        shard.linger = 0
+        shard.bind(endpoint)
+        runner.daemon = True
+        runner.start()
+        self.shard_runners.append(runner)
+        self.poller.register(shard, zmq.POLLIN)
+        self.shards[service] = shard
+        logger.info("I: started %s shard for service %s at %s", self.shard_mode, service, endpoint)
+        return shard
+
+    def mediate(self):
+        """Route messages between the front socket and the shards"""
+        while True:
+            try:
+                items = dict(self.poller.poll(self.HEARTBEAT_INTERVAL))
+            except KeyboardInterrupt:
+                break  # Interrupted
+            if items.pop(self.socket, None):
+                self.process_incoming(self.socket.recv_multipart(copy=False))
+            for shard in items:
+                self.process_outgoing(shard.recv_multipart(copy=False))
+
+    def destroy(self):
+        for runner in self.shard_runners:
+            if isinstance(runner, multiprocessing.Process):
+                runner.terminate()
+        self.ctx.destroy(0)
+        if self._ipc_dir is not None:
+            shutil.rmtree(self._ipc_dir, ignore_errors=True)
+
+    def process_incoming(self, msg):
+        """Pass a message from a client or worker to the shard of its service."""
+        assert len(msg) >= 4  # envelope, header, service name or command
+        sender = msg[0].bytes
+        header = msg[2].bytes
+        if MDP.C_CLIENT == header:
+            service = msg[3].bytes
+            if service.startswith(self.INTERNAL_SERVICE_PREFIX):
+                self.service_internal(sender, service, msg)
+                return
+            shard = self.require_shard(service)
+        elif MDP.W_WORKER == header:
+            command = msg[3].bytes
+            shard = self.worker_shards.get(sender)
+            if MDP.W_READY == command and shard is None:
+                service = msg[4].bytes
+                if service.startswith(self.INTERNAL_SERVICE_PREFIX):
+                    self.disconnect_worker(sender)
+                    return
+                shard = self.require_shard(service)
+                self.worker_shards[sender] = shard
+            elif shard is None:
+                # the worker is not known to any shard
+                self.disconnect_worker(sender)
+                return
+            elif MDP.W_DISCONNECT == command:
+                del self.worker_shards[sender]
+        else:
+            logger.error("E: invalid message from %r", sender)
+            return
+        shard.send_multipart(msg, copy=False)
+
+    def process_outgoing(self, msg):
+        """Route a message from a shard to a client or worker."""
+        address = msg[0].bytes
+        if address.startswith(self.GATHER_PREFIX):
+            self.gather_stats(address, msg)
+            return
+        if (len(msg) == 4 and MDP.W_WORKER == msg[2].bytes
+                and MDP.W_DISCONNECT == msg[3].bytes):
+            self.worker_shards.pop(address, None)
+        self.socket.send_multipart(msg, copy=False)
+
+    def disconnect_worker(self, address):
+        self.socket.send_multipart([address, '', MDP.W_WORKER, MDP.W_DISCONNECT])
+
+    def service_internal(self, sender, service, msg):
+        """Handle internal service according to 8/MMI specification
+
+        mmi.stats of a service is answered by its shard. mmi.stats of all services
+        is gathered from all shards.
+        """
+        name = msg[-1].bytes
+        returncode = "501"
+        reply = []
+        if "mmi.service" == service:
+            returncode = "200" if name in self.shards else "404"
+        elif "mmi.stats" == service:
+            if name in self.shards:
+                self.shards[name].send_multipart(msg, copy=False)
+                return
+            elif name:
+                returncode = "404"
+            elif self.shards:
+                gather = self.GATHER_PREFIX + str(next(self._gather_seq))
+                self.gathers[gather] = [sender, len(self.shards), []]
+                for shard in self.shards.values():
+                    shard.send_multipart([gather, '', MDP.C_CLIENT, service, ''])
+                return
+            else:
+                returncode = "200"
+                reply = [json.dumps(self.merge_stats([]), separators=(',', ':'))]
+        self.socket.send_multipart([sender, '', MDP.C_CLIENT, service, returncode] + reply)
+
+    def gather_stats(self, gather, msg):
+        """Collect a shard's reply to an mmi.stats request of all services."""
+        if gather not in self.gathers:
+            return
+        client, pending, stats = self.gathers[gather]
+        if msg[4].bytes == "200":
+            stats.append(json.loads(msg[5].bytes))
+        if pending > 1:
+            self.gathers[gather][1] = pending - 1
+            return
+        del self.gathers[gather]
+        self.socket.send_multipart([client, '', MDP.C_CLIENT, "mmi.stats", "200",
+                                    json.dumps(self.merge_stats(stats), separators=(',', ':'))])
+
+    def merge_stats(self, shard_stats):
+        """Broker stats of the whole sharded broker, from MajorDomoBroker.get_stats() of each shard."""
+        services = {}
+        for stats in shard_stats:
+            services.update(stats['services'])
+        return {
+            'ts': time.time(),
+            'uptime': time.time() - self.started_at,
+            'shards': len(self.shards),
+            'workers': sum(stats['workers'] for stats in shard_stats),
+            'waiting_workers': sum(stats['waiting_workers'] for stats in shard_stats),
+            'services': services,
+        }
+
+
+def main(broker_uri="tcp://*:5555", shard_mode='thread', verbose=False, service_type='normal',
+         service_queue_type='list', service_expected_stats_config_fpath=None, batch_wait_ms=0,
+         zero_copy=True):
+    """create and start new sharded broker, with one thread or process per service"""
+    broker = ShardedBroker(broker_kwargs(
+        verbose=verbose,
+        service_type=service_type,
+        service_queue_type=service_queue_type,
+        service_expected_stats_config_fpath=service_expected_stats_config_fpath,
+        batch_wait_ms=batch_wait_ms,
+        zero_copy=zero_copy,
+    ), shard_mode=shard_mode)
+    broker.bind(broker_uri)
+    try:
+        broker.mediate()
+    finally:
+        broker.destroy()
+
+
+if __name__ == '__main__':
+    fire.Fire(main)
@@ -30,6 +30,8 @@ def dump(msg_or_socket):
         msg = msg_or_socket
     print("----------------------------------------", file=log)
     for part in msg:
+        if isinstance(part, zmq.Frame):
+            part = part.bytes
         print("[%03d]" % len(part), end=' ', file=log)
         is_text = True
         try:
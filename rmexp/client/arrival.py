@@ -0,0 +1,69 @@
+"""Open-loop arrival processes for emulated clients.
+
+An arrival process is an iterator of gaps, in secs, between the times a client sends frames.
+Unlike token-based clients, whose offered load drops as soon as replies slow down,
+open-loop clients keep sending at these times no matter how long replies take.
+"""
+from __future__ import absolute_import, division, print_function
+
+import itertools
+import random
+
+import numpy as np
+
+
+def poisson(rate, rng=random):
+    """Poisson arrivals of rate per sec"""
+    assert rate > 0, 'rate must be positive'
+    while True:
+        yield rng.expovariate(rate)
+
+
+def constant(rate):
+    """Arrivals exactly 1 / rate secs apart"""
+    assert rate > 0, 'rate must be positive'
+    return itertools.repeat(1. / rate)
+
+
+def replay(timestamps, loop=True, speedup=1.):
+    """Arrivals at recorded timestamps (secs), relative to the first of them.
+
+    If loop is True, the recording starts over after its last arrival, one mean gap later.
+    """
+    timestamps = np.sort(np.asarray(timestamps, dtype=np.float64))
+    assert len(timestamps) > 1, 'need at least two timestamps to replay'
+    gaps = np.diff(timestamps) / speedup
+    first_gap = 0.
+    while True:
+        yield first_gap
+        for gap in gaps:
+            yield float(gap)
+        if not loop:
+            return
+        first_gap = float(gaps.mean())
+
+
+def load_timestamps(fpath):
+    """Timestamps to replay, one per line. Lines starting with # are ignored."""
+    return np.loadtxt(fpath, dtype=np.float64, comments='#', ndmin=1)
+
+
+def make_arrivals(spec, rng=random):
+    """Create the arrival process described by spec, a dict from the harness run_config.
+
+    {'type': 'poisson', 'rate': 15}
+    {'type': 'constant', 'rate': 15}
+    {'type': 'replay', 'timestamps': [...] or 'path': file of timestamps,
+     'loop': True, 'speedup': 1.}
+    """
+    arrival_type = spec['type']
+    if arrival_type == 'poisson':
+        return poisson(float(spec['rate']), rng=rng)
+    elif arrival_type == 'constant':
+        return constant(float(spec['rate']))
+    elif arrival_type == 'replay':
+        timestamps = spec.get('timestamps')
+        if timestamps is None:
+            timestamps = load_timestamps(spec['path'])
+        return replay(timestamps, loop=spec.get('loop', True), speedup=float(spec.get('speedup', 1.)))
+    raise ValueError('Not Supported arrival type {}'.format(arrival_type))
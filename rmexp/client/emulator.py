@@ -7,13 +7,13 @@ import collections
 
 import cv2
 import numpy as np
-import pandas as pd
 from logzero import logger
 
 import lego
 import ikea
-from rmexp import client, schema, utils
+from rmexp import client, utils
 from rmexp.client import dutycycle
+from rmexp.dataset import imucache
 
 
 class Sensor(object):
@@ -39,6 +39,15 @@ class VideoSensor(client.RTImageSequenceClient):
     def get(self, idx):
         raise NotImplementedError("VideoSensor does not allow ad-hoc query.")
 
+    def next_sample_delay(self):
+        """Seconds sample would sleep before taking a sample."""
+        return self.next_frame_delay()
+
+    def skip_frames(self, num):
+        """Make the next sample wait for a frame at least num frames after the last one."""
+        if num > 1:
+            self._fid += num - 1
+
 
 app_fsm = {
     'lego': lego.fsm.LegoFSM,
@@ -79,6 +88,12 @@ class VideoAdaptiveSensor(VideoSensor):
         logger.debug('sample period: {}'.format(fr))
         return 1. / fr
 
+    def next_sample_delay(self):
+        sleep_time = self.get_sample_period() - (time.time() - self._last_sample_time)
+        if sleep_time > 1. / self._fps:
+            return sleep_time
+        return self.next_frame_delay()
+
     def sample(self):
         sleep_time = self.get_sample_period() - (time.time() - self._last_sample_time)
         if sleep_time > 1. / self._fps:  # if smaller, get_frame will wait to get next available frame
@@ -103,18 +118,12 @@ class VideoAdaptiveSensor(VideoSensor):
 
 
 class IMUSensor(Sensor):
-    def __init__(self, trace):
+    def __init__(self, trace, cache_dir=None):
+        """cache_dir: IMU cache directory, defaults to IMU_CACHE_DIR (see rmexp.dataset.imucache)"""
         super(IMUSensor, self).__init__()
         self.trace = trace
-        df = pd.read_sql('SELECT * FROM IMU WHERE name = %s',
-                         schema.engine, params=[self.trace, ])
-        df['index'] = df['index'].astype(int)
-        self.df = df.sort_values('index')
-        df = pd.read_sql('SELECT * FROM IMUSuppression WHERE name = %s',
-                         schema.engine, params=[self.trace, ])
-        df['index'] = df['index'].astype(int)
-        self.df_suppression = df
-        self.cur_idx = self.df['index'].iloc[0]
+        self.cache = imucache.load(trace, cache_dir=cache_dir)
+        self.cur_idx = self.cache.first_index
         logger.debug('created IMU sensor {}. Current idx: {}'.format(
             self.trace, self.cur_idx))
 
@@ -123,13 +132,8 @@ class IMUSensor(Sensor):
         return (self.cur_idx, self.get(self.cur_idx))
 
     def get(self, idx):
-        if idx < len(self.df.index):
-            return self.df.iloc[idx][['rot_x',
-                                      'rot_y',
-                                      'rot_z',
-                                      'acc_x',
-                                      'acc_y',
-                                      'acc_z']].values
+        if idx < len(self.cache.imu):
+            return self.cache.imu[idx]
         else:
             logger.warning(
                 """imu look up idx ({}) invalid. 
@@ -137,14 +141,18 @@ class IMUSensor(Sensor):
             return np.array([0.] * 6)
 
     def is_passive(self, idx):
-        if idx < len(self.df_suppression.index):
-            return str(self.df_suppression['suppression'].iloc[idx]) == '1'
+        if idx < len(self.cache.suppression):
+            return bool(self.cache.suppression[idx])
         else:
             logger.warning(
                 """imu is_passive look up idx ({}) invalid. 
                 A single of this warning might due to h264 encoding requires even number of frames""".format(idx))
             return False
 
+    def next_unsuppressed(self, idx):
+        """The first frame at or after idx that is not passive"""
+        return self.cache.next_unsuppressed(idx)
+
 
 class MobileDevice(object):
     def __init__(self, sensors):
@@ -173,6 +181,10 @@ class CameraTimedMobileDevice(MobileDevice):
         data.insert(0, (idx, pdata))
         return data
 
+    def next_sample_delay(self):
+        """Seconds sample would sleep before taking a sample."""
+        return self.primary_sensor.next_sample_delay()
+
 
 class IMUSuppresedCameraTimedMobileDevice(CameraTimedMobileDevice):
     """For each sample, it gets fid from Video sensor and 
@@ -183,11 +195,19 @@ class IMUSuppresedCameraTimedMobileDevice(CameraTimedMobileDevice):
         super(IMUSuppresedCameraTimedMobileDevice, self).__init__(sensors)
         self.imu = self.sensors[1]
 
-    def sample(self):
+    def sample(self, block=True):
+        """If block is False, returns None instead of sampling again when a sample is suppressed.
+
+        After a suppressed sample, the next sample waits for the next frame that is not suppressed
+        instead of sampling each suppressed frame in between.
+        """
         (idx, pdata) = self.primary_sensor.sample()
         suppression = self.imu.is_passive(idx)
         while suppression:
             logger.debug('suppress sample: {}'.format(idx))
+            self.primary_sensor.skip_frames(self.imu.next_unsuppressed(idx) - idx)
+            if not block:
+                return None
             (idx, pdata) = self.primary_sensor.sample()
             suppression = self.imu.is_passive(idx)
 
@@ -205,20 +225,49 @@ class DeviceToClientAdapter(object):
         super(DeviceToClientAdapter, self).__init__()
         self.device = device
 
+    def next_sample_delay(self):
+        return self.device.next_sample_delay()
+
     def get_and_send_frame(self, **kwargs):
-        data = self.device.sample()
+        """Returns whether the frame was sent, i.e. not dropped by the primary sensor's frame_filter."""
+        return self._send_sample(self.device.sample(), **kwargs)
+
+    def try_get_and_send_frame(self, **kwargs):
+        """Sample and send a frame without waiting for a sample that is not suppressed.
+
+        Call after next_sample_delay() has passed. Returns whether a frame was sent.
+        Frames are not sent if suppressed or dropped by the primary sensor's frame_filter.
+        """
+        if isinstance(self.device, IMUSuppresedCameraTimedMobileDevice):
+            data = self.device.sample(block=False)
+        else:
+            data = self.device.sample()
+        if data is None:
+            return False
+        return self._send_sample(data, **kwargs)
+
+    def _send_sample(self, data, **kwargs):
         fid, frame = data[0]
         frame_bytes = None
-        if isinstance(self.device.primary_sensor, client.RTImageSequenceClient):
+        sensor = self.device.primary_sensor
+        if isinstance(sensor, client.RTImageSequenceClient):
             frame_bytes = frame
-        elif isinstance(self.device.primary_sensor, client.RTVideoClient):
-            frame_bytes = cv2.imencode('.jpg', frame)[1].tostring()
+        elif isinstance(sensor, client.RTVideoClient):
+            if sensor.encoder is not None:
+                frame_bytes = sensor.encoder.encode(frame)
+            else:
+                frame_bytes = cv2.imencode('.jpg', frame)[1].tostring()
         else:
             raise TypeError('{} is not supported by the DeviceToClientAdapter'.format(
-                type(self.device.primary_sensor)))
+                type(sensor)))
+        if sensor.frame_filter is not None and not sensor.frame_filter(frame_bytes):
+            return False
+        if sensor.encoder is not None and isinstance(sensor, client.RTImageSequenceClient):
+            # stored JPEG frames
+            frame_bytes = sensor.encoder.reencode(frame_bytes)
         ts = time.time()
-        self.device.primary_sensor.send_frame(
-            frame_bytes, fid, time=ts, **kwargs)
+        sensor.send_frame(frame_bytes, fid, time=ts, **kwargs)
+        return True
 
     def process_reply(self, msg):
         # let the primary sensor to determine how to adjust to reply
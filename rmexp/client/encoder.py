@@ -0,0 +1,128 @@
+"""Client-side JPEG encoding adapted to the latency of replies.
+
+When replies come back later than the app can tolerate, an AdaptiveEncoder makes frames
+smaller, first by lowering JPEG quality and then by scaling frames down, within the bounds
+the app declares in app_encoding_bounds. When replies are fast again, it goes back up to
+full fidelity, where stored JPEG frames are sent untouched.
+"""
+from __future__ import absolute_import, division, print_function
+
+import collections
+
+import cv2
+from logzero import logger
+from rmexp import app_utility_func, cvutils
+
+# cv2.imencode's default JPEG quality
+MAX_QUALITY = 95
+QUALITY_STEP = 10
+SCALES = (1., 0.75, 0.5, 0.25)
+
+# lowest JPEG quality and smallest scale each app still works with
+app_encoding_bounds = {
+    'lego': {'min_quality': 55, 'min_scale': 0.5},
+    'ikea': {'min_quality': 55, 'min_scale': 0.5},
+    'pingpong': {'min_quality': 45, 'min_scale': 0.5},
+    'pool': {'min_quality': 55, 'min_scale': 0.75},
+    'face': {'min_quality': 65, 'min_scale': 0.75},
+}
+
+
+class AdaptiveEncoder(object):
+    """Chooses the JPEG quality and scale of frames from the latency of replies.
+
+    Encodings form levels from full fidelity down to (min_quality, min_scale), lowering quality
+    first and then scale. After every hold replies, the encoder moves one level down if the
+    smoothed reply latency is above target_ms, and one level up if it is below
+    headroom * target_ms.
+    """
+    # frames sent whose encoding is remembered until their reply
+    MAX_SENT = 1024
+
+    def __init__(self, target_ms, min_quality=MAX_QUALITY, min_scale=1., max_quality=MAX_QUALITY,
+                 headroom=0.5, smoothing=0.2, hold=5):
+        super(AdaptiveEncoder, self).__init__()
+        qualities = range(max_quality, min_quality - 1, -QUALITY_STEP)
+        if qualities[-1] != min_quality:
+            qualities.append(min_quality)
+        self.levels = ([(1., quality) for quality in qualities] +
+                       [(scale, min_quality) for scale in SCALES if min_scale <= scale < 1.])
+        self.target_ms = target_ms
+        self.headroom = headroom
+        self.smoothing = smoothing
+        self.hold = hold
+        self.level = 0
+        self.latency_ms = None
+        self._replies_since_change = 0
+        # gabriel message index --> (quality, scale) of frames waiting for replies
+        self._sent = collections.OrderedDict()
+
+    @property
+    def scale(self):
+        return self.levels[self.level][0]
+
+    @property
+    def quality(self):
+        return self.levels[self.level][1]
+
+    def add_latency(self, reply_ms):
+        """Adjust the encoding to the latency of a reply."""
+        if self.latency_ms is None:
+            self.latency_ms = reply_ms
+        else:
+            self.latency_ms += self.smoothing * (reply_ms - self.latency_ms)
+        self._replies_since_change += 1
+        if self._replies_since_change < self.hold:
+            return
+        if self.latency_ms > self.target_ms and self.level < len(self.levels) - 1:
+            self.level += 1
+        elif self.latency_ms < self.headroom * self.target_ms and self.level > 0:
+            self.level -= 1
+        else:
+            return
+        self._replies_since_change = 0
+        logger.debug('reply latency {:.0f} ms. encode at scale {} quality {}'.format(
+            self.latency_ms, self.scale, self.quality))
+
+    def encode(self, img):
+        """Encode an image at the current quality and scale."""
+        if self.scale < 1.:
+            img = cv2.resize(img, (0, 0), fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        return cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, self.quality])[1].tostring()
+
+    def reencode(self, frame_bytes):
+        """Re-encode a JPEG frame at the current quality and scale.
+        At full fidelity, the frame is returned as is.
+        """
+        if self.level == 0:
+            return frame_bytes
+        # frames of packed traces are memoryviews
+        buf = frame_bytes.tobytes() if isinstance(frame_bytes, memoryview) else frame_bytes
+        size = cvutils.jpeg_size(buf)
+        if size is None:
+            return frame_bytes
+        max_wh = int(round(max(size) * self.scale))
+        img = cvutils.decode_jpeg(buf, max_wh=max_wh if self.scale < 1. else None)
+        img = cvutils.resize_to_max_wh(img, max_wh)
+        return cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, self.quality])[1].tostring()
+
+    def add_sent(self, index):
+        """Remember the encoding of the frame sent with gabriel message index."""
+        self._sent[index] = (self.quality, self.scale)
+        if len(self._sent) > self.MAX_SENT:
+            # e.g. frames NACKed by the broker never get replies
+            self._sent.popitem(last=False)
+
+    def pop_sent(self, index):
+        """(quality, scale) of the frame sent with gabriel message index, or None if unknown."""
+        return self._sent.pop(index, None)
+
+
+def make_encoder(app, **kwargs):
+    """AdaptiveEncoder within the app's bounds in app_encoding_bounds, targeting the reply
+    latency at which the app's utility starts to decay. kwargs override them.
+    """
+    params = dict(app_encoding_bounds[app])
+    params['target_ms'] = float(app_utility_func.slow_exponential_params[app][0])
+    params.update(kwargs)
+    return AdaptiveEncoder(**params)
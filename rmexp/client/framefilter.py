@@ -0,0 +1,89 @@
+"""Client-side early discard of frames that are not worth sending.
+
+A FrameFilter is a filter_func for the clients' get_and_send_frame. It drops a frame if it
+is blurry or if it is a near-duplicate of the last frame the client sent, before the frame
+uses bandwidth, a token or server CPU.
+"""
+from __future__ import absolute_import, division, print_function
+
+import collections
+
+from logzero import logger
+from rmexp import cvutils
+
+# frames are decoded, at a reduced JPEG scale, and scaled to at most this size for hashing,
+# so that hashes do not depend on the trace resolution
+FILTER_MAX_WH = 240
+
+# dup_max_distance: frames whose phash64 is at most this many bits away from the
+#   last sent frame's are dropped. None to send duplicates.
+# blur_min_score: frames with a cvutils.blur_score below this are dropped. None to send blurry frames.
+#   zhuocv.checkBlurByGradient's default threshold is 500. Its patches have a fixed size in pixels,
+#   so scores depend on the image size and are only comparable at the size the apps work at.
+# blur_max_wh: size frames are scaled to for blur scores, the app's WORKING_MAX_WH.
+# These thresholds are not calibrated on the recorded traces. Check them, and the instruction
+# delay they cause, with benchmark frame_filter --trace_id.
+app_filter_params = {
+    # the lego FSM needs a few consistent frames to confirm a state, so keep more of them
+    'lego': {'dup_max_distance': 1, 'blur_min_score': 500, 'blur_max_wh': 640},
+    'ikea': {'dup_max_distance': 2, 'blur_min_score': 500, 'blur_max_wh': 300},
+    # pingpong_cv.check_image scores frames at this size
+    'pingpong': {'dup_max_distance': None, 'blur_min_score': 500, 'blur_max_wh': 640},
+    'pool': {'dup_max_distance': None, 'blur_min_score': 500, 'blur_max_wh': 1920},
+    'face': {'dup_max_distance': 4, 'blur_min_score': None},
+}
+
+
+class FrameFilter(object):
+    """Decides whether a client sends a JPEG frame.
+
+    Call it with the frame's bytes. Returns True to send the frame.
+    Counts of frames and bytes kept and dropped are in stats.
+    """
+
+    def __init__(self, dup_max_distance=None, blur_min_score=None, blur_max_wh=None, max_wh=FILTER_MAX_WH):
+        super(FrameFilter, self).__init__()
+        self.dup_max_distance = dup_max_distance
+        self.blur_min_score = blur_min_score
+        # None to score blur at max_wh
+        self.blur_max_wh = blur_max_wh or max_wh
+        self.max_wh = max_wh
+        self.last_sent_hash = None
+        self.stats = collections.Counter()
+
+    def __call__(self, frame_bytes):
+        # frames of packed traces are memoryviews
+        buf = frame_bytes.tobytes() if isinstance(frame_bytes, memoryview) else frame_bytes
+        self.stats['frames'] += 1
+        if self.blur_min_score is None:
+            img = cvutils.decode_jpeg(buf, max_wh=self.max_wh)
+        else:
+            img = cvutils.decode_jpeg(buf, max_wh=max(self.max_wh, self.blur_max_wh))
+            if cvutils.blur_score(cvutils.resize_to_max_wh(img, self.blur_max_wh)) < self.blur_min_score:
+                return self._drop('blurry', buf)
+        img = cvutils.resize_to_max_wh(img, self.max_wh)
+
+        frame_hash = None
+        if self.dup_max_distance is not None:
+            frame_hash = cvutils.phash64(img)
+            if (self.last_sent_hash is not None and
+                    cvutils.hamming_distance(frame_hash, self.last_sent_hash) <= self.dup_max_distance):
+                return self._drop('duplicate', buf)
+
+        self.last_sent_hash = frame_hash
+        self.stats['sent'] += 1
+        self.stats['sent_bytes'] += len(buf)
+        return True
+
+    def _drop(self, reason, buf):
+        logger.debug('drop {} frame'.format(reason))
+        self.stats[reason] += 1
+        self.stats['dropped_bytes'] += len(buf)
+        return False
+
+
+def make_frame_filter(app, **kwargs):
+    """FrameFilter with the thresholds of app in app_filter_params. kwargs override them."""
+    params = dict(app_filter_params[app])
+    params.update(kwargs)
+    return FrameFilter(**params)
@@ -1,5 +1,6 @@
 from __future__ import absolute_import, division, print_function
 
+import itertools
 import os
 import time
 import types
@@ -11,18 +12,38 @@ import logging
 import logzero
 from logzero import logger
 from rmexp import gabriel_pb2, cvutils
+from rmexp.dataset import packedtrace, videoindex
 
 logzero.formatter(logzero.LogFormatter(
     fmt='%(color)s[%(levelname)1.1s %(asctime)s.%(msecs)03d %(module)s:%(lineno)d]%(end_color)s %(message)s'))
 
 logzero.loglevel(logging.DEBUG)
 
+# frames before the target at which cv2.VideoCapture starts looking for a keyframe when seeking
+SEEK_BACKOFF_FRAMES = 16
+
+# numbers the video clients of this process, many of which may run in one event loop
+_client_seq = itertools.count()
+
+
+def make_index(stream_id, frame_id):
+    """Index of a frame sent by a client, <stream id>-<frame id>"""
+    return '{}-{}'.format(stream_id, frame_id)
+
+
+def parse_index(index):
+    """(stream id, frame id) of the index of a frame, as made by make_index"""
+    stream_id, _, frame_id = index.rpartition('-')
+    return stream_id, frame_id
+
 
 class VideoClient(object):
     def __init__(self, app, video_uri,
                  network_connector=None, video_params=None, max_wh=None,
                  loop=False, random_start=False):
         super(VideoClient, self).__init__()
+        # unique across the clients of all processes. workers keep per-stream state by it
+        self.stream_id = '{}.{}'.format(os.getpid(), next(_client_seq))
         self.video_uri = video_uri
         self._cam = self.get_video_capture(video_uri)
         self._fps = self._cam.get(cv2.cv.CV_CAP_PROP_FPS)
@@ -35,6 +56,10 @@ class VideoClient(object):
         self._loop = loop
         self._app = app
         self._nc = network_connector
+        # default filter_func of get_and_send_frame, e.g. a framefilter.FrameFilter
+        self.frame_filter = None
+        # encoder.AdaptiveEncoder choosing how frames are encoded. None to send them as they are
+        self.encoder = None
         assert self._app in ['lego', 'pingpong', 'face',
                              'pool', 'ikea'], 'Unknown app: {}'.format(self._app)
 
@@ -63,10 +88,13 @@ class VideoClient(object):
 
     def send_frame(self, frame_bytes, frame_id, reply, **kwargs):
         gabriel_msg = gabriel_pb2.Message()
-        gabriel_msg.data = frame_bytes
+        # frames of packed traces are memoryviews
+        gabriel_msg.data = frame_bytes.tobytes() if isinstance(frame_bytes, memoryview) else frame_bytes
         gabriel_msg.timestamp = kwargs['time']
-        gabriel_msg.index = '{}-{}'.format(os.getpid(), frame_id)
+        gabriel_msg.index = make_index(self.stream_id, frame_id)
         gabriel_msg.reply = reply
+        if self.encoder is not None:
+            self.encoder.add_sent(gabriel_msg.index)
         self._nc.put([gabriel_msg.SerializeToString(), ],
                      service=self._app)
 
@@ -92,13 +120,21 @@ class VideoClient(object):
             raise ValueError("Failed to get another frame.")
 
     def get_and_send_frame(self, filter_func=None, reply=False, **kwargs):
-        """Public convenient function to get and send a frame."""
+        """Public convenient function to get and send a frame.
+        Returns whether the frame was sent, i.e. not dropped by filter_func or self.frame_filter.
+        """
         frame = self.get_frame()
-        frame_bytes = cv2.imencode('.jpg', frame)[1].tostring()
+        if self.encoder is not None:
+            frame_bytes = self.encoder.encode(frame)
+        else:
+            frame_bytes = cv2.imencode('.jpg', frame)[1].tostring()
         ts = time.time()
+        filter_func = filter_func or self.frame_filter
         if filter_func is None or filter_func(frame_bytes):
             self.send_frame(frame_bytes, self._fid - 1,
                             reply=reply, time=ts, **kwargs)
+            return True
+        return False
 
     def process_reply(self, msg):
         # logger.trace('{} reply ignored'.format(self))
@@ -144,8 +180,21 @@ class RTVideoClient(VideoClient):
         super(RTVideoClient, self).__init__(*args, **kwargs)
         self._start_time = None
         self._fps = 30
+        # keyframes of the video, to fast-forward without decoding every skipped frame.
+        # loaded by _skip_frames when it first needs it. None if the video has no index
+        self._index = None
+        self._index_loaded = False
         logger.info('RTVideoClient considers FPS to be {}'.format(self._fps))
 
+    def next_frame_delay(self):
+        """Seconds get_frame would sleep before the next frame is available."""
+        if self._fid == self._start_fid:
+            return 0.
+        now = time.time()
+        if int(self._fps * (now - self._start_time)) + self._start_fid >= self._fid:
+            return 0.
+        return max(0., self._start_time + self._fid * (1. / self._fps) - now)
+
     def get_frame(self):
         tic = time.time()
         if self._fid == self._start_fid:
@@ -171,21 +220,11 @@ class RTVideoClient(VideoClient):
                     time.sleep(sleep_time)
                 next_fid = self._fid
 
-            # fast-forward
-            for _ in range(next_fid + 1 - self._fid):
-                has_frame, img = self._get_frame_and_resize()
-                if has_frame and img is not None:
-                    pass
-                else:
-                    self._cam.release()
-                    raise ValueError("Failed to get another frame.")
+            self._skip_frames(next_fid - self._fid)
+            has_frame, img = self._get_frame_and_resize()
 
             logger.debug("get_frame_and_resize: {}".format(time.time() - tic))
 
-            # # self._set_cam_pos(next_fid) #  this takes 50 ms. WTH?!
-            # has_frame, img = self._get_frame_and_resize()
-            # self._fid = next_fid
-
             if not has_frame or img is None:
                 self._cam.release()
                 raise ValueError("Failed to get another frame.")
@@ -194,8 +233,48 @@ class RTVideoClient(VideoClient):
             os.getpid(), self._fid - 1, self.current_fid, img.shape, int(1000 * (time.time() - tic))))
         return img
 
+    def _video_index(self):
+        if not self._index_loaded:
+            self._index_loaded = True
+            self._index = videoindex.load(self.video_uri)
+        return self._index
+
+    def _skip_frames(self, num):
+        """Fast-forward num frames without converting them into images.
+
+        Seeking decodes every frame from a keyframe to the target frame (this is why it takes 50 ms),
+        so seek only if that is fewer frames than grabbing up to the target, and grab otherwise.
+        Videos without an index are always grabbed.
+        """
+        if num <= 0:
+            return
+        target_fid = self._fid + num
+        target_pos = target_fid % self._cam_frame_cnt if self._loop else target_fid
+        index = self._video_index()
+        if index is not None and target_pos < len(index):
+            # OpenCV decodes from the last keyframe SEEK_BACKOFF_FRAMES or more before the target
+            seek_cost = target_pos - index.keyframe_before(max(0, target_pos - SEEK_BACKOFF_FRAMES))
+            if seek_cost < num:
+                self._set_cam_pos(target_fid)
+                return
+        for _ in range(num):
+            grabbed = self._cam.grab()
+            # reset video for looping
+            if not grabbed and self._loop:
+                self._cam.set(cv2.cv.CV_CAP_PROP_POS_FRAMES, 0)
+                grabbed = self._cam.grab()
+            if not grabbed:
+                self._cam.release()
+                raise ValueError("Failed to get another frame.")
+            self._fid += 1
+
 
 class RTImageSequenceClient(RTVideoClient):
+    """Real-time client of a directory of %010d.jpg frames, or of a packed trace directory.
+
+    Packed traces (see rmexp.dataset.packedtrace) are opened once and frames are memoryviews of them.
+    """
+
     def __init__(self, app, video_uri,
                  network_connector=None, video_params=None, max_wh=None,
                  loop=False, random_start=False):
@@ -206,8 +285,13 @@ class RTImageSequenceClient(RTVideoClient):
         self._start_time = None
         self._fps = 30
         self._start_fid = 0
-        self._cam_frame_cnt = len(
-            glob.glob(os.path.join(self.video_uri, '*.jpg')))
+        self._packed = None
+        if packedtrace.is_packed_trace(video_uri):
+            self._packed = packedtrace.PackedTrace(video_uri)
+            self._cam_frame_cnt = len(self._packed)
+        else:
+            self._cam_frame_cnt = len(
+                glob.glob(os.path.join(self.video_uri, '*.jpg')))
         assert self._cam_frame_cnt > 0, '{} has no frames. Is your video_uri correct?'.format(
             video_uri)
         logger.info('random_start: {}'.format(random_start))
@@ -218,6 +302,10 @@ class RTImageSequenceClient(RTVideoClient):
         self._loop = loop
         self._app = app
         self._nc = network_connector
+        # default filter_func of get_and_send_frame, e.g. a framefilter.FrameFilter
+        self.frame_filter = None
+        # encoder.AdaptiveEncoder choosing how frames are encoded. None to send them as they are
+        self.encoder = None
         if video_params is not None:
             self._set_cam_params(video_params)
         assert self._fid is not None, 'Camera position needs to be initialized using _set_cam_pos'
@@ -241,6 +329,12 @@ class RTImageSequenceClient(RTVideoClient):
         if self._loop:
             frame_index = frame_index % self._cam_frame_cnt
 
+        if self._packed is not None:
+            if frame_index >= self._cam_frame_cnt:
+                return False, None
+            self._fid = frame_index + 1
+            return True, self._packed.get_frame(frame_index)
+
         # on-disk jpeg sequence starts with 1 while our frame index starts with 0
         jpeg_fp = os.path.join(
             self.video_uri, '{:010d}.jpg'.format(frame_index + 1))
@@ -251,12 +345,55 @@ class RTImageSequenceClient(RTVideoClient):
         return True, frame_bytes
 
     def get_and_send_frame(self, filter_func=None, reply=False, **kwargs):
-        """Public convenient function to get and send a frame."""
+        """Public convenient function to get and send a frame.
+        Returns whether the frame was sent, i.e. not dropped by filter_func or self.frame_filter.
+        """
         frame_bytes = self.get_frame()
         ts = time.time()
+        filter_func = filter_func or self.frame_filter
         if filter_func is None or filter_func(frame_bytes):
+            if self.encoder is not None:
+                frame_bytes = self.encoder.reencode(frame_bytes)
             self.send_frame(frame_bytes, self._fid - 1,
                             reply=reply, time=ts, **kwargs)
+            return True
+        return False
+
+    def next_frame_delay(self):
+        """Seconds get_frame would sleep before the next frame is available."""
+        if self._fid == self._start_fid:
+            return 0.
+        now = time.time()
+        if int(self._fps * (now - self._start_time)) + self._start_fid >= self._fid:
+            return 0.
+        return max(0., self._start_time + (self._fid - self._start_fid) * (1. / self._fps) - now)
+
+    def get_latest_frame(self):
+        """Get the newest frame available now without waiting.
+        Returns the last frame again if no new frame is available yet.
+        """
+        if self._fid == self._start_fid:
+            return self.get_frame()
+        next_fid = int(self._fps * (time.time() - self._start_time)) + self._start_fid
+        if next_fid < self._fid:
+            next_fid = self._fid - 1
+        has_frame, img = self._get_frame_bytes(frame_index=next_fid)
+        if not has_frame or img is None:
+            raise ValueError("Failed to get another frame.")
+        return img
+
+    def get_and_send_latest_frame(self, reply=False, **kwargs):
+        """Send the newest frame available now, for open-loop clients that send at their own times.
+        Returns whether the frame was sent, i.e. not dropped by self.frame_filter.
+        """
+        frame_bytes = self.get_latest_frame()
+        if self.frame_filter is None or self.frame_filter(frame_bytes):
+            if self.encoder is not None:
+                frame_bytes = self.encoder.reencode(frame_bytes)
+            self.send_frame(frame_bytes, self._fid - 1,
+                            reply=reply, time=time.time(), **kwargs)
+            return True
+        return False
 
     def get_frame(self):
         """Public function to get a frame.
@@ -6,5 +6,18 @@ STREAM_TOPIC = 'feeds'
 REDIS_RESPONSE_CHAN = 'responses'
 WORKER_GROUP = 'processor'
 MONITOR_GROUP = 'monitor'
+# SQLAlchemy URL of the database, e.g. mysql://... or sqlite:///results.db, or parquet://<directory>
+# to keep results in Parquet files instead (see rmexp.schema.columnar)
 DB_URI = os.getenv('DB_URI', None)
 EXP = os.getenv('EXP')
+# Decode JPEG frames at a reduced scale close to the app's working size (see cvutils.decode_jpeg)
+REDUCED_DECODE = os.getenv('REDUCED_DECODE', 'False').lower() == 'true'
+# If set, workers dump per-stage latency histograms to <WORKER_STATS_DIR>/worker-<pid>.json
+WORKER_STATS_DIR = os.getenv('WORKER_STATS_DIR', None)
+WORKER_STATS_INTERVAL = float(os.getenv('WORKER_STATS_INTERVAL', 10))
+# Per-trace cache of the IMU tables for emulated clients (see rmexp.dataset.imucache)
+IMU_CACHE_DIR = os.getenv('IMU_CACHE_DIR', os.path.join(
+    os.path.expanduser('~'), '.cache', 'rmexp', 'imu'))
+# Keyframe indexes of video traces for real-time video clients (see rmexp.dataset.videoindex)
+VIDEO_INDEX_DIR = os.getenv('VIDEO_INDEX_DIR', os.path.join(
+    os.path.expanduser('~'), '.cache', 'rmexp', 'videoindex'))
@@ -1,6 +1,9 @@
 # (junjuew) ImageHash related functions are adapted from
 # https://github.com/JohannesBuchner/imagehash
 from __future__ import absolute_import, division, print_function
+import io
+import struct
+
 import numpy as np
 
 
@@ -84,6 +87,58 @@ def phash(image, hash_size=8, highfreq_factor=4):
     return ImageHash(diff)
 
 
+def phash64(image, hash_size=8, highfreq_factor=4):
+    """Perceptual hash of phash packed into an int, hash_size ** 2 bits long.
+
+    The bits are those of phash, most significant first, i.e. '{:016x}'.format(phash64(image))
+    == str(phash(image)) for the default hash_size. Uses cv2.dct and np.packbits instead
+    of scipy and strings, so it is cheap enough to run on every frame a client sends.
+    Compare hashes with hamming_distance.
+    """
+    if hash_size < 2:
+        raise ValueError("Hash size must be greater than or equal to 2")
+
+    import cv2
+    img_size = hash_size * highfreq_factor
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    image = cv2.resize(image, (img_size, img_size))
+    dct = cv2.dct(image.astype(np.float32))[:hash_size, :hash_size].astype(np.float64)
+    # cv2.dct is orthonormal. rescale the first row and column relative to the others
+    # like the unnormalized scipy dct of phash, so that the bits match
+    dct[0, :] *= np.sqrt(2)
+    dct[:, 0] *= np.sqrt(2)
+    dctlowfreq = dct.flatten()
+    diff = dctlowfreq > np.average(dctlowfreq[1:])
+    return int(np.packbits(diff).tostring().encode('hex'), 16)
+
+
+def hamming_distance(hash1, hash2):
+    """Number of bits that differ between two phash64 hashes"""
+    return bin(hash1 ^ hash2).count('1')
+
+
+def blur_score(image, patch_nbox=5, patch_width=25, patch_height=25):
+    """Sharpness of an image as in zhuocv.checkBlurByGradient, which calls images blurry
+    if this is at most its threshold.
+
+    The image is sampled in patch_nbox x patch_nbox patches spread over it. Returns the
+    largest sum of absolute second-order Sobel gradients of a patch.
+    """
+    import cv2
+    bw = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    n_rows, n_cols = bw.shape[:2]
+    max_gradients = 0.
+    for i in range(patch_nbox):
+        top = (n_rows // (2 * patch_nbox + 1)) * (2 * i + 1)
+        for j in range(patch_nbox):
+            left = (n_cols // (2 * patch_nbox + 1)) * (2 * j + 1)
+            bw_window = bw[top:top + patch_height, left:left + patch_width]
+            gradients = np.absolute(cv2.Sobel(bw_window, cv2.CV_64F, 1, 1, ksize=5))
+            max_gradients = max(max_gradients, np.sum(gradients))
+    return max_gradients
+
+
 def resize_to_max_wh(img, max_wh):
     """Resize an image so that the max of width or height is less than max_wh."""
     import cv2
@@ -93,3 +148,75 @@ def resize_to_max_wh(img, max_wh):
         img = cv2.resize(img, (0, 0), fx=resize_ratio,
                          fy=resize_ratio, interpolation=cv2.INTER_AREA)
     return img
+
+
+# JPEG start of frame markers, which carry the image size
+_JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - set([0xC4, 0xC8, 0xCC])
+# libjpeg can decode at 1/2, 1/4 and 1/8 of the full size by skipping DCT coefficients
+_JPEG_REDUCED_SCALES = (8, 4, 2)
+
+
+def jpeg_size(buf):
+    """Read (width, height) from the headers of a JPEG. Returns None if buf is not a JPEG."""
+    if buf[:2] != b'\xff\xd8':
+        return None
+    idx = 2
+    while idx + 9 <= len(buf):
+        if buf[idx] != b'\xff':
+            return None
+        marker = ord(buf[idx + 1])
+        if marker in _JPEG_SOF_MARKERS:
+            height, width = struct.unpack('>HH', buf[idx + 5:idx + 9])
+            return width, height
+        segment_length, = struct.unpack('>H', buf[idx + 2:idx + 4])
+        idx += 2 + segment_length
+    return None
+
+
+def get_reduced_scale(size, max_wh):
+    """Largest JPEG scale-down factor that keeps max(width, height) at least max_wh."""
+    for scale in _JPEG_REDUCED_SCALES:
+        if -(-max(size) // scale) >= max_wh:
+            return scale
+    return 1
+
+
+_imdecode_reduced = []
+
+
+def _imdecode_supports_reduced():
+    """OpenCV has IMREAD_REDUCED_* since 3.2, but older versions only honor it in imread."""
+    if not _imdecode_reduced:
+        import cv2
+        supported = False
+        if hasattr(cv2, 'IMREAD_REDUCED_COLOR_2'):
+            buf = cv2.imencode('.jpg', np.zeros((16, 16, 3), dtype=np.uint8))[1]
+            supported = cv2.imdecode(buf, cv2.IMREAD_REDUCED_COLOR_2).shape[:2] == (8, 8)
+        _imdecode_reduced.append(supported)
+    return _imdecode_reduced[0]
+
+
+def decode_jpeg(buf, max_wh=None):
+    """Decode an encoded image like cv2.imdecode.
+
+    If max_wh is given and buf is a JPEG larger than that, it is decoded at the smallest
+    1/2, 1/4 or 1/8 scale that still has max(width, height) >= max_wh.
+    Handlers still resize to their exact working size afterwards.
+    This uses IMREAD_REDUCED_COLOR_* if cv2.imdecode supports it, otherwise PIL's draft mode.
+    """
+    import cv2
+    img_np = np.frombuffer(buf, dtype=np.uint8)
+    size = jpeg_size(buf) if max_wh else None
+    scale = get_reduced_scale(size, max_wh) if size else 1
+    if scale == 1:
+        return cv2.imdecode(img_np, cv2.CV_LOAD_IMAGE_UNCHANGED)
+    if _imdecode_supports_reduced():
+        return cv2.imdecode(img_np, getattr(cv2, 'IMREAD_REDUCED_COLOR_{}'.format(scale)))
+
+    from PIL import Image
+    image = Image.open(io.BytesIO(buf))
+    image.draft('RGB', (-(-size[0] // scale), -(-size[1] // scale)))
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    # PIL is RGB and OpenCV is BGR
+    return cv2.cvtColor(np.asarray(image), cv2.COLOR_RGB2BGR)
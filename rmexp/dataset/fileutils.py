@@ -216,6 +216,21 @@ def decode_video_to_imgs_in_app_dataset(app_dataset_dir_path, trace_ids=None, fo
     worker_pool.join()
 
 
+def pack_app_dataset(app_dataset_dir_path, trace_ids=None):
+    """Pack all traces in dir_path for emulated clients. See rmexp.dataset.packedtrace."""
+    from rmexp.dataset import packedtrace
+    if trace_ids is not None:
+        assert type(
+            trace_ids) == list, 'trace_ids should be a list of trace directory names not {}'.format(
+                type(trace_ids))
+
+    worker_pool = multiprocessing.Pool(10)
+    trace_dir_paths = _get_trace_dir_path(app_dataset_dir_path, trace_ids)
+    worker_pool.map_async(packedtrace.pack_trace_dir, trace_dir_paths)
+    worker_pool.close()
+    worker_pool.join()
+
+
 def get_image_sequence_resolution(image_sequence_path):
     import cv2
     img_ps = glob.glob(os.path.join(image_sequence_path, '*.jpg'))
@@ -0,0 +1,116 @@
+#! /usr/bin/env python
+"""Local cache of the IMU and IMUSuppression tables of a trace, for emulated clients.
+
+The cache of a trace is a directory <cache_dir>/<trace> holding
+    index.npy       -- int64 frame index of each IMU sample, ascending
+    imu.npy         -- float64 IMU samples, one row of IMU_COLUMNS per entry of index.npy
+    suppression.npy -- bool IMU suppression decisions, in the order of the IMUSuppression table
+
+It is built from the database the first time a trace is used, so later clients start
+without querying it, and lookups are array indexing instead of pandas row access.
+"""
+from __future__ import absolute_import, division, print_function
+
+import os
+import shutil
+import tempfile
+
+import fire
+import numpy as np
+from logzero import logger
+
+from rmexp import config
+from rmexp.dataset.packedtrace import IMU_COLUMNS
+
+INDEX_FNAME = 'index.npy'
+IMU_FNAME = 'imu.npy'
+SUPPRESSION_FNAME = 'suppression.npy'
+
+
+def cache_path(trace, cache_dir=None):
+    return os.path.join(cache_dir or config.IMU_CACHE_DIR, trace)
+
+
+def build(trace, cache_dir=None, overwrite=False):
+    """Materialize the IMU data of trace from the database into its cache directory.
+
+    An existing cache is kept unless overwrite is True.
+    """
+    from rmexp import dbutils
+    from rmexp.schema import models
+
+    df = dbutils.read_table(models.IMU, filters=[('name', '=', trace)])
+    df['index'] = df['index'].astype(int)
+    df = df.sort_values('index')
+    df_suppression = dbutils.read_table(models.IMUSuppression, filters=[('name', '=', trace)])
+    assert len(df.index) > 0, 'no IMU data of {}'.format(trace)
+
+    path = cache_path(trace, cache_dir)
+    parent = os.path.dirname(path)
+    if not os.path.exists(parent):
+        os.makedirs(parent)
+    # clients of the same trace may build it at the same time. write aside and move in place
+    tmp_path = tempfile.mkdtemp(prefix='.{}-'.format(trace), dir=parent)
+    os.chmod(tmp_path, 0o755)
+    np.save(os.path.join(tmp_path, INDEX_FNAME), df['index'].values.astype(np.int64))
+    np.save(os.path.join(tmp_path, IMU_FNAME), df[list(IMU_COLUMNS)].values.astype(np.float64))
+    np.save(os.path.join(tmp_path, SUPPRESSION_FNAME),
+            df_suppression['suppression'].astype(str).values == '1')
+    if overwrite and os.path.isdir(path):
+        shutil.rmtree(path)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # built by someone else meanwhile
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    logger.info('cached IMU data of {} ({} samples) in {}'.format(trace, len(df.index), path))
+    return path
+
+
+class IMUCache(object):
+    """IMU samples and suppression decisions of a trace, looked up by position like the tables."""
+
+    def __init__(self, path):
+        super(IMUCache, self).__init__()
+        self.path = path
+        self.index = np.load(os.path.join(path, INDEX_FNAME))
+        self.imu = np.load(os.path.join(path, IMU_FNAME))
+        self.suppression = np.load(os.path.join(path, SUPPRESSION_FNAME))
+        # position of the first unsuppressed decision at or after each position,
+        # len(suppression) if there is none
+        positions = np.arange(len(self.suppression))
+        unsuppressed = np.where(self.suppression, len(self.suppression), positions)
+        self._next_unsuppressed = np.minimum.accumulate(unsuppressed[::-1])[::-1]
+
+    @property
+    def first_index(self):
+        return int(self.index[0])
+
+    def next_unsuppressed(self, idx):
+        """The first position at or after idx that is not suppressed.
+        Positions past the suppression decisions are not suppressed.
+        """
+        if 0 <= idx < len(self._next_unsuppressed):
+            return int(self._next_unsuppressed[idx])
+        return idx
+
+
+def load(trace, cache_dir=None):
+    """Load the cache of trace, building it from the database if there is none."""
+    path = cache_path(trace, cache_dir)
+    if not os.path.isdir(path):
+        build(trace, cache_dir)
+    return IMUCache(path)
+
+
+def build_all(*traces, **kwargs):
+    """(Re)build the caches of traces ahead of experiments, e.g. build_all lego-tr1 lego-tr2
+
+    cache_dir: defaults to IMU_CACHE_DIR
+    """
+    for trace in traces:
+        build(trace, cache_dir=kwargs.get('cache_dir'), overwrite=True)
+
+
+if __name__ == '__main__':
+    fire.Fire()
@@ -0,0 +1,163 @@
+#! /usr/bin/env python
+"""Packed traces: all JPEG frames of a trace in one file, for emulated clients.
+
+A packed trace is a directory holding
+    frames.bin  -- the JPEG frames, concatenated
+    offsets.npy -- int64 offsets of the frames in frames.bin, followed by its size
+    imu.npy     -- optional float64 IMU samples, one row of IMU_COLUMNS per frame (NaN if missing)
+
+Readers open and mmap the files once and serve frames as memoryviews of the mapping,
+so getting a frame costs no syscalls and no copies, and clients of the same trace
+share its pages.
+"""
+from __future__ import absolute_import, division, print_function
+
+import csv
+import glob
+import mmap
+import os
+
+import fire
+import numpy as np
+from logzero import logger
+
+FRAMES_FNAME = 'frames.bin'
+OFFSETS_FNAME = 'offsets.npy'
+IMU_FNAME = 'imu.npy'
+IMU_COLUMNS = ('rot_x', 'rot_y', 'rot_z', 'acc_x', 'acc_y', 'acc_z')
+# packed trace directory name next to video.mp4 and video-images in a trace directory
+PACKED_DNAME = 'video-packed'
+
+
+def is_packed_trace(path):
+    # offsets are written last, so partially written traces are not picked up
+    return os.path.isfile(os.path.join(path, OFFSETS_FNAME))
+
+
+class PackedTrace(object):
+    """Read-only view of a packed trace."""
+
+    def __init__(self, path):
+        super(PackedTrace, self).__init__()
+        self.path = path
+        self.offsets = np.load(os.path.join(path, OFFSETS_FNAME), mmap_mode='r')
+        assert len(self.offsets) > 1, '{} has no frames'.format(path)
+        with open(os.path.join(path, FRAMES_FNAME), 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        # memoryview() does not take an mmap directly in python 2
+        self._frames = memoryview(np.frombuffer(self._mmap, dtype=np.uint8))
+        imu_fp = os.path.join(path, IMU_FNAME)
+        self.imu = np.load(imu_fp, mmap_mode='r') if os.path.isfile(imu_fp) else None
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def get_frame(self, idx):
+        """JPEG bytes of frame idx as a memoryview. Use .tobytes() where a str is needed."""
+        return self._frames[self.offsets[idx]:self.offsets[idx + 1]]
+
+    def get_imu(self, idx):
+        """IMU_COLUMNS of frame idx, or None if the trace has no IMU data."""
+        return self.imu[idx] if self.imu is not None else None
+
+    def close(self):
+        self._frames = None
+        self._mmap.close()
+
+
+def pack_frames(frames, output_dir, imu=None, imu_fp=None):
+    """Write JPEG frames, an iterable of strings, as a packed trace to output_dir.
+
+    imu: optional array with one row of IMU_COLUMNS per frame
+    imu_fp: optional imu.csv made by rmexp.dataset.trace to take the IMU rows from instead
+    """
+    offsets_fp = os.path.join(output_dir, OFFSETS_FNAME)
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    elif os.path.exists(offsets_fp):
+        # unmark the trace as packed while it is rewritten
+        os.remove(offsets_fp)
+    offsets = [0]
+    with open(os.path.join(output_dir, FRAMES_FNAME), 'wb') as f:
+        for frame in frames:
+            f.write(frame)
+            offsets.append(offsets[-1] + len(frame))
+    n_frames = len(offsets) - 1
+    assert n_frames > 0, 'no frames to pack into {}'.format(output_dir)
+    if imu_fp is not None:
+        imu = _load_imu_csv(imu_fp, n_frames)
+    if imu is not None:
+        imu = np.asarray(imu, dtype=np.float64)
+        assert imu.shape == (n_frames, len(IMU_COLUMNS)), 'imu has shape {} for {} frames'.format(
+            imu.shape, n_frames)
+        np.save(os.path.join(output_dir, IMU_FNAME), imu)
+    np.save(offsets_fp, np.array(offsets, dtype=np.int64))
+    logger.info('packed {} frames ({:.1f} MB) into {}'.format(
+        n_frames, offsets[-1] / 1e6, output_dir))
+    return n_frames
+
+
+def _read_jpegs(image_dir):
+    for fp in sorted(glob.glob(os.path.join(image_dir, '*.jpg'))):
+        with open(fp, 'rb') as f:
+            yield f.read()
+
+
+def _decode_video_to_jpegs(video_fp, jpeg_quality):
+    import cv2
+    cam = cv2.VideoCapture(video_fp)
+    while True:
+        has_frame, img = cam.read()
+        if not has_frame or img is None:
+            break
+        yield cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality])[1].tostring()
+    cam.release()
+
+
+def _load_imu_csv(imu_fp, n_frames):
+    """IMU rows of frames from an imu.csv made by rmexp.dataset.trace"""
+    imu = np.full((n_frames, len(IMU_COLUMNS)), np.nan)
+    with open(imu_fp, 'r') as f:
+        for row in csv.DictReader(f):
+            fid = int(row['frame_id'])
+            if 0 <= fid < n_frames:
+                imu[fid] = [float(row[column]) for column in IMU_COLUMNS]
+    return imu
+
+
+def pack_image_dir(image_dir, output_dir=None, imu_fp=None):
+    """Pack a directory of %010d.jpg frames, in file name order.
+
+    output_dir defaults to video-packed next to image_dir.
+    """
+    output_dir = output_dir or os.path.join(os.path.dirname(image_dir.rstrip('/')), PACKED_DNAME)
+    return pack_frames(_read_jpegs(image_dir), output_dir, imu_fp=imu_fp)
+
+
+def pack_video(video_fp, output_dir=None, imu_fp=None, jpeg_quality=95):
+    """Decode a video and pack its frames, re-encoded as JPEGs of jpeg_quality.
+
+    output_dir defaults to video-packed next to video_fp.
+    """
+    output_dir = output_dir or os.path.join(os.path.dirname(video_fp), PACKED_DNAME)
+    return pack_frames(_decode_video_to_jpegs(video_fp, jpeg_quality), output_dir, imu_fp=imu_fp)
+
+
+def pack_trace_dir(trace_dir, jpeg_quality=95):
+    """Pack a trace directory into <trace_dir>/video-packed.
+
+    Frames come from video-images if it exists and from video.mp4 otherwise.
+    IMU data comes from imu.csv if it exists.
+    """
+    image_dir = os.path.join(trace_dir, 'video-images')
+    output_dir = os.path.join(trace_dir, PACKED_DNAME)
+    imu_fp = os.path.join(trace_dir, 'imu.csv')
+    imu_fp = imu_fp if os.path.isfile(imu_fp) else None
+    if os.path.isdir(image_dir):
+        return pack_image_dir(image_dir, output_dir, imu_fp=imu_fp)
+    return pack_video(os.path.join(trace_dir, 'video.mp4'), output_dir, imu_fp=imu_fp,
+                      jpeg_quality=jpeg_quality)
+
+
+if __name__ == '__main__':
+    fire.Fire()
@@ -3,7 +3,10 @@ from __future__ import absolute_import, division, print_function
 
 import glob
 import importlib
+import itertools
 import json
+import multiprocessing
+import multiprocessing.pool
 import os
 import re
 import shutil
@@ -12,10 +15,14 @@ import cv2
 import fire
 import pandas as pd
 from logzero import logger
-from rmexp import dbutils, schema, utils
+from rmexp import dbutils, utils
 from rmexp.schema import models
 
 supported_apps = ['lego', 'pingpong', 'ikea', 'pool', 'face']
+# apps whose Handler.process depends on the frames before, so their frames are processed in order
+sequential_process_apps = ['pingpong']
+# frames handed to the process pool at a time. bounds decoded frames in memory to twice this
+FRAME_BATCH_SIZE = 32
 
 
 def _assert_trace_dir_integrity(trace_dir, relative_video_uri, imu_fname):
@@ -42,14 +49,58 @@ def _parse_trace_dir(trace_dir):
     return app_name, trace_id
 
 
-def load_trace_dir_to_db(trace_dir,
-                         relative_video_uri='video-images/%010d.jpg',
-                         imu_fname='imu.csv',
-                         dry_run=True):
-    """Load trace directory to database.
-    The trace_dir should ends with a particular naming path:
-    ...../<app-name>/<trace-id>/
+# app name --> Handler of a process pool worker
+_worker_handlers = {}
+
+
+def _process_frame(args):
+    """Symbolic state of a frame, by a process pool worker's handler of the app"""
+    app_name, fid, img = args
+    if app_name not in _worker_handlers:
+        _worker_handlers[app_name] = importlib.import_module(app_name).Handler()
+    return fid, img.shape[:2], _worker_handlers[app_name].process(img)
+
+
+def _read_frames(cam, fids):
+    """Read frames fids, in ascending order, decoding sequentially instead of seeking to each."""
+    pos = 0
+    for fid in fids:
+        if fid < pos:
+            cam.set(cv2.cv.CV_CAP_PROP_POS_FRAMES, fid)
+            pos = fid
+        # skipped frames are not converted to images
+        while pos < fid:
+            cam.grab()
+            pos += 1
+        _, img = cam.read()
+        pos += 1
+        assert img is not None, 'failed to read frame {}'.format(fid)
+        yield fid, img
+
+
+def _process_frames(app_name, app_handler, frames, pool):
+    """(fid, (height, width), symbolic_state) of frames, in order.
+
+    With a pool, a batch of frames is processed while the next one is decoded.
     """
+    if pool is None or app_name in sequential_process_apps:
+        for (fid, img) in frames:
+            yield fid, img.shape[:2], app_handler.process(img)
+        return
+
+    pending = None
+    while True:
+        batch = [(app_name, fid, img) for (fid, img) in itertools.islice(frames, FRAME_BATCH_SIZE)]
+        result = pool.map_async(_process_frame, batch, chunksize=1) if batch else None
+        if pending is not None:
+            for processed in pending.get():
+                yield processed
+        if result is None:
+            break
+        pending = result
+
+
+def _load_trace_dir(trace_dir, relative_video_uri, imu_fname, sink, pool):
     logger.debug('loading from dir: {}, video uri: {}'.format(
         trace_dir, os.path.join(trace_dir, relative_video_uri)))
     _create_imu_csv(trace_dir)
@@ -57,6 +108,7 @@ def load_trace_dir_to_db(trace_dir,
         trace_dir, relative_video_uri=relative_video_uri, imu_fname=imu_fname)
     app_name, trace_id = _parse_trace_dir(trace_dir)
     app = importlib.import_module(app_name)
+    # process() may run in pool workers, but instructions are made here in frame order
     app_handler = app.Handler()
 
     # get video
@@ -65,41 +117,86 @@ def load_trace_dir_to_db(trace_dir,
 
     # get imu data
     imu_fpath = os.path.join(trace_dir, imu_fname)
-    imu_df = pd.read_csv(imu_fpath, index_col='frame_id')
+    imu_df = pd.read_csv(imu_fpath, index_col='frame_id').sort_index()
     imu_df['sensor_timestamp'] = pd.to_datetime(imu_df['sensor_timestamp'])
 
-    with dbutils.session_scope(dry_run=dry_run) as sess:
-        for row in imu_df.itertuples():
-            fid = row.Index
-            cam.set(cv2.cv.CV_CAP_PROP_POS_FRAMES, fid)
-            _, img = cam.read()
-            symbolic_state = app_handler.process(img)
-            instruction = app_handler.add_symbolic_state_for_instruction(
-                symbolic_state)
-            keys_dict = {'name': app_name,
-                         'trace': trace_id,
-                         'fid': fid}
-            vals_dict = {
-                'symbolic_state': symbolic_state,
-                'rot_x': row.rot_x,
-                'rot_y': row.rot_y,
-                'rot_z': row.rot_z,
-                'acc_x': row.acc_x,
-                'acc_y': row.acc_y,
-                'acc_z': row.acc_z,
-                'sensor_timestamp': row.sensor_timestamp.to_pydatetime(),
-                'instruction': instruction,
-                'height': img.shape[0],
-                'width': img.shape[1]
-            }
-            logger.debug('{}: {}'.format(
-                json.dumps(keys_dict), json.dumps(vals_dict, default=str)))
+    frames = _read_frames(cam, imu_df.index.tolist())
+    for (row, (fid, shape, symbolic_state)) in itertools.izip(
+            imu_df.itertuples(), _process_frames(app_name, app_handler, frames, pool)):
+        instruction = app_handler.add_symbolic_state_for_instruction(
+            symbolic_state)
+        keys_dict = {'name': app_name,
+                     'trace': trace_id,
+                     'fid': fid}
+        vals_dict = {
+            'symbolic_state': symbolic_state,
+            'rot_x': row.rot_x,
+            'rot_y': row.rot_y,
+            'rot_z': row.rot_z,
+            'acc_x': row.acc_x,
+            'acc_y': row.acc_y,
+            'acc_z': row.acc_z,
+            'sensor_timestamp': row.sensor_timestamp.to_pydatetime(),
+            'instruction': instruction,
+            'height': shape[0],
+            'width': shape[1]
+        }
+        logger.debug('{}: {}'.format(
+            json.dumps(keys_dict), json.dumps(vals_dict, default=str)))
 
-            dbutils.insert_or_update_one(sess,
-                                         models.Trace,
-                                         keys_dict,
-                                         vals_dict)
+        if sink is not None:
+            sink.upsert(models.Trace, keys_dict, vals_dict)
     cam.release()
+    logger.info('loaded {} frames of {}'.format(len(imu_df.index), trace_dir))
+
+
+def load_trace_dirs_to_db(*trace_dirs, **kwargs):
+    """Load trace directories to database, e.g. load_trace_dirs_to_db data/lego-trace/*
+
+    Frames are decoded in order and processed by a pool of processes. Instructions are made
+    from their symbolic states in frame order, and rows are upserted in batches.
+
+    Keyword Arguments:
+        relative_video_uri {string} -- (default: {'video-images/%010d.jpg'})
+        imu_fname {string} -- (default: {'imu.csv'})
+        dry_run {bool} -- Do not write to the database (default: {True})
+        processes {int} -- Processes running app handlers. In this process if 1 (default: {cpu count})
+        parallel_traces {int} -- Trace directories decoded at the same time (default: {1})
+    """
+    relative_video_uri = kwargs.get('relative_video_uri', 'video-images/%010d.jpg')
+    imu_fname = kwargs.get('imu_fname', 'imu.csv')
+    processes = kwargs.get('processes') or multiprocessing.cpu_count()
+    parallel_traces = kwargs.get('parallel_traces', 1)
+
+    pool = multiprocessing.Pool(processes) if processes > 1 else None
+    # rows must not be dropped, so wait for the writer instead
+    with dbutils.sink_scope(dry_run=kwargs.get('dry_run', True), block_when_full=True) as sink:
+        def load(trace_dir):
+            _load_trace_dir(trace_dir, relative_video_uri, imu_fname, sink, pool)
+
+        try:
+            if parallel_traces > 1:
+                trace_pool = multiprocessing.pool.ThreadPool(parallel_traces)
+                trace_pool.map(load, trace_dirs, chunksize=1)
+                trace_pool.close()
+            else:
+                map(load, trace_dirs)
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+
+def load_trace_dir_to_db(trace_dir,
+                         relative_video_uri='video-images/%010d.jpg',
+                         imu_fname='imu.csv',
+                         dry_run=True,
+                         processes=None):
+    """Load trace directory to database.
+    The trace_dir should ends with a particular naming path:
+    ...../<app-name>/<trace-id>/
+    """
+    load_trace_dirs_to_db(trace_dir, relative_video_uri=relative_video_uri, imu_fname=imu_fname,
+                          dry_run=dry_run, processes=processes)
 
 
 def _create_imu_csv(trace_dir, output_fname='imu.csv'):
@@ -140,31 +237,28 @@ def create_instruction_from_symbolic_state_in_db(app, trace_id,
     avoiding re-running all symbolic state extractions.
     """
     app_name = app
-    df = pd.read_sql(
-        "select symbolic_state, fid from Trace where name=%(app)s and trace=%(trace_id)s order by fid",
-        schema.engine,
-        params={'app': app_name, 'trace_id': trace_id}
+    df = dbutils.read_table(
+        models.Trace, columns=['symbolic_state', 'fid'],
+        filters=[('name', '=', app_name), ('trace', '=', trace_id)], order_by='fid'
     )
 
     app = importlib.import_module(app)
     app_handler = app.Handler()
 
-    with dbutils.session_scope(dry_run=dry_run) as sess:
+    with dbutils.sink_scope(dry_run=dry_run, block_when_full=True) as sink:
         for row in df.itertuples():
             instruction = app_handler.add_symbolic_state_for_instruction(
                 row.symbolic_state)
             keys_dict = {'name': app_name,
                          'trace': trace_id,
-                         'fid': row.fid}
+                         'fid': int(row.fid)}
             vals_dict = {
                 'instruction': instruction,
             }
             logger.debug('update {}: {}'.format(
                 json.dumps(keys_dict), json.dumps(vals_dict, default=str)))
-            dbutils.insert_or_update_one(sess,
-                                         models.Trace,
-                                         keys_dict,
-                                         vals_dict)
+            if sink is not None:
+                sink.upsert(models.Trace, keys_dict, vals_dict)
 
 
 if __name__ == "__main__":
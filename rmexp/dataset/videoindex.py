@@ -0,0 +1,175 @@
+#! /usr/bin/env python
+"""Keyframe and timestamp index of a video trace, for real-time video clients.
+
+The index of a video file is stored under VIDEO_INDEX_DIR (see rmexp.config), named after the
+path, size and modification time of the video, as an .npz holding
+    pts       -- float64 presentation timestamp of each frame in seconds, in frame order
+    keyframes -- int64 ascending frame numbers of the keyframes
+
+Clients build it on first use with ffprobe. Only one process builds an index at a time; the
+others go without it meanwhile. Clients get no index (and grab every frame they skip) when
+ffprobe is unavailable, the video is not a file, e.g. a live stream, or the index cannot be
+written. build_all indexes videos ahead of experiments, grabbing frames once with OpenCV if
+ffprobe is unavailable, in which case only the first frame is known to be a keyframe.
+"""
+from __future__ import absolute_import, division, print_function
+
+import hashlib
+import os
+import subprocess
+import time
+
+import cv2
+import fire
+import numpy as np
+from logzero import logger
+
+from rmexp import config
+
+# a build lock older than this is left over by a dead builder
+LOCK_TIMEOUT_S = 600
+
+
+def index_path(video_fp, index_dir=None):
+    """Index file of video_fp. It changes when the video is modified."""
+    video_fp = os.path.abspath(video_fp)
+    stat = os.stat(video_fp)
+    key = hashlib.sha1('{}:{}:{}'.format(video_fp, stat.st_size, int(stat.st_mtime))).hexdigest()
+    return os.path.join(index_dir or config.VIDEO_INDEX_DIR,
+                        '{}-{}.npz'.format(os.path.basename(video_fp), key[:16]))
+
+
+def _probe_packets(video_fp):
+    """(pts, is_keyframe) of the video packets, with ffprobe. None if ffprobe fails."""
+    cmd = ['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+           '-show_entries', 'packet=pts_time,flags', '-of', 'csv=print_section=0', video_fp]
+    try:
+        output = subprocess.check_output(cmd)
+    except (OSError, subprocess.CalledProcessError) as e:
+        logger.warning('ffprobe failed on {}: {}'.format(video_fp, e))
+        return None
+    packets = []
+    for line in output.splitlines():
+        fields = line.strip().split(',')
+        if len(fields) < 2 or fields[0] in ('', 'N/A'):
+            continue
+        packets.append((float(fields[0]), 'K' in fields[1]))
+    return packets
+
+
+def _grab_packets(video_fp):
+    """(pts, is_keyframe) of the video frames, by grabbing them with OpenCV."""
+    cam = cv2.VideoCapture(video_fp)
+    packets = []
+    while cam.grab():
+        packets.append((cam.get(cv2.cv.CV_CAP_PROP_POS_MSEC) / 1000., len(packets) == 0))
+    cam.release()
+    return packets
+
+
+def _lock(path):
+    """Take the build lock of index path. False if another process holds it."""
+    lock_path = path + '.lock'
+    try:
+        if time.time() - os.path.getmtime(lock_path) > LOCK_TIMEOUT_S:
+            os.remove(lock_path)
+    except OSError:
+        pass
+    try:
+        os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except OSError:
+        return False
+    return True
+
+
+def build(video_fp, index_dir=None, overwrite=False, grab=True):
+    """Index the frames of video_fp. An existing index is kept unless overwrite is True.
+
+    Returns the index path, or None if there is no index: video_fp is not a file, ffprobe is
+    unavailable and grab is False, another process is building it, or it cannot be written.
+    """
+    if not os.path.isfile(video_fp):
+        return None
+    path = index_path(video_fp, index_dir)
+    if os.path.isfile(path) and not overwrite:
+        return path
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        locked = _lock(path)
+    except OSError as e:
+        logger.warning('cannot write the index of {} in {}: {}'.format(video_fp, path, e))
+        return None
+    if not locked:
+        logger.info('{} is being indexed by another process'.format(video_fp))
+        return None
+    try:
+        packets = _probe_packets(video_fp)
+        if packets is None and grab:
+            packets = _grab_packets(video_fp)
+        if not packets:
+            return None
+        # packets are in decoding order. frames are numbered in presentation order
+        packets.sort(key=lambda packet: packet[0])
+        pts = np.array([packet[0] for packet in packets], dtype=np.float64)
+        keyframes = np.array([idx for (idx, packet) in enumerate(packets) if packet[1]], dtype=np.int64)
+        if len(keyframes) == 0 or keyframes[0] != 0:
+            keyframes = np.insert(keyframes, 0, 0)
+        # readers must never see a partial index. write aside and move in place
+        tmp_path = '{}.{}.tmp.npz'.format(path[:-len('.npz')], os.getpid())
+        np.savez(tmp_path, pts=pts, keyframes=keyframes)
+        os.rename(tmp_path, path)
+    except (IOError, OSError) as e:
+        logger.warning('cannot write the index of {} in {}: {}'.format(video_fp, path, e))
+        return None
+    finally:
+        try:
+            os.remove(path + '.lock')
+        except OSError:
+            pass
+    logger.info('indexed {} ({} frames, {} keyframes) in {}'.format(
+        video_fp, len(pts), len(keyframes), path))
+    return path
+
+
+class VideoIndex(object):
+    """Frame timestamps and keyframes of a video."""
+
+    def __init__(self, path):
+        super(VideoIndex, self).__init__()
+        self.path = path
+        with np.load(path) as data:
+            self.pts = data['pts']
+            self.keyframes = data['keyframes']
+
+    def __len__(self):
+        return len(self.pts)
+
+    def keyframe_before(self, fid):
+        """The last keyframe at or before frame fid."""
+        return int(self.keyframes[np.searchsorted(self.keyframes, fid, side='right') - 1])
+
+
+def load(video_fp, index_dir=None):
+    """Load the index of video_fp, building it with ffprobe if there is none. None if there is no index."""
+    path = build(video_fp, index_dir, grab=False)
+    if path is None:
+        return None
+    try:
+        return VideoIndex(path)
+    except (IOError, OSError, KeyError, ValueError) as e:
+        logger.warning('cannot load the index of {} from {}: {}'.format(video_fp, path, e))
+        return None
+
+
+def build_all(*video_fps, **kwargs):
+    """(Re)build the indexes of videos ahead of experiments, e.g. build_all data/lego-trace/*/video.mp4
+
+    index_dir: defaults to VIDEO_INDEX_DIR
+    """
+    for video_fp in video_fps:
+        build(video_fp, kwargs.get('index_dir'), overwrite=True)
+
+
+if __name__ == '__main__':
+    fire.Fire()
@@ -11,7 +11,7 @@ import fire
 import numpy as np
 import pandas as pd
 from logzero import logger
-from rmexp import client, schema, utils, dbutils
+from rmexp import client, utils, dbutils
 from rmexp.schema import models
 
 
@@ -34,10 +34,9 @@ def interval_extract(list, slack=30):
 
 
 def get_trace_frames(app, trace_id):
-    df = pd.read_sql(
-        "select value from DataStat where app=%(app)s and trace=%(trace_id)s",
-        schema.engine,
-        params={'app': app, 'trace_id': trace_id}
+    df = dbutils.read_table(
+        models.DataStat, columns=['value'],
+        filters=[('app', '=', app), ('trace', '=', trace_id)]
     )
     datastat = json.loads(df['value'].iloc[0])
     total_frs = datastat['frames']
@@ -49,21 +48,15 @@ def get_ss_df(app, trace_id):
     By default, they are ordered as frame sequence.
     """
     name = '{}-tr{}'.format(app, trace_id)
-    df = pd.read_sql(
-        "select * from SS where name like %(name)s",
-        schema.engine,
-        params={'name': name}
-    )
+    df = dbutils.read_table(models.SS, filters=[('name', 'like', name)])
     # SS's database frame index somehow started from 1, this is to fix it
     df['index'] = df['index'].astype('int32') - 1
     return df
 
 
 def get_gt_active_df(app, trace_id):
-    df = pd.read_sql(
-        "select * from DutyCycleGT where name=%(app)s and trace=%(trace_id)s",
-        schema.engine,
-        params={'app': app, 'trace_id': trace_id}
+    df = dbutils.read_table(
+        models.DutyCycleGT, filters=[('name', '=', app), ('trace', '=', trace_id)]
     )
     df['index'] = df['index'].astype('int32')
     return df
@@ -200,10 +193,9 @@ def get_inst_idx(app, df):
 
 
 def get_gt_inst_idx(app, trace_id):
-    df = pd.read_sql(
-        "select value from GTInst where app=%(app)s and trace=%(trace_id)s",
-        schema.engine,
-        params={'app': app, 'trace_id': trace_id}
+    df = dbutils.read_table(
+        models.GTInst, columns=['value'],
+        filters=[('app', '=', app), ('trace', '=', trace_id)]
     )
     assert len(df.index) == 1
     datastat = json.loads(df['value'].iloc[0])
@@ -213,10 +205,9 @@ def get_gt_inst_idx(app, trace_id):
 
 
 def get_exp_app_inst_for_client(exp, app, client_id):
-    df = pd.read_sql(
-        "select * from ExpLatency where name=%(exp)s and app=%(app)s and client=%(client_id)s",
-        schema.engine,
-        params={'app': app, 'client_id': client_id, 'exp': exp}
+    df = dbutils.read_table(
+        models.ExpLatency,
+        filters=[('name', '=', exp), ('app', '=', app), ('client', '=', client_id)]
     )
     df['val'] = df['result']
     return get_inst_idx(app, df)
@@ -225,11 +216,9 @@ def get_exp_app_inst_for_client(exp, app, client_id):
 def get_exp_app_inst_delay_for_client(exp, app, client_id, trace_id):
     """Return the instruction delay in ms
     """
-    df = pd.read_sql(
-        "select * from ExpLatency where name=%(exp)s and app=%(app)s and client=%(client_id)s",
-        schema.engine,
-        params={'app': app, 'client_id': client_id,
-                'exp': exp}
+    df = dbutils.read_table(
+        models.ExpLatency,
+        filters=[('name', '=', exp), ('app', '=', app), ('client', '=', client_id)]
     )
     exp_inst_idx = get_exp_app_inst_for_client(exp, app, client_id)
     delays = []
@@ -261,11 +250,10 @@ def get_exp_app_inst_delay_for_client(exp, app, client_id, trace_id):
 
 
 def get_exp_app_inst_delay(exp, app):
-    df = pd.read_sql(
-        "select client, val from ExpLatency where name=%(exp)s and app=%(app)s group by client, val",
-        schema.engine,
-        params={'app': app, 'exp': exp}
-    )
+    df = dbutils.read_table(
+        models.ExpLatency, columns=['client', 'val'],
+        filters=[('name', '=', exp), ('app', '=', app)]
+    ).drop_duplicates()
     client_ids = df['client'].values.tolist()
     trace_ids = df['val'].values.tolist()
     delays = {}
@@ -279,6 +267,42 @@ def get_exp_app_inst_delay(exp, app):
     return delays
 
 
+def get_frame_filter_inst_delay(app, trace_id, sent):
+    """Delay of instructions, in ms, when a client-side frame filter drops frames of a trace.
+
+    sent: bool per frame of the trace, whether the filter sent it
+    Instructions are detected in the symbolic states of all frames and of the sent frames only,
+    running the app's FSM on them if it has one. Each instruction detected from all frames is
+    matched to the first instruction detected from the sent frames at or after it and before
+    the next one. Returns the delays and the number of instructions that were not matched.
+    """
+    from rmexp.client.emulator import app_fsm
+
+    sent = np.asarray(sent, dtype=bool)
+    ss_df = get_ss_df(app, trace_id)
+    ss_df = ss_df.sort_values('index')
+    keep = ss_df['index'].map(lambda idx: 0 <= idx < len(sent) and sent[idx]).values.astype(bool)
+
+    def _inst_idx(df):
+        df = df.copy()
+        if app_fsm[app] is not None:
+            df['val'] = run_fsm_on_ss_for_inst(app_fsm[app](), df).fillna('')
+        return get_inst_idx(app, df)
+
+    all_inst_idx = _inst_idx(ss_df)
+    sent_inst_idx = np.array(_inst_idx(ss_df[keep]))
+    delays = []
+    missed = 0
+    for (i, inst_idx) in enumerate(all_inst_idx):
+        next_inst_idx = all_inst_idx[i + 1] if i + 1 < len(all_inst_idx) else np.inf
+        matched = sent_inst_idx[(sent_inst_idx >= inst_idx) & (sent_inst_idx < next_inst_idx)]
+        if len(matched) == 0:
+            missed += 1
+            continue
+        delays.append((matched[0] - inst_idx) * 1000. / 30.)
+    return delays, missed
+
+
 def run_fsm_on_ss_for_inst(fsm, ss):
     """Run FSM with a sequence of CV symbolic states as inputs and get instructions.
     """
@@ -1,11 +1,16 @@
 
 from __future__ import absolute_import, division, print_function
 
+import collections
 import contextlib
 import functools
+import Queue
+import threading
+import time
 
+from logzero import logger
 from rmexp import config, schema
-from sqlalchemy import Column, DateTime, Integer, String, create_engine
+from sqlalchemy import Column, DateTime, Integer, String, create_engine, select
 from sqlalchemy.engine.url import URL
 from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 from sqlalchemy.ext.declarative import declarative_base
@@ -85,6 +90,225 @@ def insert_or_update_one(sess, model, keys_dict, vals_dict):
     return record
 
 
+class ResultSink(object):
+    """Writes records to the database, or to schema.store, in batches from a background thread.
+
+    insert and upsert only put a record in a bounded in-memory buffer, so they do not wait for
+    the database. A batch is written and committed when batch_size records are buffered or
+    flush_interval secs after its first record, so a crash loses at most the records of the
+    last flush_interval. If the buffer is full, e.g. the database is down, records are dropped
+    and counted in dropped, unless block_when_full is set for writers that must not lose records.
+    Batches that fail to be written are logged and counted in dropped too.
+    Upserts of a batch are written with one query for the existing rows of each model.
+    """
+    # buffer entries asking the writer to write everything buffered before them, and then
+    # to go on or to stop
+    _FLUSH, _STOP = 'flush', 'stop'
+    # secs between checks that the writer is alive while waiting for it
+    _POLL_INTERVAL = 1.
+
+    def __init__(self, session_factory=get_session, store=None, batch_size=1000, flush_interval=1.,
+                 max_buffer=100000, block_when_full=False):
+        """store: columnar.ColumnarStore to write to instead of the database. Defaults to schema.store."""
+        super(ResultSink, self).__init__()
+        self.block_when_full = block_when_full
+        self.session_factory = session_factory
+        self.store = store or schema.store
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self.written = 0
+        self._buffer = Queue.Queue(maxsize=max_buffer)
+        self._closed = False
+        self._writer = threading.Thread(target=self._write_loop)
+        self._writer.daemon = True
+        self._writer.start()
+
+    def insert(self, model, values):
+        """Insert a row of model with values, a dict of column values."""
+        self._put((model, None, values))
+
+    def upsert(self, model, keys, values):
+        """Set values on the row of model matching keys, like get_or_create, creating it if there is none."""
+        self._put((model, keys, values))
+
+    def _put(self, record):
+        assert not self._closed, 'sink is closed'
+        if self.block_when_full:
+            self._put_to_writer(record)
+            return
+        try:
+            self._buffer.put_nowait(record)
+        except Queue.Full:
+            if self.dropped == 0:
+                logger.warning('result sink buffer is full. dropping records')
+            self.dropped += 1
+
+    def flush(self):
+        """Wait until the records buffered so far are written."""
+        self._wait_for(self._FLUSH)
+
+    def close(self):
+        """Write the buffered records and stop the background writer."""
+        if self._closed:
+            return
+        self._closed = True
+        self._wait_for(self._STOP)
+        self._writer.join()
+        logger.info('result sink wrote {} records, dropped {}'.format(self.written, self.dropped))
+
+    def _check_writer(self):
+        if not self._writer.is_alive():
+            raise RuntimeError('result sink writer has stopped')
+
+    def _put_to_writer(self, record):
+        """Put record in the buffer, waiting for room while the writer is alive."""
+        while True:
+            self._check_writer()
+            try:
+                self._buffer.put(record, timeout=self._POLL_INTERVAL)
+                return
+            except Queue.Full:
+                pass
+
+    def _wait_for(self, marker):
+        done = threading.Event()
+        self._put_to_writer((marker, done))
+        while not done.wait(self._POLL_INTERVAL):
+            self._check_writer()
+
+    def _write_loop(self):
+        stop = False
+        while not stop:
+            batch, flushes = [], []
+            record = self._buffer.get()
+            deadline = time.time() + self.flush_interval
+            while True:
+                if record[0] in (self._FLUSH, self._STOP):
+                    flushes.append(record[1])
+                    stop = record[0] == self._STOP
+                    break
+                batch.append(record)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    record = self._buffer.get(timeout=max(0., deadline - time.time()))
+                except Queue.Empty:
+                    break
+            try:
+                if batch:
+                    self._write_batch(batch)
+            finally:
+                for done in flushes:
+                    done.set()
+
+    def _write_batch(self, batch):
+        try:
+            if self.store is not None:
+                self.store.write_batch(batch)
+            else:
+                self._write_session(batch)
+            self.written += len(batch)
+        except Exception:
+            # a bad batch must not stop the writer, which flushes and closes wait for
+            logger.exception('failed to write {} records'.format(len(batch)))
+            self.dropped += len(batch)
+
+    def _write_session(self, batch):
+        session = self.session_factory()
+        try:
+            inserts = collections.defaultdict(list)
+            # (model, key columns) --> key values --> row
+            upserts = collections.defaultdict(collections.OrderedDict)
+            for (model, keys, values) in batch:
+                if keys is None:
+                    inserts[model].append(values)
+                else:
+                    key_columns = tuple(sorted(keys))
+                    row = upserts[(model, key_columns)].setdefault(
+                        _key_values(model, key_columns, keys), dict(keys))
+                    row.update(values)
+            for ((model, key_columns), rows) in upserts.items():
+                bulk_upsert(session, model, key_columns, rows)
+            for (model, rows) in inserts.items():
+                session.bulk_insert_mappings(model, rows)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+
+def _key_values(model, key_columns, row):
+    # keys compare as the column type, e.g. an int index matches '1' in a String column
+    return tuple(model.__table__.c[column].type.python_type(row[column]) for column in key_columns)
+
+
+def bulk_upsert(sess, model, key_columns, rows):
+    """Upsert rows of model by key_columns with one query for the existing rows, like
+    insert_or_update_one for each row.
+
+    rows: dict of key values, as _key_values, to a dict of the columns of the row
+    """
+    table = model.__table__
+    query = sess.query(table.c.id, *[table.c[column] for column in key_columns])
+    for (idx, column) in enumerate(key_columns):
+        query = query.filter(table.c[column].in_(set(key[idx] for key in rows)))
+    existing = {}
+    for record in query:
+        existing.setdefault(_key_values(model, key_columns, dict(zip(key_columns, record[1:]))), record[0])
+    updates, inserts = [], []
+    for (key, row) in rows.items():
+        if key in existing:
+            updates.append(dict(row, id=existing[key]))
+        else:
+            inserts.append(row)
+    sess.bulk_update_mappings(model, updates)
+    sess.bulk_insert_mappings(model, inserts)
+
+
+def read_table(model, columns=None, filters=None, order_by=None):
+    """Read rows of model into a DataFrame, from the database or schema.store.
+
+    columns: names of the columns to read. All if None
+    filters: list of (column, op, value) that rows match, with op '=' or 'like'
+    order_by: name of a column to sort rows by
+    """
+    import pandas as pd
+
+    if schema.store is not None:
+        df = schema.store.read(model, columns=columns, filters=filters)
+        if order_by is not None:
+            df = df.sort_values(order_by).reset_index(drop=True)
+        return df
+
+    table = model.__table__
+    query = select([table.c[column] for column in columns] if columns is not None else [table])
+    for (column, op, value) in filters or []:
+        assert op in ('=', 'like'), 'unsupported filter op {}'.format(op)
+        query = query.where(table.c[column] == value if op == '=' else table.c[column].like(value))
+    if order_by is not None:
+        query = query.order_by(table.c[order_by])
+    return pd.read_sql(query, schema.engine)
+
+
+@contextlib.contextmanager
+def sink_scope(dry_run=False, **kwargs):
+    """Provide a ResultSink that is flushed when the scope exits, or None if dry_run.
+    To use:
+    with sink_scope() as sink:
+        sink.insert(models.ExpLatency, {...})
+    kwargs are passed to ResultSink.
+    """
+    sink = None if dry_run else ResultSink(**kwargs)
+    try:
+        yield sink
+    finally:
+        if sink is not None:
+            sink.close()
+
+
 class Connector(object):
     def __init__(self):
         self._engine = None
@@ -3,6 +3,8 @@
 from __future__ import absolute_import, division, print_function
 
 import datetime
+import heapq
+import itertools
 import logging
 import multiprocessing
 import os
@@ -12,14 +14,20 @@ import time
 import cv2
 import fire
 import logzero
+import zmq
 from lego import lego_cv
 from logzero import logger
 from rmexp import client, config, dbutils, gabriel_pb2, networkutil, utils
-from rmexp.client import emulator, dutycycle
-from rmexp.client.video import RTImageSequenceClient, RTVideoClient
+from rmexp.client import arrival, emulator, dutycycle, encoder, framefilter
+from rmexp.client.video import RTImageSequenceClient, RTVideoClient, parse_index
 from rmexp.schema import models
 from rmexp import app_utility_func
 
+# run_loop sends again once no reply has come for this long
+REPLY_TIMEOUT_MS = 5
+# clients do not sleep for less than this long (secs) to pace frames
+MIN_SLEEP = 1e-4
+
 # def start_single_feed(video_uri, fps, broker_type, broker_uri):
 #     from twisted.internet import reactor, task
 #     nc = networkutil.get_connector(broker_type, broker_uri)
@@ -32,25 +40,37 @@ from rmexp import app_utility_func
 #     reactor.run()
 
 
-def store_exp_latency(dbobj, gabriel_msg, util_fn, output):
+def get_reply_ms(gabriel_msg):
+    """End-to-end latency of a reply, from the capture of its frame until now"""
+    return int(1000 * (time.time() - gabriel_msg.timestamp))
+
+
+def store_exp_latency(dbobj, gabriel_msg, util_fn, reply_ms=None, encoding=None):
+    """Record the latency of a reply in ExpLatency through dbobj['sink'], a dbutils.ResultSink,
+    or print it if there is no sink.
+    encoding: (JPEG quality, scale) the frame was sent with, if the client adapts it
+    """
     exp, app, client_id, trace_id = dbobj['exp'], dbobj['app'], dbobj['client_id'], dbobj['trace_id']
 
-    reply_ms = int(1000 * (time.time() - gabriel_msg.timestamp))
+    if reply_ms is None:
+        reply_ms = get_reply_ms(gabriel_msg)
     arrival_ms = int(
         1000 * (gabriel_msg.arrival_ts - gabriel_msg.timestamp))
     finished_ms = int(
         1000 * (gabriel_msg.finished_ts - gabriel_msg.timestamp))
     utility = float(util_fn(reply_ms))
 
-    index = gabriel_msg.index.split('-')[1]
+    index = parse_index(gabriel_msg.index)[1]
 
-    if dbobj['sess'] is not None:
-        record = models.ExpLatency(
+    if dbobj['sink'] is not None:
+        record = dict(
             name=exp, index=index, app=app, client=str(client_id),
             arrival=arrival_ms, finished=finished_ms,
             reply=reply_ms, utility=utility, val=trace_id, result=gabriel_msg.data
         )
-        output.append(record)
+        if encoding is not None:
+            record['jpeg_quality'], record['scale'] = encoding
+        dbobj['sink'].insert(models.ExpLatency, record)
 
     else:
         print(
@@ -62,10 +82,34 @@ def store_exp_latency(dbobj, gabriel_msg, util_fn, output):
         gabriel_msg.index, reply_ms, gabriel_msg.data, utility))
 
 
+def get_sensor(vc):
+    """The client that captures and sends frames, i.e. the primary sensor of emulated devices"""
+    return vc.device.primary_sensor if isinstance(vc, emulator.DeviceToClientAdapter) else vc
+
+
+def process_reply(vc, r, dbobj=None, util_fn=None):
+    """Handle a reply r, as returned by nc.get, to a frame vc sent."""
+    (service, msg) = r
+    if service == 'NACK':
+        # the broker dropped the frame and returned our token
+        logger.debug("Frame NACKed by broker")
+        return
+    gabriel_msg = gabriel_pb2.Message()
+    gabriel_msg.ParseFromString(msg[0])
+    reply_ms = get_reply_ms(gabriel_msg)
+    encoding = None
+    encoder = get_sensor(vc).encoder
+    if encoder is not None:
+        encoder.add_latency(reply_ms)
+        encoding = encoder.pop_sent(gabriel_msg.index)
+    vc.process_reply(gabriel_msg)
+    if dbobj is not None:
+        store_exp_latency(dbobj, gabriel_msg, util_fn, reply_ms=reply_ms, encoding=encoding)
+
+
 def run_loop(vc, nc, tokens_cap, dbobj=None, util_fn=None, stop_after=None):
     start = time.time()
     tokens = tokens_cap
-    output = list()
 
     while True:
         if stop_after and time.time() - start > stop_after:
@@ -73,53 +117,211 @@ def run_loop(vc, nc, tokens_cap, dbobj=None, util_fn=None, stop_after=None):
             break
 
         while tokens > 0:
-            vc.get_and_send_frame(reply=True)
-            tokens -= 1
+            # frames dropped by the client's frame filter do not use a token
+            if vc.get_and_send_frame(reply=True):
+                tokens -= 1
 
         while True:
-            r = nc.get(timeout=5)
+            r = nc.get(timeout=REPLY_TIMEOUT_MS)
             if r is None:
                 break
             else:
                 tic = time.time()
-                (service, msg) = r
-                msg = msg[0]
                 tokens += 1
-                gabriel_msg = gabriel_pb2.Message()
-                gabriel_msg.ParseFromString(msg)
-                vc.process_reply(gabriel_msg)
-                if dbobj is not None:
-                    store_exp_latency(dbobj, gabriel_msg, util_fn, output)
-
+                process_reply(vc, r, dbobj=dbobj, util_fn=util_fn)
                 logger.debug("Took {} secs to from recv to finish processing reply. DB: {}".format(
                     time.time() - tic, bool(dbobj)))
 
-    if dbobj and 'sess' in dbobj:
-        sess = dbobj['sess']
-        logger.info("[pid {}] Committing changes to DB.".format(os.getpid()))
-        sess.add_all(output)
-        sess.commit()
-        logger.info("[pid {}] Commited".format(os.getpid()))
 
+class FeedClient(object):
+    """A token-based client driven by run_event_loop, taking the same steps as run_loop.
 
-def start_single_feed_token(video_uri,
-                            app,
-                            broker_type,
-                            broker_uri,
-                            tokens_cap,
-                            dutycycle_sampling_on=False,
-                            loop=True,
-                            random_start=True,
-                            exp='',
-                            client_id=0,
-                            client_type='video',
-                            print_only=False,
-                            stop_after=None):
-    if print_only:
-        logzero.loglevel(logging.CRITICAL)
-    nc = networkutil.get_connector(broker_type, broker_uri, client=True)
+    run_loop sleeps to pace frames and blocks waiting for replies. Here, those waits are
+    returned to the event loop as the time the client wants to run again, so that
+    many clients can share one thread.
+    """
+    SENDING, RECEIVING, DONE = 'sending', 'receiving', 'done'
+
+    def __init__(self, vc, nc, tokens_cap, dbobj=None, util_fn=None, stop_after=None, start_delay=0.):
+        """nc: ZmqMajorDomoConnector of the client
+        start_delay: secs to wait before sending the first frame
+        """
+        super(FeedClient, self).__init__()
+        self.vc = vc
+        self.nc = nc
+        self.tokens = tokens_cap
+        self.dbobj = dbobj
+        self.util_fn = util_fn
+        self.stop_after = stop_after
+        self.start_delay = start_delay
+        self.start = None
+        self.state = None
+        self.wake_at = None  # time of the client's pending timer
+        # devices pace samples, plain video clients pace frames
+        self._next_delay = getattr(vc, 'next_sample_delay', None) or vc.next_frame_delay
+
+    def _send_frame(self):
+        """Returns whether a frame was sent"""
+        if hasattr(self.vc, 'try_get_and_send_frame'):
+            return self.vc.try_get_and_send_frame(reply=True)
+        return self.vc.get_and_send_frame(reply=True)
+
+    def step(self, now):
+        """Run until the client has to wait. Returns when to call step again, or None when done."""
+        if self.state != self.SENDING:
+            if self.start is None:
+                self.start = now
+            if self.stop_after and now - self.start > self.stop_after:
+                logger.info("Time's up ({}). Exiting loop".format(self.stop_after))
+                self.state = self.DONE
+                return None
+            self.state = self.SENDING
+
+        while self.tokens > 0:
+            delay = self._next_delay()
+            if delay > MIN_SLEEP:
+                return time.time() + delay
+            if self._send_frame():
+                self.tokens -= 1
+
+        self.state = self.RECEIVING
+        return time.time() + REPLY_TIMEOUT_MS / 1000.
+
+    def receive(self):
+        """Take a reply waiting on the client's socket. Returns when to call step again."""
+        r = self.nc.get(timeout=0)
+        if r is not None:
+            self.tokens += 1
+            process_reply(self.vc, r, dbobj=self.dbobj, util_fn=self.util_fn)
+        return time.time() + REPLY_TIMEOUT_MS / 1000.
+
+
+class OpenLoopFeedClient(FeedClient):
+    """A client driven by run_event_loop that sends frames at the times of an arrival process.
+
+    Unlike FeedClient, it does not wait for replies before sending more, so the load it
+    offers does not drop when the broker falls behind. With a tokens_cap, it still holds
+    at most tokens_cap frames in flight, and arrivals without a token are dropped at the client.
+    Frames sent are the newest of the video at the time of the arrival.
+    """
+    # secs to take replies after the last arrival of a finite arrival process
+    DRAIN_SECS = 1.
+
+    def __init__(self, vc, nc, arrivals, tokens_cap=None, **kwargs):
+        """arrivals: iterator of secs between sends, see rmexp.client.arrival
+        tokens_cap: None to send at every arrival
+        """
+        assert hasattr(vc, 'get_and_send_latest_frame'), \
+            '{} can not send frames at arbitrary times'.format(type(vc))
+        super(OpenLoopFeedClient, self).__init__(vc, nc, tokens_cap, **kwargs)
+        self.arrivals = arrivals
+        self.next_arrival = None
+        self.sent = 0
+        self.dropped = 0
+        self.filtered = 0
+
+    def step(self, now):
+        if self.start is None:
+            self.start = now
+            self.next_arrival = now
+        if (self.stop_after and now - self.start > self.stop_after) or self.next_arrival is None:
+            logger.info("Sent {} frames, dropped {} arrivals without a token and {} by the frame filter. "
+                        "Exiting loop".format(self.sent, self.dropped, self.filtered))
+            self.state = self.DONE
+            return None
+
+        while self.next_arrival <= now:
+            if self.tokens is None or self.tokens > 0:
+                if not self.vc.get_and_send_latest_frame(reply=True):
+                    self.filtered += 1
+                else:
+                    self.sent += 1
+                    if self.tokens is not None:
+                        self.tokens -= 1
+            else:
+                self.dropped += 1
+            try:
+                # arrivals are spaced from the previous arrival, not from when it was handled
+                self.next_arrival += next(self.arrivals)
+            except StopIteration:
+                self.next_arrival = None
+                self.state = self.RECEIVING
+                return now + self.DRAIN_SECS
+        # replies are taken any time
+        self.state = self.RECEIVING
+        if self.stop_after:
+            return min(self.next_arrival, self.start + self.stop_after)
+        return self.next_arrival
+
+    def receive(self):
+        r = self.nc.get(timeout=0)
+        if r is not None:
+            if self.tokens is not None:
+                self.tokens += 1
+            process_reply(self.vc, r, dbobj=self.dbobj, util_fn=self.util_fn)
+        return self.wake_at
+
+
+def run_event_loop(clients):
+    """Run FeedClients in this thread until all of them are done.
+
+    Clients wait for replies on one poller and for frame pacing on one timer heap.
+    """
+    poller = zmq.Poller()
+    receiving = {}  # socket --> client waiting for replies on it
+    timers = []  # heap of (time, seq, client). Entries not matching client.wake_at are stale
+    seq = itertools.count()
+
+    def wake(client, at):
+        if at == client.wake_at:
+            return
+        client.wake_at = at
+        heapq.heappush(timers, (at, next(seq), client))
+
+    now = time.time()
+    for client in clients:
+        wake(client, now + client.start_delay)
+    running = len(clients)
+
+    while running:
+        timeout = max(0., 1000. * (timers[0][0] - time.time())) if timers else None
+        try:
+            events = poller.poll(timeout)
+        except KeyboardInterrupt:
+            break
+        for socket, _ in events:
+            client = receiving[socket]
+            wake(client, client.receive())
+
+        while timers and timers[0][0] <= time.time():
+            at, _, client = heapq.heappop(timers)
+            if at != client.wake_at:
+                continue
+            client.wake_at = None
+            at = client.step(time.time())
+            if client.state == client.RECEIVING:
+                if client.nc.socket not in receiving:
+                    receiving[client.nc.socket] = client
+                    poller.register(client.nc.socket, zmq.POLLIN)
+            elif client.nc.socket in receiving:
+                del receiving[client.nc.socket]
+                poller.unregister(client.nc.socket)
+            if at is None:
+                running -= 1
+            else:
+                wake(client, at)
+
+
+def make_client(video_uri, app, nc, client_type='video', dutycycle_sampling_on=False,
+                loop=True, random_start=True, frame_filter=False, adaptive_encoding=False):
+    """Create the emulated client of client_type sending frames of video_uri through nc.
+
+    frame_filter: if True, the client drops blurry and near-duplicate frames before sending them,
+    with the app's thresholds in framefilter.app_filter_params
+    adaptive_encoding: if True, the client lowers JPEG quality and resolution when replies are late,
+    within the app's bounds in encoder.app_encoding_bounds
+    """
     vc = None
-    time.sleep(random.random() * 10.0)
     if client_type == 'video':
         if os.path.isdir(video_uri):
             vc = RTImageSequenceClient(
@@ -176,12 +378,41 @@ def start_single_feed_token(video_uri,
         vc = emulator.DeviceToClientAdapter(device)
     else:
         raise ValueError('Not Supoprted client_type {}'.format(client_type))
+    if frame_filter:
+        get_sensor(vc).frame_filter = framefilter.make_frame_filter(app)
+    if adaptive_encoding:
+        get_sensor(vc).encoder = encoder.make_encoder(app)
+    return vc
+
+
+def start_single_feed_token(video_uri,
+                            app,
+                            broker_type,
+                            broker_uri,
+                            tokens_cap,
+                            dutycycle_sampling_on=False,
+                            loop=True,
+                            random_start=True,
+                            exp='',
+                            client_id=0,
+                            client_type='video',
+                            print_only=False,
+                            stop_after=None,
+                            frame_filter=False,
+                            adaptive_encoding=False):
+    if print_only:
+        logzero.loglevel(logging.CRITICAL)
+    nc = networkutil.get_connector(broker_type, broker_uri, client=True)
+    time.sleep(random.random() * 10.0)
+    vc = make_client(video_uri, app, nc, client_type=client_type,
+                     dutycycle_sampling_on=dutycycle_sampling_on, loop=loop, random_start=random_start,
+                     frame_filter=frame_filter, adaptive_encoding=adaptive_encoding)
     dbobj = None
     db_dry_run = bool(not exp or print_only)
-    with dbutils.session_scope(dry_run=db_dry_run) as sess:
+    with dbutils.sink_scope(dry_run=db_dry_run) as sink:
         trace_id = str(int(video_uri.rstrip('/').split('/')[-2]))
         dbobj = {
-            'sess': sess,
+            'sink': sink,
             'exp': exp,
             'client_id': client_id,
             'trace_id': trace_id,
@@ -211,5 +442,80 @@ def start(num, video_uri, app, broker_type, broker_uri, tokens_cap,
         map(lambda p: p.terminate(), procs)
 
 
+def start_event_loop_feeds(feeds, broker_type, broker_uri, exp='', print_only=False):
+    """Run many token-based clients in this process with run_event_loop.
+
+    feeds: list of dicts with the video_uri, app and tokens_cap of each client and
+    optionally its client_id, client_type, dutycycle_sampling_on, loop, random_start, stop_after,
+    frame_filter and adaptive_encoding.
+    Clients with an arrival, a dict for rmexp.client.arrival.make_arrivals, are open-loop.
+    If the arrival has mixed set, they still keep their tokens_cap.
+    Clients share one zmq context and one dbutils.ResultSink.
+    """
+    assert broker_type == 'zmq-md', 'the event loop feed needs a zmq-md broker'
+    if print_only:
+        logzero.loglevel(logging.CRITICAL)
+    ctx = zmq.Context()
+    db_dry_run = bool(not exp or print_only)
+    with dbutils.sink_scope(dry_run=db_dry_run) as sink:
+        clients = []
+        for feed in feeds:
+            video_uri, app = feed['video_uri'], feed['app']
+            nc = networkutil.get_connector(broker_type, broker_uri, client=True, ctx=ctx)
+            vc = make_client(video_uri, app, nc,
+                             client_type=feed.get('client_type', 'video'),
+                             dutycycle_sampling_on=feed.get('dutycycle_sampling_on', False),
+                             loop=feed.get('loop', True),
+                             random_start=feed.get('random_start', True),
+                             frame_filter=feed.get('frame_filter', False),
+                             adaptive_encoding=feed.get('adaptive_encoding', False))
+            dbobj = {
+                'sink': sink,
+                'exp': exp,
+                'client_id': feed.get('client_id', 0),
+                'trace_id': str(int(video_uri.rstrip('/').split('/')[-2])),
+                'app': app
+            }
+            kwargs = {
+                'dbobj': dbobj,
+                'util_fn': app_utility_func.func_dict[app],
+                'stop_after': feed.get('stop_after'),
+                'start_delay': random.random() * 10.0,
+            }
+            spec = feed.get('arrival')
+            if spec is None:
+                clients.append(FeedClient(vc, nc, feed['tokens_cap'], **kwargs))
+            else:
+                # mixed: open-loop arrivals, but keep the client's token cap
+                tokens_cap = feed['tokens_cap'] if spec.get('mixed', False) else None
+                clients.append(OpenLoopFeedClient(
+                    vc, nc, arrival.make_arrivals(spec), tokens_cap=tokens_cap, **kwargs))
+        logger.info("[pid {}] Running {} clients".format(os.getpid(), len(clients)))
+        run_event_loop(clients)
+    ctx.destroy(0)
+
+
+def start_event_loop(num, video_uri, app, broker_type, broker_uri, tokens_cap,
+                     loop=True, random_start=True, exp='', client_id=0, client_type='video',
+                     stop_after=None, arrival=None):
+    """Like start, but runs the num clients in this process instead of one process each.
+
+    arrival: dict for rmexp.client.arrival.make_arrivals to make the clients open-loop,
+    e.g. {'type': 'poisson', 'rate': 15}
+    """
+    feed = {
+        'video_uri': video_uri,
+        'app': app,
+        'tokens_cap': tokens_cap,
+        'loop': loop,
+        'random_start': random_start,
+        'client_id': client_id,
+        'client_type': client_type,
+        'stop_after': stop_after,
+        'arrival': arrival,
+    }
+    start_event_loop_feeds([feed] * num, broker_type, broker_uri, exp=exp)
+
+
 if __name__ == '__main__':
     fire.Fire()
@@ -22,6 +22,7 @@ import yaml
 
 # local
 import feed
+from rmexp.dataset import packedtrace
 
 DOCKER_IMAGE = 'res'
 CGROUP_INFO = {
@@ -89,15 +90,41 @@ def start_worker(app, num, docker_run_kwargs, busy_wait=None):
         raise
 
 
+def get_feed_video_uri(video_uri):
+    # forced convert video_uri to frame dir, packed if it has been packed
+    if not os.path.isdir(video_uri):
+        packed_uri = os.path.join(os.path.dirname(video_uri), packedtrace.PACKED_DNAME)
+        if packedtrace.is_packed_trace(packed_uri):
+            video_uri = packed_uri
+        else:
+            video_uri = os.path.join(os.path.dirname(video_uri), 'video-images')
+    return video_uri
+
+
 def start_feed(app, video_uri, tokens_cap, stop_after,
                random_start=False, client_type='video', dutycycle_sampling_on=False,
-               exp='', client_id=0):
-    # forced convert video_uri to frame dir
-    if not os.path.isdir(video_uri):
-        video_uri = os.path.join(os.path.dirname(video_uri), 'video-images')
+               exp='', client_id=0, arrival=None, frame_filter=False, adaptive_encoding=False):
+    video_uri = get_feed_video_uri(video_uri)
 
     logger.info('Starting client %d %s @ %s' % (client_id, app, video_uri))
 
+    if arrival is not None:
+        # open-loop clients only run in an event loop
+        feed.start_event_loop_feeds([{
+            'video_uri': video_uri,
+            'app': app,
+            'tokens_cap': tokens_cap,
+            'stop_after': stop_after,
+            'random_start': random_start,
+            'client_type': client_type,
+            'dutycycle_sampling_on': dutycycle_sampling_on,
+            'client_id': client_id,
+            'arrival': arrival,
+            'frame_filter': frame_filter,
+            'adaptive_encoding': adaptive_encoding,
+        }], os.getenv('BROKER_TYPE'), os.getenv('CLIENT_BROKER_URI'), exp=exp)
+        return
+
     try:
         feed.start_single_feed_token(
             video_uri,
@@ -111,13 +138,28 @@ def start_feed(app, video_uri, tokens_cap, stop_after,
             dutycycle_sampling_on=dutycycle_sampling_on,
             exp=exp,
             client_id=client_id,
-            stop_after=stop_after
+            stop_after=stop_after,
+            frame_filter=frame_filter,
+            adaptive_encoding=adaptive_encoding
         )
     except ValueError:
         logger.info("%s finished" % video_uri)
 
 
-def run(run_config, component, scheduler, exp='', dry_run=False, enable_dutycycleimu=False, **kwargs):
+def start_event_loop_feeds(feeds, exp=''):
+    """Run all feeds, a list of start_feed kwargs, in this process."""
+    feeds = [dict(kwargs, video_uri=get_feed_video_uri(kwargs['video_uri'])) for kwargs in feeds]
+    logger.info('Starting {} clients in one event loop'.format(len(feeds)))
+    feed.start_event_loop_feeds(
+        feeds,
+        os.getenv('BROKER_TYPE'),
+        os.getenv('CLIENT_BROKER_URI'),
+        exp=exp
+    )
+
+
+def run(run_config, component, scheduler, exp='', dry_run=False, enable_dutycycleimu=False,
+        feed_mode='process', **kwargs):
     """[summary]
 
     Arguments:
@@ -127,6 +169,15 @@ def run(run_config, component, scheduler, exp='', dry_run=False, enable_dutycycl
         exp {string} -- if not empty, will write latency to DB
         dry_run {bool} -- if true, only print scheduling results and not run processes
         enable_dutycycleimu {bool} -- if true, enable dutycycle and imu suppression on the client
+        feed_mode {string} -- 'process' runs each client in its own process,
+            'event' runs all clients in one process with feed.run_event_loop
+        run_config may have open-loop arrivals of each app's clients, e.g.
+            arrivals: {lego: {type: poisson, rate: 15}, face: {type: constant, rate: 10, mixed: true}}
+            See rmexp.client.arrival.make_arrivals. With mixed, clients still keep their tokens_cap.
+        run_config may set frame_filter to true, or to a list of apps, to have clients drop
+            blurry and near-duplicate frames before sending them (see rmexp.client.framefilter).
+        run_config may set adaptive_encoding to true, or to a list of apps, to have clients lower
+            JPEG quality and resolution when replies are late (see rmexp.client.encoder).
         **kwargs -- override values in run_config
     """
 
@@ -135,6 +186,8 @@ def run(run_config, component, scheduler, exp='', dry_run=False, enable_dutycycl
     assert component in [
         'client', 'server'], 'Component needs to be either client or server'
 
+    assert feed_mode in ['process', 'event'], 'feed_mode needs to be either process or event'
+
     # parse run_config
     if not isinstance(run_config, dict):
         run_config = yaml.load(open(run_config, 'r'))
@@ -193,13 +246,25 @@ def run(run_config, component, scheduler, exp='', dry_run=False, enable_dutycycl
                 call['kwargs']['dutycycle_sampling_on'] = False
             call['kwargs']['exp'] = exp
             call['kwargs']['stop_after'] = run_config.get('stop_after', None)
+            call['kwargs']['arrival'] = run_config.get('arrivals', {}).get(call['kwargs']['app'])
+            for option in ('frame_filter', 'adaptive_encoding'):
+                value = run_config.get(option, False)
+                call['kwargs'][option] = (call['kwargs']['app'] in value
+                                          if isinstance(value, list) else bool(value))
             logger.debug("start feed: {}".format(call))
 
-            if not dry_run:
+            if not dry_run and feed_mode == 'process':
                 feeds.append(mp.Process(
                     target=start_feed, args=call['args'], kwargs=call['kwargs']
                 ))
 
+        if not dry_run and feed_mode == 'event':
+            feeds.append(mp.Process(
+                target=start_event_loop_feeds,
+                args=([call['kwargs'] for call in start_feed_calls], ),
+                kwargs={'exp': exp}
+            ))
+
     if component == 'server':
 
         for call in start_worker_calls:
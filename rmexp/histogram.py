@@ -0,0 +1,144 @@
+"""Fixed-bucket latency histograms for instrumenting worker hot loops.
+
+Recording a sample is a bisect over a constant list of bucket bounds and a few integer updates,
+so histograms can stay on in production. Percentiles are reported as the upper bound
+of the bucket they fall in, i.e. with about 19% relative error.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import bisect
+import json
+import os
+import time
+
+# Upper bounds (ms) of the buckets. Four buckets per power of two, from 10 us to ~80 s.
+# Samples above the last bound fall into an overflow bucket.
+BUCKET_BOUNDS_MS = tuple(0.01 * 2 ** (i / 4.) for i in range(93))
+
+
+class LatencyHistogram(object):
+    """Histogram of latencies in ms over BUCKET_BOUNDS_MS."""
+
+    def __init__(self):
+        super(LatencyHistogram, self).__init__()
+        self.counts = [0] * (len(BUCKET_BOUNDS_MS) + 1)
+        self.count = 0
+        self.sum_ms = 0.
+        self.max_ms = 0.
+
+    def record(self, ms):
+        self.counts[bisect.bisect_left(BUCKET_BOUNDS_MS, ms)] += 1
+        self.count += 1
+        self.sum_ms += ms
+        if ms > self.max_ms:
+            self.max_ms = ms
+
+    def merge(self, other):
+        self.counts = [a + b for (a, b) in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.sum_ms += other.sum_ms
+        self.max_ms = max(self.max_ms, other.max_ms)
+
+    def percentile(self, p):
+        """Upper bound of the bucket holding the p-th percentile (0 < p <= 100), capped by max_ms."""
+        if self.count == 0:
+            return None
+        rank = p / 100. * self.count
+        seen = 0
+        for (idx, n) in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n > 0:
+                if idx < len(BUCKET_BOUNDS_MS):
+                    return min(BUCKET_BOUNDS_MS[idx], self.max_ms)
+                break
+        return self.max_ms
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum_ms': self.sum_ms,
+            'max_ms': self.max_ms,
+            # sparse, most stages only ever touch a handful of buckets
+            'counts': {str(idx): n for (idx, n) in enumerate(self.counts) if n > 0},
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        hist = cls()
+        for (idx, n) in d['counts'].items():
+            hist.counts[int(idx)] = n
+        hist.count = d['count']
+        hist.sum_ms = d['sum_ms']
+        hist.max_ms = d['max_ms']
+        return hist
+
+    def summary(self):
+        if self.count == 0:
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'mean_ms': round(self.sum_ms / self.count, 3),
+            'p50_ms': round(self.percentile(50), 3),
+            'p95_ms': round(self.percentile(95), 3),
+            'p99_ms': round(self.percentile(99), 3),
+            'max_ms': round(self.max_ms, 3),
+        }
+
+
+class StageStats(object):
+    """Latency histograms of named processing stages.
+
+    If dump_path is set, maybe_dump() rewrites it as JSON at most every dump_interval seconds.
+    The file is replaced atomically so that readers never see a partial dump.
+    """
+
+    def __init__(self, dump_path=None, dump_interval=10., **meta):
+        super(StageStats, self).__init__()
+        self.hists = {}
+        self.meta = meta
+        self.dump_path = dump_path
+        self.dump_interval = dump_interval
+        self._last_dump = time.time()
+
+    def record(self, stage, seconds):
+        hist = self.hists.get(stage)
+        if hist is None:
+            hist = self.hists.setdefault(stage, LatencyHistogram())
+        hist.record(seconds * 1000.)
+
+    def to_dict(self):
+        d = dict(self.meta)
+        d.update({
+            'pid': os.getpid(),
+            'ts': time.time(),
+            'stages': {stage: hist.to_dict() for (stage, hist) in self.hists.items()},
+        })
+        return d
+
+    def summary(self):
+        return {stage: hist.summary() for (stage, hist) in sorted(self.hists.items())}
+
+    def dump(self, path=None):
+        path = path or self.dump_path
+        tmp_path = '{}.tmp'.format(path)
+        with open(tmp_path, 'w') as f:
+            json.dump(self.to_dict(), f)
+        os.rename(tmp_path, path)
+        self._last_dump = time.time()
+
+    def maybe_dump(self):
+        if self.dump_path is not None and time.time() - self._last_dump >= self.dump_interval:
+            self.dump()
+
+
+def load_summary(*paths):
+    """Merge stage histograms dumped by StageStats and summarize each stage."""
+    merged = {}
+    for path in paths:
+        with open(path, 'r') as f:
+            d = json.load(f)
+        for (stage, hist_dict) in d['stages'].items():
+            merged.setdefault(stage, LatencyHistogram()).merge(
+                LatencyHistogram.from_dict(hist_dict))
+    return {stage: hist.summary() for (stage, hist) in sorted(merged.items())}
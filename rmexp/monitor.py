@@ -6,24 +6,48 @@ import time
 import fire
 from logzero import logger
 from rmexp import config, dbutils, gabriel_pb2, networkutil
+from rmexp.broker.mdcliapi2 import MajorDomoClient
 from rmexp.schema import models
 
 
 def start(broker_type, broker_uri):
     nc = networkutil.get_connector(
         broker_type, broker_uri, listen=True, group_id=config.MONITOR_GROUP)
-    sess = dbutils.get_session()
+    with dbutils.sink_scope() as sink:
+        while True:
+            msg = nc.get()
+            arrival_t = time.time()
+            gabriel_msg = gabriel_pb2.Message()
+            gabriel_msg.ParseFromString(msg)
+            sink.upsert(models.LegoLatency,
+                        {'name': config.EXP, 'index': gabriel_msg.index},
+                        {'capture': gabriel_msg.timestamp, 'arrival': arrival_t})
+            logger.debug('{} arrives at {}'.format(gabriel_msg.index, arrival_t))
+
+
+def broker_stats(broker_uri, service='', interval=None, timeout=2500):
+    """Print queue and worker metrics from a zmq-md broker's mmi.stats service.
+
+    Keyword Arguments:
+        service {str} -- Only report this service. All services if empty (default: {''})
+        interval {float} -- If set, keep polling every this many seconds (default: {None})
+        timeout {int} -- ms to wait for the broker's reply (default: {2500})
+    """
+    client = MajorDomoClient(broker_uri)
     while True:
-        msg = nc.get()
-        arrival_t = time.time()
-        gabriel_msg = gabriel_pb2.Message()
-        gabriel_msg.ParseFromString(msg)
-        record, _ = dbutils.get_or_create(sess, models.LegoLatency,
-                                          name=config.EXP, index=gabriel_msg.index)
-        record.capture = gabriel_msg.timestamp
-        record.arrival = arrival_t
-        sess.commit()
-        logger.debug('{} arrives at {}'.format(gabriel_msg.index, arrival_t))
+        client.send('mmi.stats', service)
+        reply = client.recv(timeout)
+        if reply is None:
+            logger.error('No reply from broker at {}'.format(broker_uri))
+            return
+        returncode = reply[1][0]
+        if returncode != '200':
+            logger.error('mmi.stats returned {} for service "{}"'.format(returncode, service))
+            return
+        print(reply[1][1])
+        if not interval:
+            break
+        time.sleep(interval)
 
 
 if __name__ == "__main__":
@@ -123,15 +123,18 @@ class ZmqMajorDomoConnector(object):
     def setup(cls, broker_uri, *args, **kwargs):
         pass
 
-    def __init__(self, uri, service=None, client=False, verbose=False, dormant=False, *args, **kwargs):
+    def __init__(self, uri, service=None, client=False, verbose=False, dormant=False, batch_size=1, pipeline_depth=1,
+                 ctx=None, *args, **kwargs):
         # client = True: client, otherwise worker
+        # ctx: zmq context shared by clients, or with an inproc broker
         self.client = client
         if self.client:
-            self.sock = MajorDomoClient(uri, verbose)
+            self.sock = MajorDomoClient(uri, verbose, ctx=ctx)
         else:
             assert service is not None
             self.sock = MajorDomoWorker(uri, service,
-                                        dormant=dormant, verbose=verbose)
+                                        dormant=dormant, verbose=verbose, batch_size=batch_size,
+                                        pipeline_depth=pipeline_depth, ctx=ctx)
 
         self.reply = None
 
@@ -150,6 +153,32 @@ class ZmqMajorDomoConnector(object):
         else:
             self.reply = msg   # defer sending
 
+    @property
+    def socket(self):
+        # client only. the socket replies arrive on, to poll many clients together
+        return self.sock.client
+
+    def get_batch(self):
+        # worker only
+        msgs = self.sock.recv_batch(self.reply)
+        self.reply = None
+        return msgs
+
+    def put_batch(self, msgs):
+        # worker only. one reply for each request of the last batch
+        self.reply = msgs   # defer sending
+
+    def poll(self, timeout=None):
+        # worker only. returns (reply_to, msg) or None
+        return self.sock.poll_request(timeout)
+
+    def reply_to(self, reply_to, msg):
+        # worker only. reply to a request returned by poll
+        self.sock.send_reply(reply_to, msg)
+
+    def add_wakeup_fd(self, fd):
+        self.sock.add_wakeup_fd(fd)
+
 
 class KafkaConnector(object):
     def __init__(self, uri, topic=None, listen=False, api_version=None, group_id=None):
@@ -16,7 +16,8 @@ import scipy.interpolate
 from logzero import logger
 from mpl_toolkits.mplot3d import Axes3D
 
-from rmexp import app_utility_func, schema
+from rmexp import app_utility_func, dbutils
+from rmexp.schema import models
 
 logzero.loglevel(logging.DEBUG)
 
@@ -103,12 +104,10 @@ class ProfileFuncFitter(object):
 
     def _get_df_by_latency(self):
         """Get dataframe by converting latency to utility frame by frame"""
-        df = pd.read_sql(
-            'select latency, cpu, memory, num_worker from ResourceLatency ' +
-            'where name=%(exp_name)s and trace like %(app)s',
-            schema.engine,
-            params={'app': self.app + '%',  # fuzzy match
-                    'exp_name': self.exp_name}
+        df = dbutils.read_table(
+            models.ResourceLatency, columns=['latency', 'cpu', 'memory', 'num_worker'],
+            filters=[('name', '=', self.exp_name),
+                     ('trace', 'like', self.app + '%')]  # fuzzy match
         )
         df['util'] = df['num_worker'] * (df['latency'].apply(self.l2u_func))
         return df
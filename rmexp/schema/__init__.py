@@ -2,12 +2,22 @@
 from sqlalchemy import create_engine, MetaData
 from sqlalchemy.ext.declarative import declarative_base
 from rmexp import config
+from rmexp.schema import columnar
 
 engine = None
+# columnar.ColumnarStore used instead of a database if DB_URI is parquet://<directory>
+store = None
 meta = MetaData()
 Base = declarative_base(metadata=meta)
 
-if config.DB_URI is not None:
+if config.DB_URI is not None and config.DB_URI.startswith(columnar.URI_PREFIX):
+    store = columnar.ColumnarStore(config.DB_URI[len(columnar.URI_PREFIX):])
+elif config.DB_URI is not None:
     engine = create_engine(config.DB_URI)
     meta = MetaData(engine)
     Base = declarative_base(metadata=meta)
+
+if engine is not None and engine.name == 'sqlite':
+    # small runs on a local file without the MySQL container and its migrations
+    from rmexp.schema import models
+    meta.create_all(engine)
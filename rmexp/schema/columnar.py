@@ -0,0 +1,263 @@
+"""Columnar store of the rmexp.schema models in Parquet files, used instead of a database
+when DB_URI is parquet://<directory>.
+
+A table is a directory <directory>/<__tablename__> partitioned by its name column (or app
+column if it has none), with one Parquet file per written batch:
+    <directory>/ExpLatency/name=<name>/part-<write stamp>-<pid>-<seq>.parquet
+Write stamps are microseconds since the epoch, increasing within a process, so file names
+sort in write order across processes. Files are written aside and moved in place, so
+readers never see partial files.
+
+Reads prune partitions and the row groups whose statistics exclude '=' filters, and only load
+the requested columns. Upserted tables are append-only too: each row also stores the columns
+it sets in SET_COLUMNS, and rows with the same UPSERT_KEYS are merged on read, taking the
+last value written for each column by a row that sets it.
+
+Needs pyarrow and pandas.
+"""
+from __future__ import absolute_import, division, print_function
+
+import datetime
+import itertools
+import os
+import re
+import time
+import urllib
+
+URI_PREFIX = 'parquet://'
+
+# key columns of the tables written with dbutils.ResultSink.upsert
+UPSERT_KEYS = {
+    'SS': ('name', 'index', 'trace'),
+    'LegoLatency': ('name', 'index'),
+    'Trace': ('name', 'trace', 'fid'),
+}
+
+PARTITION_COLUMNS = ('name', 'app')
+
+# comma-separated columns set by a row of an upserted table. Inserted rows set all columns
+SET_COLUMNS = '_set_columns'
+
+# last write stamp of this process
+_last_stamp = [0]
+
+
+def partition_column(model):
+    columns = model.__table__.c
+    for column in PARTITION_COLUMNS:
+        if column in columns:
+            return column
+    return None
+
+
+def _like_to_regex(pattern):
+    """Regex of a SQL LIKE pattern"""
+    return '^' + ''.join('.*' if c == '%' else '.' if c == '_' else re.escape(c) for c in pattern) + '$'
+
+
+def _arrow_type(column):
+    import pyarrow as pa
+    python_type = column.type.python_type
+    if python_type is int:
+        return pa.int64()
+    if python_type is float:
+        return pa.float64()
+    if python_type is datetime.datetime:
+        return pa.timestamp('us')
+    return pa.string()
+
+
+def _coerce(column, value):
+    """value as the column type, like the database does, e.g. '1' for an Integer column."""
+    python_type = column.type.python_type
+    if value is None or isinstance(value, python_type) or (python_type is str and isinstance(value, unicode)):
+        return value
+    return python_type(value)
+
+
+def _part_name(pid, seq):
+    """File name of a written batch. Names sort in write order."""
+    stamp = max(int(time.time() * 1e6), _last_stamp[0] + 1)
+    _last_stamp[0] = stamp
+    return 'part-{:020d}-{}-{:06d}.parquet'.format(stamp, pid, seq)
+
+
+def _stored_columns(model):
+    # ids are assigned by databases and mean nothing across files
+    return [column for column in model.__table__.c if not column.primary_key]
+
+
+def _default(column):
+    if column.default is None:
+        return None
+    if column.default.is_callable:
+        # sqlalchemy wraps callables to take an execution context
+        return column.default.arg(None)
+    return column.default.arg
+
+
+class ColumnarStore(object):
+    def __init__(self, path):
+        super(ColumnarStore, self).__init__()
+        self.path = path
+        self._seq = itertools.count()
+
+    def table_path(self, model):
+        return os.path.join(self.path, model.__tablename__)
+
+    def write_batch(self, batch):
+        """Append a batch of dbutils.ResultSink records, (model, keys, values), one file per partition."""
+        rows = {}  # (model, partition value) --> rows
+        for (model, keys, values) in batch:
+            if keys is not None:
+                assert tuple(sorted(keys)) == tuple(sorted(UPSERT_KEYS[model.__tablename__])), \
+                    '{} upserts by {}'.format(model.__tablename__, UPSERT_KEYS[model.__tablename__])
+                values = dict(values, **keys)
+                values[SET_COLUMNS] = ','.join(sorted(values))
+            column = partition_column(model)
+            rows.setdefault((model, values.get(column) if column else None), []).append(values)
+        for ((model, value), model_rows) in rows.items():
+            self._write(model, value, model_rows)
+
+    def _write(self, model, partition_value, rows):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        columns = _stored_columns(model)
+        arrays = []
+        for column in columns:
+            default = _default(column)
+            values = [_coerce(column, row.get(column.name, default)) for row in rows]
+            arrays.append(pa.array(values, type=_arrow_type(column)))
+        names = [column.name for column in columns]
+        if model.__tablename__ in UPSERT_KEYS:
+            all_columns = ','.join(sorted(names))
+            arrays.append(pa.array([row.get(SET_COLUMNS, all_columns) for row in rows], type=pa.string()))
+            names.append(SET_COLUMNS)
+        table = pa.Table.from_arrays(arrays, names=names)
+
+        dir_path = self.table_path(model)
+        column = partition_column(model)
+        if column is not None:
+            dir_path = os.path.join(dir_path, '{}={}'.format(column, urllib.quote(str(partition_value), safe='')))
+        tmp_dir = os.path.join(self.path, '.tmp')
+        for path in (dir_path, tmp_dir):
+            if not os.path.isdir(path):
+                try:
+                    os.makedirs(path)
+                except OSError:
+                    # made by another writer meanwhile
+                    pass
+        fname = _part_name(os.getpid(), next(self._seq))
+        tmp_path = os.path.join(tmp_dir, fname)
+        pq.write_table(table, tmp_path)
+        os.rename(tmp_path, os.path.join(dir_path, fname))
+
+    def _partition_dirs(self, model, filters):
+        """Directories of the partitions of model's table that can match filters"""
+        table_path = self.table_path(model)
+        if not os.path.isdir(table_path):
+            return []
+        column = partition_column(model)
+        if column is None:
+            return [table_path]
+        dirs = []
+        for dname in sorted(os.listdir(table_path)):
+            if not dname.startswith(column + '='):
+                continue
+            value = urllib.unquote(dname[len(column) + 1:])
+            if all(self._match(value, op, filter_value) for (filter_column, op, filter_value) in filters
+                   if filter_column == column):
+                dirs.append(os.path.join(table_path, dname))
+        return dirs
+
+    @staticmethod
+    def _match(value, op, filter_value):
+        if op == '=':
+            return value == str(filter_value)
+        return re.match(_like_to_regex(filter_value), value) is not None
+
+    @staticmethod
+    def _may_match(row_group, names, filters):
+        """Whether the statistics of a row group allow rows matching the '=' filters"""
+        for (column, op, value) in filters:
+            if op != '=' or column not in names:
+                continue
+            stats = row_group.column(names.index(column)).statistics
+            if stats is None or not getattr(stats, 'has_min_max', True):
+                continue
+            if value < stats.min or value > stats.max:
+                return False
+        return True
+
+    def read(self, model, columns=None, filters=None):
+        """DataFrame of the rows of model matching filters, a list of (column, op, value) with op
+        '=' or 'like', with the given columns.
+        """
+        import pandas as pd
+        import pyarrow.parquet as pq
+
+        table_columns = model.__table__.c
+        assert all(op in ('=', 'like') for (_, op, _) in filters or []), 'unsupported filter in {}'.format(filters)
+        filters = [(column, op, table_columns[column].type.python_type(value) if op == '=' else value)
+                   for (column, op, value) in filters or []]
+        upsert_keys = UPSERT_KEYS.get(model.__tablename__, ())
+        wanted = [column.name for column in _stored_columns(model)] if columns is None else list(columns)
+        # filter and key columns are needed to filter and merge rows
+        needed = list(wanted)
+        for column in [f[0] for f in filters] + list(upsert_keys) + ([SET_COLUMNS] if upsert_keys else []):
+            if column not in needed:
+                needed.append(column)
+        partition = partition_column(model)
+
+        frames = []
+        for dir_path in self._partition_dirs(model, filters):
+            for fname in sorted(os.listdir(dir_path)):
+                if not fname.endswith('.parquet'):
+                    continue
+                parquet_file = pq.ParquetFile(os.path.join(dir_path, fname))
+                names = parquet_file.schema.to_arrow_schema().names
+                # files written before a column was added do not have it
+                file_columns = [column for column in needed if column in names]
+                for idx in range(parquet_file.num_row_groups):
+                    if self._may_match(parquet_file.metadata.row_group(idx), names, filters):
+                        frames.append(parquet_file.read_row_group(idx, columns=file_columns).to_pandas())
+        if not frames:
+            return pd.DataFrame(columns=wanted)
+        df = pd.concat(frames, ignore_index=True)
+        for column in needed:
+            if column not in df.columns:
+                df[column] = None
+
+        for (column, op, value) in filters:
+            if column == partition:
+                continue
+            if op == '=':
+                df = df[df[column] == value]
+            else:
+                df = df[df[column].astype(str).str.match(_like_to_regex(value))]
+        if upsert_keys:
+            df = self._merge_upserts(model, df, list(upsert_keys), wanted)
+        return df[wanted].reset_index(drop=True)
+
+    @staticmethod
+    def _merge_upserts(model, df, keys, columns):
+        """One row per key with the last value written to each column by a row that sets it"""
+        # files written before SET_COLUMNS was stored set all columns
+        set_columns = df[SET_COLUMNS].fillna(','.join(sorted(c.name for c in _stored_columns(model))))
+        merged = df[keys].drop_duplicates()
+        # the first row of a key created it, with the defaults of the columns it did not set
+        created = ~df.duplicated(keys)
+        defaults = set(c.name for c in _stored_columns(model) if c.default is not None)
+        # few distinct sets of columns are written, e.g. one for each caller of upsert
+        sets = {value: value.split(',') for value in set_columns.unique()}
+        for column in columns:
+            if column in keys:
+                continue
+            setting = set_columns.isin([value for (value, names) in sets.items() if column in names])
+            if column in defaults:
+                setting |= created
+            setting = df[setting]
+            merged = merged.merge(setting[keys + [column]].drop_duplicates(keys, keep='last'),
+                                  on=keys, how='left')
+        return merged
@@ -21,6 +21,9 @@ class ExpLatency(Base):
     reply = Column(Integer)
     utility = Column(types.Float)
     result = Column(String(8192))
+    # encoding of the frame by clients adapting it to reply latency
+    jpeg_quality = Column(Integer)
+    scale = Column(types.Float)
 
 
 class LegoLatency(Base):
@@ -3,6 +3,10 @@ from __future__ import absolute_import, division, print_function
 
 import ast
 import collections
+import gc
+import glob
+import importlib
+import json
 import multiprocessing
 import os
 import time
@@ -12,7 +16,7 @@ import fire
 import numpy as np
 from logzero import logger
 
-from rmexp import config, worker
+from rmexp import config, histogram, worker, utils
 from rmexp import networkutil
 
 
@@ -27,19 +31,85 @@ class JobQueue(object):
     def put(self, msg):
         self.connector.put(msg)
 
+    def get_batch(self):
+        return self.connector.get_batch()
 
-def start_process_loop(broker_type, broker_uri, listen, tagged, app, busy_wait, dormant):
+    def put_batch(self, msgs):
+        self.connector.put_batch(msgs)
+
+    def poll(self, timeout=None):
+        return self.connector.poll(timeout)
+
+    def reply_to(self, reply_to, msg):
+        self.connector.reply_to(reply_to, msg)
+
+    def add_wakeup_fd(self, fd):
+        self.connector.add_wakeup_fd(fd)
+
+
+def start_process_loop(broker_type, broker_uri, listen, tagged, app, busy_wait, dormant, batch_size=1,
+                       pipeline_depth=1):
     nc = networkutil.get_connector(
         broker_type, broker_uri,
         listen=listen, tagged=tagged,
         group_id=config.WORKER_GROUP, service=app,
-        dormant=dormant
+        dormant=dormant, batch_size=batch_size, pipeline_depth=pipeline_depth
     )
     jq = JobQueue(nc)
-    worker.work_loop(jq, app, busy_wait=busy_wait)
+    if batch_size > 1:
+        worker.batch_work_loop(jq, app, busy_wait=busy_wait)
+    elif pipeline_depth > 1:
+        worker.pipelined_work_loop(
+            jq, app, busy_wait=busy_wait, pipeline_depth=pipeline_depth)
+    else:
+        worker.work_loop(jq, app, busy_wait=busy_wait)
+
 
+def preload_app(app):
+    """Import the app and build its read-only model state in the current process.
 
-def start(num, broker_type, broker_uri, app='lego', listen=False, tagged=True, busy_wait=None, dormant=False):
+    Workers forked afterwards share these pages copy-on-write instead of each loading their own copy.
+    Apps that load models in Handler() can expose a module level preload() to load them ahead of time.
+    """
+    app_module = importlib.import_module(app)
+    if hasattr(app_module, 'preload'):
+        app_module.preload()
+    # objects freed now would otherwise be written to by every worker's first collection
+    gc.collect()
+    logger.info('[pid {}] preloaded {}'.format(os.getpid(), app))
+
+
+def stats(*paths):
+    """Print p50/p95/p99 of each worker stage, merged over stats files dumped by workers.
+
+    Directories are expanded to the worker-*.json files in them. Defaults to config.WORKER_STATS_DIR.
+    """
+    paths = paths or (config.WORKER_STATS_DIR,)
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, 'worker-*.json'))))
+        else:
+            files.append(path)
+    summary = histogram.load_summary(*files)
+    for stage in sorted(summary):
+        logger.info('{:<32} {}'.format(stage, json.dumps(summary[stage], sort_keys=True)))
+    return summary
+
+
+def memory(*pids):
+    """Print RSS, PSS and USS (KB) of each process and their total."""
+    total = collections.Counter()
+    for pid in pids:
+        usage = utils.get_memory_usage(pid)
+        total.update(usage)
+        logger.info('[pid {}] rss {rss} KB, pss {pss} KB, uss {uss} KB'.format(pid, **usage))
+    logger.info('[total] rss {rss} KB, pss {pss} KB, uss {uss} KB'.format(**total))
+    return dict(total)
+
+
+def start(num, broker_type, broker_uri, app='lego', listen=False, tagged=True, busy_wait=None, dormant=False,
+          batch_size=1, pipeline_depth=1, prefork=False, memory_report_interval=None):
     """[summary]
 
     Arguments:
@@ -50,12 +120,27 @@ def start(num, broker_type, broker_uri, app='lego', listen=False, tagged=True, b
     Keyword Arguments:
         listen {bool} -- [description] (default: {True})
         tagged {bool} -- Used to distinguish whether zmq packet are tagged or not.
+        batch_size {int} -- Max number of frames a worker gets from the broker at once. zmq-md only. (default: {1})
+        pipeline_depth {int} -- Max number of frames in flight at a worker. If > 1, frames are
+            received and decoded while the previous one is processed. zmq-md only. (default: {1})
+        prefork {bool} -- Load the app once before forking workers so that they share model memory (default: {False})
+        memory_report_interval {float} -- If set, log workers' memory usage every this many seconds (default: {None})
     """
 
+    assert batch_size == 1 or pipeline_depth == 1, 'batching and pipelining cannot be combined'
     networkutil.setup_broker(broker_type, broker_uri, num_worker=num,)
+    if config.WORKER_STATS_DIR and not os.path.isdir(config.WORKER_STATS_DIR):
+        os.makedirs(config.WORKER_STATS_DIR)
+    if prefork:
+        preload_app(app)
     procs = [multiprocessing.Process(target=start_process_loop, args=(
-        broker_type, broker_uri, listen, tagged, app, busy_wait, dormant)) for i in range(num)]
+        broker_type, broker_uri, listen, tagged, app, busy_wait, dormant, batch_size, pipeline_depth))
+        for i in range(num)]
     map(lambda proc: proc.start(), procs)
+    if memory_report_interval:
+        while any([proc.is_alive() for proc in procs]):
+            time.sleep(memory_report_interval)
+            memory(*[proc.pid for proc in procs if proc.is_alive()])
     map(lambda proc: proc.join(), procs)
 
 
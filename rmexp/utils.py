@@ -59,3 +59,29 @@ class NumpyCompatibleEncoder(json.JSONEncoder):
         if isinstance(obj, np.ndarray):
             return obj.tolist()
         return json.JSONEncoder.default(self, obj)
+
+
+def get_memory_usage(pid):
+    """Memory usage of a process in KB from /proc/<pid>/smaps.
+
+    rss: resident set size
+    pss: proportional set size, shared pages are divided among the processes sharing them
+    uss: unique set size, pages private to the process
+    """
+    fpath = '/proc/{}/smaps_rollup'.format(pid)
+    if not os.path.exists(fpath):
+        fpath = '/proc/{}/smaps'.format(pid)
+    usage = {'rss': 0, 'pss': 0, 'uss': 0}
+    with open(fpath, 'r') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) < 2 or not fields[0].endswith(':'):
+                continue
+            key, value = fields[0][:-1], fields[1]
+            if key == 'Rss':
+                usage['rss'] += int(value)
+            elif key == 'Pss':
+                usage['pss'] += int(value)
+            elif key in ('Private_Clean', 'Private_Dirty'):
+                usage['uss'] += int(value)
+    return usage
@@ -1,8 +1,11 @@
 from __future__ import absolute_import, division, print_function
 
+import fcntl
 import json
 import logging
 import os
+import Queue
+import threading
 import time
 import importlib
 import multiprocessing
@@ -13,7 +16,8 @@ import logzero
 from logzero import logger
 import numpy as np
 
-from rmexp import config, cvutils, dbutils, gabriel_pb2, client
+from rmexp import config, cvutils, dbutils, gabriel_pb2, client, histogram
+from rmexp.client import video
 from rmexp.schema import models
 
 logzero.formatter(logging.Formatter(
@@ -21,6 +25,74 @@ logzero.formatter(logging.Formatter(
 logzero.loglevel(logging.DEBUG)
 
 
+def _get_stream_id(gabriel_msg):
+    """Clients index frames as <client stream id>-<frame id>."""
+    return video.parse_index(gabriel_msg.index)[0]
+
+
+def _process(handler, img, stream_id):
+    """Pass client stream id to handlers that keep per-stream state."""
+    if getattr(handler, 'per_stream_state', False):
+        return handler.process(img, stream_id=stream_id)
+    return handler.process(img)
+
+
+def _process_batch(handler, imgs, stream_ids):
+    """Let handlers that support batching process all frames at once."""
+    if hasattr(handler, 'process_batch'):
+        return handler.process_batch(imgs)
+    return [_process(handler, img, stream_id) for (img, stream_id) in zip(imgs, stream_ids)]
+
+
+def _busy_wait(seconds):
+    tic = time.time()
+    while True:
+        if time.time() - tic > seconds:
+            break
+    return 'busy wait {}'.format(seconds)
+
+
+def _get_decode_max_wh(app_module):
+    """Apps declare the max(width, height) they work at as WORKING_MAX_WH."""
+    if not config.REDUCED_DECODE:
+        return None
+    return getattr(app_module, 'WORKING_MAX_WH', None)
+
+
+def _decode(gabriel_msg, max_wh=None):
+    return cvutils.decode_jpeg(gabriel_msg.data, max_wh=max_wh)
+
+
+def _make_stage_stats(app, app_module):
+    """Latency histograms of this worker's processing stages.
+
+    Stages that the app profiles with config.profile are recorded as process.<function name>.
+    Histograms are dumped to config.WORKER_STATS_DIR, if set, every config.WORKER_STATS_INTERVAL seconds.
+    """
+    dump_path = None
+    if config.WORKER_STATS_DIR:
+        dump_path = os.path.join(
+            config.WORKER_STATS_DIR, 'worker-{}.json'.format(os.getpid()))
+    stats = histogram.StageStats(
+        dump_path=dump_path, dump_interval=config.WORKER_STATS_INTERVAL, app=app)
+    app_config = getattr(app_module, 'config', None)
+    if hasattr(app_config, 'STAGE_RECORDERS'):
+        app_config.STAGE_RECORDERS.append(
+            lambda name, seconds: stats.record('process.' + name, seconds))
+    return stats
+
+
+def _make_reply(gabriel_msg, result, arrival_ts, finished_ts, cpu_proc_ms):
+    reply = gabriel_pb2.Message()
+    reply.data = str(result)
+    reply.timestamp = gabriel_msg.timestamp
+    reply.index = gabriel_msg.index
+    reply.finished_ts = finished_ts
+    reply.arrival_ts = arrival_ts
+    reply.cpu_proc_ms = cpu_proc_ms
+    return reply.SerializeToString()
+
+
 def work_loop(job_queue, app, busy_wait=None):
     """[summary]
 
@@ -30,22 +102,30 @@ def work_loop(job_queue, app, busy_wait=None):
 
     Keyword Arguments:
         busy_wait {float} -- if not None, busy spin seconds instead of running actual app (default: {None})
+
+    Records the latency of the get, parse, decode, process, serialize stages
+    and their total in per-stage histograms (see _make_stage_stats).
     """
-    handler = importlib.import_module(app).Handler()
+    app_module = importlib.import_module(app)
+    handler = app_module.Handler()
+    decode_max_wh = _get_decode_max_wh(app_module)
+    stats = _make_stage_stats(app, app_module)
 
     while True:
         get_ts = time.time()
         msg = job_queue.get()[0]
-        get_wait = time.time() - get_ts
+        arrival_ts = time.time()
+        get_wait = arrival_ts - get_ts
+        stats.record('get', get_wait)
         if get_wait > 2e-3:
             logger.warn("[pid {}] took {} ms to get a new request. Maybe waiting".format(
                 os.getpid(), int(1000 * get_wait)))
 
-        arrival_ts = time.time()
-
         gabriel_msg = gabriel_pb2.Message()
         gabriel_msg.ParseFromString(msg)
-        encoded_im, ts = gabriel_msg.data, gabriel_msg.timestamp
+        ts = gabriel_msg.timestamp
+        parsed_ts = time.time()
+        stats.record('parse', parsed_ts - arrival_ts)
 
         logger.debug("[pid {}] about to process frame {}".format(
             os.getpid(), gabriel_msg.index))
@@ -53,35 +133,174 @@ def work_loop(job_queue, app, busy_wait=None):
         cts = time.clock()
         if not busy_wait:
             # do real work
-            encoded_im_np = np.frombuffer(encoded_im, dtype=np.uint8)
-            img = cv2.imdecode(encoded_im_np, cv2.CV_LOAD_IMAGE_UNCHANGED)
-            result = handler.process(img)
+            img = _decode(gabriel_msg, decode_max_wh)
+            decoded_ts = time.time()
+            stats.record('decode', decoded_ts - parsed_ts)
+            result = _process(handler, img, _get_stream_id(gabriel_msg))
         else:
             # busy wait fixed time
-            tic = time.time()
-            while True:
-                if time.time() - tic > busy_wait:
-                    break
-            result = 'busy wait {}'.format(busy_wait)
+            decoded_ts = parsed_ts
+            result = _busy_wait(busy_wait)
 
         finished_ts = time.time()
+        stats.record('process', finished_ts - decoded_ts)
         time_lapse = (finished_ts - ts) * 1000
         cpu_proc_ms = round((time.clock() - cts) * 1000)
 
         if gabriel_msg.reply:
-            reply = gabriel_pb2.Message()
-            reply.data = str(result)
-            reply.timestamp = gabriel_msg.timestamp
-            reply.index = gabriel_msg.index
-            reply.finished_ts = finished_ts
-            reply.arrival_ts = arrival_ts
-            reply.cpu_proc_ms = cpu_proc_ms
-            job_queue.put([reply.SerializeToString(), ])
+            reply = _make_reply(
+                gabriel_msg, result, arrival_ts, finished_ts, cpu_proc_ms)
+            stats.record('serialize', time.time() - finished_ts)
+            job_queue.put([reply, ])
+        stats.record('total', time.time() - arrival_ts)
+        stats.maybe_dump()
 
         logger.debug('[pid {}] takes {} ms (cpu: {} ms) for frame {}: {}.'.format(
             os.getpid(), (time.time() - ts) * 1000, cpu_proc_ms, gabriel_msg.index, result))
 
 
+def batch_work_loop(job_queue, app, busy_wait=None):
+    """Same as work_loop, but gets a batch of frames from the job queue at a time.
+
+    Handlers that have a process_batch method process the whole batch at once.
+    Replies report each frame's share of the batch CPU time as cpu_proc_ms.
+    Stage latencies are recorded per batch.
+    """
+    app_module = importlib.import_module(app)
+    handler = app_module.Handler()
+    decode_max_wh = _get_decode_max_wh(app_module)
+    stats = _make_stage_stats(app, app_module)
+
+    while True:
+        get_ts = time.time()
+        msgs = job_queue.get_batch()
+        arrival_ts = time.time()
+        stats.record('get', arrival_ts - get_ts)
+
+        gabriel_msgs = []
+        for msg in msgs:
+            gabriel_msg = gabriel_pb2.Message()
+            gabriel_msg.ParseFromString(msg)
+            gabriel_msgs.append(gabriel_msg)
+        parsed_ts = time.time()
+        stats.record('parse', parsed_ts - arrival_ts)
+
+        logger.debug("[pid {}] about to process {} frames {}".format(
+            os.getpid(), len(gabriel_msgs), [m.index for m in gabriel_msgs]))
+
+        cts = time.clock()
+        if not busy_wait:
+            imgs = [_decode(gabriel_msg, decode_max_wh) for gabriel_msg in gabriel_msgs]
+            decoded_ts = time.time()
+            stats.record('decode', decoded_ts - parsed_ts)
+            results = _process_batch(
+                handler, imgs, [_get_stream_id(gabriel_msg) for gabriel_msg in gabriel_msgs])
+        else:
+            decoded_ts = parsed_ts
+            results = [_busy_wait(busy_wait)] * len(gabriel_msgs)
+
+        finished_ts = time.time()
+        stats.record('process', finished_ts - decoded_ts)
+        cpu_proc_ms = round((time.clock() - cts) * 1000 / len(gabriel_msgs))
+
+        replies = [
+            _make_reply(gabriel_msg, result, arrival_ts, finished_ts, cpu_proc_ms)
+            if gabriel_msg.reply else None
+            for (gabriel_msg, result) in zip(gabriel_msgs, results)]
+        stats.record('serialize', time.time() - finished_ts)
+        job_queue.put_batch(replies)
+        stats.record('total', time.time() - arrival_ts)
+        stats.maybe_dump()
+
+        logger.debug('[pid {}] takes {} ms (cpu: {} ms/frame) for {} frames.'.format(
+            os.getpid(), (finished_ts - arrival_ts) * 1000, cpu_proc_ms, len(gabriel_msgs)))
+
+
+def pipelined_work_loop(job_queue, app, busy_wait=None, pipeline_depth=2):
+    """Same as work_loop, but receives and decodes frames while the previous one is processed.
+
+    The calling thread owns the job queue. It receives up to pipeline_depth frames,
+    decodes them, and sends replies back. A second thread runs the handler on decoded frames
+    one at a time, so that handlers that release the GIL overlap with I/O and decoding.
+    arrival_ts is still when a frame is received and finished_ts when its processing finishes.
+    cpu_proc_ms is measured with time.clock(), which also counts decoding overlapping with processing.
+    Besides the stages of work_loop, the time decoded frames wait for the processing thread is recorded as queue.
+    """
+    app_module = importlib.import_module(app)
+    handler = app_module.Handler()
+    decode_max_wh = _get_decode_max_wh(app_module)
+    stats = _make_stage_stats(app, app_module)
+    decoded = Queue.Queue()
+    processed = Queue.Queue()
+    # the processing thread wakes up the receiving thread's poll by writing to this pipe
+    wakeup_r, wakeup_w = os.pipe()
+    fcntl.fcntl(wakeup_r, fcntl.F_SETFL, os.O_NONBLOCK)
+    job_queue.add_wakeup_fd(wakeup_r)
+
+    def process_loop():
+        while True:
+            reply_to, gabriel_msg, img, arrival_ts, decoded_ts = decoded.get()
+            start_ts = time.time()
+            stats.record('queue', start_ts - decoded_ts)
+            cts = time.clock()
+            if not busy_wait:
+                result = _process(handler, img, _get_stream_id(gabriel_msg))
+            else:
+                result = _busy_wait(busy_wait)
+            finished_ts = time.time()
+            stats.record('process', finished_ts - start_ts)
+            cpu_proc_ms = round((time.clock() - cts) * 1000)
+            reply = None
+            if gabriel_msg.reply:
+                reply = _make_reply(
+                    gabriel_msg, result, arrival_ts, finished_ts, cpu_proc_ms)
+                stats.record('serialize', time.time() - finished_ts)
+            processed.put((reply_to, reply, arrival_ts))
+            os.write(wakeup_w, 'x')
+            logger.debug('[pid {}] takes {} ms (cpu: {} ms) for frame {}: {}.'.format(
+                os.getpid(), (finished_ts - gabriel_msg.timestamp) * 1000, cpu_proc_ms,
+                gabriel_msg.index, result))
+
+    process_thread = threading.Thread(target=process_loop)
+    process_thread.daemon = True
+    process_thread.start()
+
+    while True:
+        request = job_queue.poll()
+        if request is not None:
+            arrival_ts = time.time()
+            reply_to, msg = request
+            gabriel_msg = gabriel_pb2.Message()
+            gabriel_msg.ParseFromString(msg[0])
+            parsed_ts = time.time()
+            stats.record('parse', parsed_ts - arrival_ts)
+            img = None
+            decoded_ts = parsed_ts
+            if not busy_wait:
+                img = _decode(gabriel_msg, decode_max_wh)
+                decoded_ts = time.time()
+                stats.record('decode', decoded_ts - parsed_ts)
+            logger.debug("[pid {}] decoded frame {}. {} frames waiting".format(
+                os.getpid(), gabriel_msg.index, decoded.qsize()))
+            decoded.put((reply_to, gabriel_msg, img, arrival_ts, decoded_ts))
+        else:
+            try:
+                os.read(wakeup_r, 4096)
+            except OSError:
+                # woken up by a heartbeat or timeout
+                pass
+
+        while True:
+            try:
+                reply_to, reply, arrival_ts = processed.get_nowait()
+            except Queue.Empty:
+                break
+            if reply is not None:
+                job_queue.reply_to(reply_to, [reply, ])
+            stats.record('total', time.time() - arrival_ts)
+        stats.maybe_dump()
+
+
 class Sampler(object):
     """A Class to sample video stream. Designed to work with cam.read().
     Sample once every sample_period calls
@@ -111,29 +330,25 @@ def process_and_time(img, app_handler):
 
 def store(
         data,
-        session,
+        sink,
         store_result,
         store_latency,
         store_profile,
         **kwargs):
+    """Store the result and latency of a frame through sink, a dbutils.ResultSink."""
     name, trace, idx, result, time_lapse = data
     if store_result:
-        rec, _ = dbutils.get_or_create(
-            session,
+        sink.upsert(
             models.SS,
-            name=name,
-            index=idx,
-            trace=trace)
-        rec.val = str(result)
+            {'name': name, 'index': idx, 'trace': trace},
+            {'val': str(result)})
     if store_latency:
-        rec, _ = dbutils.get_or_create(
-            session,
+        sink.upsert(
             models.LegoLatency,
-            name=name,
-            index=idx)
-        rec.val = int(time_lapse)
+            {'name': name, 'index': idx},
+            {'val': int(time_lapse)})
     if store_profile:
-        rec = kwargs
+        rec = dict(kwargs)
         rec.update(
             {'trace': trace,
              'index': idx,
@@ -141,8 +356,7 @@ def store(
              'latency': time_lapse
              }
         )
-        dbutils.insert(
-            session,
+        sink.insert(
             models.ResourceLatency,
             rec
         )
@@ -181,7 +395,7 @@ def batch_process(video_uri,
         app.__name__, video_uri, None, loop=False, random_start=False)
 
     idx = 1
-    with dbutils.session_scope() as session:
+    with dbutils.sink_scope() as sink:
         for img in vc.get_frame_generator():
             cpu_time_ts = time.clock()
             result, time_lapse = process_and_time(img, app_handler)
@@ -190,7 +404,7 @@ def batch_process(video_uri,
             logger.debug(result)
             store(
                 (experiment_name, trace, idx, result, time_lapse),
-                session,
+                sink,
                 store_result,
                 store_latency,
                 store_profile,
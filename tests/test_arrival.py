@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+
+"""Make sure open-loop arrival processes offer the load they are configured for."""
+
+import itertools
+import random
+
+import pytest
+
+from rmexp.client import arrival
+
+
+@pytest.mark.parametrize('arrival_type', ['poisson', 'constant'])
+def test_rate(arrival_type):
+    arrivals = arrival.make_arrivals({'type': arrival_type, 'rate': 20}, rng=random.Random(0))
+    gaps = list(itertools.islice(arrivals, 20000))
+    assert abs(len(gaps) / sum(gaps) - 20) < 0.5
+
+
+def test_replay():
+    timestamps = [10., 10.5, 10.75, 12.]
+    gaps = list(arrival.make_arrivals({'type': 'replay', 'timestamps': timestamps, 'loop': False}))
+    assert gaps == [0., .5, .25, 1.25]
+    looped = list(itertools.islice(arrival.make_arrivals(
+        {'type': 'replay', 'timestamps': timestamps, 'speedup': 2.}), 8))
+    assert looped == [0., .25, .125, .625, 1. / 3, .25, .125, .625]
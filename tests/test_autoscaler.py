@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+"""Make sure the predictive autoscaler tracks load without oscillating, in simulated time."""
+
+import math
+
+import pytest
+
+from rmexp import benchmark
+from rmexp.broker import mdbroker
+
+RATES = (5, 25, 10, 40, 15)
+PHASE_S = 40
+SERVICE_MS = 100.
+EXPECTED_LATENCY_MS = 300.
+
+
+def _simulate(service_type, seed):
+    latencies, active = benchmark._simulate_autoscaler(
+        service_type, 8, SERVICE_MS, RATES, PHASE_S, EXPECTED_LATENCY_MS, seed=seed)
+    return latencies, active, benchmark._autoscaler_stats(latencies, active, EXPECTED_LATENCY_MS)
+
+
+@pytest.mark.parametrize('seed', range(2))
+def test_hysteresis_reduces_oscillation(seed):
+    _, _, stats = _simulate('predictive', seed)
+    _, _, no_hysteresis_stats = _simulate('predictive-no-hysteresis', seed)
+    assert stats['reversals'] * 10 < no_hysteresis_stats['reversals']
+    assert stats['scaling_actions'] <= 4 * len(RATES)
+    assert stats['slo_violations'] < 0.01
+
+
+def test_pool_follows_load():
+    _, active, stats = _simulate('predictive', 0)
+    reactive_stats = _simulate('adaptive', 0)[2]
+    assert stats['slo_violations'] < reactive_stats['slo_violations']
+    for (phase, rate) in enumerate(RATES):
+        # workers at the end of each phase
+        n = [count for (ts, count) in active if ts < (phase + 1) * PHASE_S][-1]
+        needed = int(math.ceil(rate * SERVICE_MS / 1000. / 0.8))
+        # at most the workers needed to be 50% busy, plus one left from draining the queue
+        assert needed <= n <= int(math.ceil(rate * SERVICE_MS / 1000. / 0.5)) + 1
+
+
+def test_activated_worker_gets_its_slots_back():
+    service = mdbroker.AdaptiveWorkerPoolService('sim', {'throughput': 30, 'latency': 100})
+    active, dormant = [mdbroker.Worker(identity, identity, 0) for identity in ('a', 'b')]
+    service.add_waiting_worker(active, add_to_active_if_new=True)
+    service.add_waiting_worker(dormant, add_to_active_if_new=False)
+    assert list(service._waiting) == [active]
+    service.inc_worker()
+    assert sorted(service._waiting) == sorted([active, dormant])
+    service.dec_worker()
+    assert len(service._waiting) == 1
+    service.remove_worker(dormant)
+    service.remove_worker(active)
+    assert not service._waiting and not service._parked
+    assert not service._active_pool and not service._dormant_pool
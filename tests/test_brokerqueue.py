@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+"""Make sure broker queues serve clients fairly and NACK the requests they drop."""
+
+import pytest
+
+from rmexp import gabriel_pb2
+from rmexp.broker import brokerqueue
+
+
+class FakeSocket(object):
+    def __init__(self):
+        self.sent = []
+
+    def send_multipart(self, frames):
+        self.sent.append(frames)
+
+
+class FakeBroker(object):
+    def __init__(self):
+        self.socket = FakeSocket()
+
+
+class FakeClock(object):
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def _request(client, timestamp):
+    msg = gabriel_pb2.Message()
+    msg.timestamp = timestamp
+    return [client, '', msg.SerializeToString()]
+
+
+def test_expired_requests_are_dropped_before_dispatch():
+    broker = FakeBroker()
+    clock = FakeClock(100.)
+    queue = brokerqueue.DeadlineTokenQueue(broker, service_name='lego', clock=clock)
+    queue.append(_request('client', 100.))
+    assert queue and len(queue) == 1
+
+    # the request expires between the broker's check and its pop
+    clock.now += 60.
+    assert queue.pop()[0] == 'client'
+    assert broker.socket.sent == []
+
+    # checking the queue size does not drop requests, e.g. for stats
+    queue.append(_request('client', 100.))
+    assert queue and len(queue) == 1
+    assert broker.socket.sent == []
+
+    queue.drop_expired()
+    assert not queue and len(queue) == 0
+    assert queue.nacked == 1
+    assert broker.socket.sent[0][0] == 'client'
+
+
+def test_per_client_queue_round_robin():
+    queue = brokerqueue.PerClientFreshnessTokenQueue(FakeBroker())
+    for client in ('a', 'b', 'c'):
+        queue.append([client, '', 'frame-1'])
+    assert [queue.pop()[0] for _ in range(2)] == ['a', 'b']
+
+    # a client joins the end of the round once popped
+    queue.append(['a', '', 'frame-2'])
+    assert [queue.pop() for _ in range(2)] == [['c', '', 'frame-1'], ['a', '', 'frame-2']]
+    assert queue.nacked == 0
+
+
+def test_per_client_queue_replaces_stale_requests():
+    broker = FakeBroker()
+    queue = brokerqueue.PerClientFreshnessTokenQueue(broker)
+    queue.append(['a', '', 'frame-1'])
+    queue.append(['b', '', 'frame-1'])
+    queue.append(['a', '', 'frame-2'])
+    assert len(queue) == 2
+    assert queue.nacked == 1
+    assert broker.socket.sent == [['a', '', brokerqueue.MDP.C_CLIENT, brokerqueue.RETURN_TO_CLIENT_SERVICE_TYPE, '']]
+
+    # the newer frame keeps the client's place in the round
+    assert queue.pop(0) == ['a', '', 'frame-2']
+    assert queue.pop(0) == ['b', '', 'frame-1']
+
+
+def test_per_client_queue_pop_empty():
+    queue = brokerqueue.PerClientFreshnessTokenQueue(FakeBroker())
+    assert not queue
+    with pytest.raises(IndexError):
+        queue.pop()
+
+    # a full rotation empties the ring
+    for client in ('a', 'b'):
+        queue.append([client, '', 'frame'])
+    queue.pop()
+    queue.pop()
+    assert not queue and len(queue) == 0
+    with pytest.raises(IndexError):
+        queue.pop(0)
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+"""Make sure the columnar store reads back what result sinks write, filtered and merged."""
+
+import pytest
+
+from rmexp import dbutils
+from rmexp.schema import columnar, models
+
+
+def _store(path):
+    pytest.importorskip('pyarrow')
+    pytest.importorskip('pandas')
+    return columnar.ColumnarStore(path)
+
+
+def test_columnar_store(tmpdir):
+    store = _store(str(tmpdir))
+    with dbutils.sink_scope(store=store, batch_size=3) as sink:
+        for (name, client) in [('exp1', 0), ('exp1', 1), ('exp2', 0)] * 2:
+            sink.insert(models.ExpLatency, {'name': name, 'index': 1, 'client': str(client),
+                                            'app': 'lego', 'reply': 100 * client})
+        sink.upsert(models.LegoLatency, {'name': 'exp1', 'index': '1'}, {'capture': 1.})
+        sink.upsert(models.LegoLatency, {'name': 'exp1', 'index': '1'}, {'arrival': 2.})
+
+    df = store.read(models.ExpLatency, columns=['reply'], filters=[('name', '=', 'exp1'), ('client', '=', 1)])
+    assert df['reply'].tolist() == [100, 100]
+    assert len(store.read(models.ExpLatency, filters=[('name', 'like', 'exp%')])) == 6
+    assert len(store.read(models.ExpLatency, filters=[('name', '=', 'exp3')])) == 0
+
+    df = store.read(models.LegoLatency, columns=['capture', 'arrival', 'date'])
+    assert df[['capture', 'arrival']].values.tolist() == [[1., 2.]]
+    # set when the row was created, like a database default
+    assert df['date'].notnull().all()
+
+
+def test_columnar_store_coerces_values(tmpdir):
+    store = _store(str(tmpdir))
+    with dbutils.sink_scope(store=store, batch_size=2) as sink:
+        # shaped like feed.store_exp_latency and worker.store records
+        sink.insert(models.ExpLatency, {'name': 'exp1', 'index': '12', 'app': 'lego', 'client': '0',
+                                        'arrival': 10, 'finished': 20, 'reply': 30.6, 'utility': 1.,
+                                        'val': '3', 'result': 'done'})
+        sink.upsert(models.SS, {'name': 'exp1', 'index': 12, 'trace': 'lego-1'}, {'val': 'state'})
+    assert sink.written == 2
+
+    df = store.read(models.ExpLatency, columns=['index', 'val', 'reply'], filters=[('name', '=', 'exp1')])
+    assert df.values.tolist() == [[12, 3, 30]]
+    df = store.read(models.SS, columns=['index', 'val'], filters=[('index', '=', 12)])
+    assert df.values.tolist() == [['12', 'state']]
+
+
+def test_part_names_sort_in_write_order():
+    names = [columnar._part_name(pid, seq) for (pid, seq) in [(9999, 0), (10001, 0), (5, 1), (5, 0)]]
+    assert sorted(names) == names
+
+
+def test_later_upserts_win_across_writers(tmpdir, monkeypatch):
+    keys = {'name': 'exp1', 'index': '1', 'trace': 'lego-1'}
+    # e.g. ingestion, and a later process adding to its rows
+    for (pid, values) in [(9999, {'val': 'first'}), (10001, {'val': 'second'}), (5, {})]:
+        monkeypatch.setattr(columnar.os, 'getpid', lambda: pid)
+        with dbutils.sink_scope(store=_store(str(tmpdir))) as sink:
+            sink.upsert(models.SS, keys, values)
+    # columns an upsert does not set keep their values
+    assert _store(str(tmpdir)).read(models.SS, columns=['val'])['val'].tolist() == ['second']
+
+    with dbutils.sink_scope(store=_store(str(tmpdir))) as sink:
+        sink.upsert(models.SS, keys, {'val': None})
+    # as in a database, columns can be set back to NULL
+    assert _store(str(tmpdir)).read(models.SS, columns=['val'])['val'].tolist() == [None]
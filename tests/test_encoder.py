@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+
+"""Make sure the adaptive encoder backs off under late replies, within bounds, and recovers."""
+
+import cv2
+import numpy as np
+
+from rmexp.client import encoder
+
+
+def test_adaptive_encoder_levels():
+    enc = encoder.AdaptiveEncoder(target_ms=100., min_quality=75, min_scale=0.5, hold=2)
+    assert enc.levels == [(1., 95), (1., 85), (1., 75), (0.75, 75), (0.5, 75)]
+
+    img = np.random.RandomState(0).randint(0, 255, (120, 160, 3)).astype(np.uint8)
+    frame = cv2.imencode('.jpg', img)[1].tostring()
+    assert enc.reencode(frame) is frame
+
+    for _ in range(20):
+        enc.add_latency(400)
+    assert (enc.quality, enc.scale) == (75, 0.5)
+    assert cv2.imdecode(np.frombuffer(enc.reencode(frame), np.uint8), cv2.IMREAD_COLOR).shape == (60, 80, 3)
+
+    enc.add_sent(7)
+    assert enc.pop_sent(7) == (75, 0.5)
+    assert enc.pop_sent(7) is None
+
+    for _ in range(40):
+        enc.add_latency(10)
+    assert enc.level == 0
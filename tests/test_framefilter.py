@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+"""Make sure the client frame filter drops blurry and duplicate frames but sends new ones."""
+
+import cv2
+import numpy as np
+
+from rmexp import cvutils
+from rmexp.client import framefilter
+
+
+def _image(seed):
+    rng = np.random.RandomState(seed)
+    img = rng.randint(0, 255, (18, 32, 3)).astype(np.uint8)
+    return cv2.resize(img, (640, 360), interpolation=cv2.INTER_NEAREST)
+
+
+def _jpeg(img):
+    return cv2.imencode('.jpg', img)[1].tostring()
+
+
+def test_phash64_matches_phash():
+    for seed in range(5):
+        img = _image(seed)
+        assert '{:016x}'.format(cvutils.phash64(img)) == str(cvutils.phash(img))
+    assert cvutils.hamming_distance(cvutils.phash64(_image(0)), cvutils.phash64(_image(0))) == 0
+
+
+def test_frame_filter():
+    ff = framefilter.FrameFilter(dup_max_distance=2, blur_min_score=500)
+    assert ff(_jpeg(_image(0)))
+    assert not ff(_jpeg(_image(0)))
+    assert not ff(_jpeg(np.full((360, 640, 3), 128, dtype=np.uint8)))
+    assert ff(_jpeg(_image(1)))
+    assert (ff.stats['sent'], ff.stats['duplicate'], ff.stats['blurry']) == (2, 1, 1)
+
+
+def test_blur_is_scored_at_the_app_size(monkeypatch):
+    # OpenCV 3+ names it IMREAD_UNCHANGED
+    monkeypatch.setattr(cv2, 'CV_LOAD_IMAGE_UNCHANGED', cv2.IMREAD_UNCHANGED, raising=False)
+    blurry = _jpeg(cv2.GaussianBlur(_image(0), (15, 15), 0))
+    # scaled down to FILTER_MAX_WH, the blur hardly shows
+    assert framefilter.FrameFilter(blur_min_score=20000)(blurry)
+    assert not framefilter.FrameFilter(blur_min_score=20000, blur_max_wh=640)(blurry)
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+
+"""Make sure fixed-bucket latency histograms report percentiles within a bucket of the exact ones."""
+
+import numpy as np
+import pytest
+
+from rmexp import histogram
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_percentiles_within_one_bucket(seed):
+    rs = np.random.RandomState(seed)
+    samples = rs.lognormal(mean=3, sigma=1, size=5000)
+    hist = histogram.LatencyHistogram()
+    for ms in samples:
+        hist.record(ms)
+    assert hist.count == len(samples)
+    assert hist.max_ms == samples.max()
+    for p in (50, 95, 99):
+        exact = np.percentile(samples, p)
+        assert exact * 0.8 <= hist.percentile(p) <= exact * 1.2
+
+
+def test_merge_and_round_trip(tmpdir):
+    stats = [histogram.StageStats(dump_path=str(tmpdir.join('worker-{}.json'.format(i))))
+             for i in range(2)]
+    for (i, s) in enumerate(stats):
+        for ms in range(1, 101):
+            s.record('process', (ms + 100 * i) / 1000.)
+        s.record('decode', 0.005)
+        s.dump()
+    summary = histogram.load_summary(*[s.dump_path for s in stats])
+    assert summary['process']['count'] == 200
+    assert summary['process']['max_ms'] == 200.
+    assert summary['decode']['count'] == 2
+    assert 90 <= summary['process']['p50_ms'] <= 120
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+
+"""Make sure cached IMU suppression decisions find the next frame to send."""
+
+import os
+
+import numpy as np
+
+from rmexp.dataset import imucache
+
+
+def test_next_unsuppressed(tmpdir):
+    path = str(tmpdir.mkdir('lego-tr1'))
+    suppression = np.array([False, True, True, False, True, True])
+    np.save(os.path.join(path, imucache.INDEX_FNAME), np.arange(1, 7))
+    np.save(os.path.join(path, imucache.IMU_FNAME), np.zeros((6, 6)))
+    np.save(os.path.join(path, imucache.SUPPRESSION_FNAME), suppression)
+
+    cache = imucache.load('lego-tr1', cache_dir=str(tmpdir))
+    assert cache.first_index == 1
+    assert [cache.next_unsuppressed(idx) for idx in range(8)] == [0, 3, 3, 3, 6, 6, 6, 7]
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+"""Make sure the vectorized lego bitmap reconstruction matches the loop version."""
+
+import numpy as np
+import pytest
+
+from lego import config
+from lego import lego_cv as lc
+from lego import zhuocv as zc
+
+
+def _synthetic_lego(n_rows, n_cols, noise, seed):
+    """Create color masks of a lego model with n_rows x n_cols bricks."""
+    rs = np.random.RandomState(seed)
+    height = int(round(n_rows * config.BRICK_HEIGHT)) + rs.randint(0, 4)
+    width = int(round(n_cols * config.BRICK_WIDTH)) + rs.randint(0, 4)
+    gt = rs.randint(0, 7, size=(n_rows, n_cols))
+    rows = np.minimum(
+        (np.arange(height) / config.BRICK_HEIGHT).astype(int), n_rows - 1)
+    cols = np.minimum(
+        (np.arange(width) / config.BRICK_WIDTH).astype(int), n_cols - 1)
+    labels = gt[rows[:, np.newaxis], cols[np.newaxis, :]]
+    noisy = rs.rand(height, width) < noise
+    labels[noisy] = rs.randint(0, 8, size=noisy.sum())
+    masks = [labels == color_idx for color_idx in xrange(len(config.COLOR_ORDER))]
+    img = np.zeros((height, width, 3), dtype=np.uint8)
+    return img, zc.calc_stacked_cumsum(masks), masks
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_img2bitmap_vectorized_matches_loop(seed):
+    n_rows, n_cols = 1 + seed % 6, 2 + seed % 9
+    img, color_cumsums, _ = _synthetic_lego(
+        n_rows, n_cols, noise=0.05 * (seed % 5), seed=seed)
+    for n_rows_try in (n_rows - 1, n_rows, n_rows + 1):
+        for n_cols_try in (n_cols - 1, n_cols, n_cols + 1):
+            if n_rows_try < 1 or n_cols_try < 1:
+                continue
+            expected = lc._img2bitmap_loop(
+                img, color_cumsums, n_rows_try, n_cols_try, None)
+            actual = lc._img2bitmap_vectorized(
+                img, color_cumsums, n_rows_try, n_cols_try, None)
+            if expected[0] is None:
+                assert actual[0] is None
+            else:
+                assert np.array_equal(expected[0], actual[0])
+            assert expected[1] == actual[1]
+            assert expected[3] == actual[3]
+
+
+def test_calc_stacked_cumsum_matches_calc_cumsum():
+    _, color_cumsums, masks = _synthetic_lego(4, 6, noise=0.1, seed=0)
+    for mask, color_cumsum in zip(masks, color_cumsums):
+        assert np.array_equal(zc.calc_cumsum(mask), color_cumsum)
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+
+"""Make sure replies of batching and pipelined workers get back to their clients through an inproc broker."""
+
+import itertools
+import json
+import textwrap
+import threading
+import time
+
+import cv2
+import numpy as np
+import pytest
+import zmq
+
+from rmexp import gabriel_pb2, networkutil, worker
+from rmexp.broker import mdbroker
+from rmexp.broker.mdcliapi2 import MajorDomoClient
+from rmexp.broker.mdwrkapi import MajorDomoWorker
+
+TIMEOUT_MS = 5000
+
+_broker_seq = itertools.count()
+
+
+def _start_broker(ctx, **kwargs):
+    """Endpoint of a broker mediating in a background thread until the tests exit."""
+    broker = mdbroker.MajorDomoBroker(mdbroker.Service, {}, ctx=ctx, **kwargs)
+    endpoint = 'inproc://test-broker-{}'.format(next(_broker_seq))
+    broker.bind(endpoint)
+    mediator = threading.Thread(target=broker.mediate)
+    mediator.daemon = True
+    mediator.start()
+    return endpoint
+
+
+def _queue_request(client, service, body):
+    """Send a request and wait until the broker has queued it."""
+    client.send(service, body)
+    # the broker handles a client's messages in order
+    client.send('mmi.service', service)
+    assert client.recv(TIMEOUT_MS) == ('mmi.service', ['200'])
+
+
+def _in_background(func, *args):
+    thread = threading.Thread(target=func, args=args)
+    thread.daemon = True
+    thread.start()
+
+
+def _frame(value, shape, reply=True, ext='.png'):
+    gabriel_msg = gabriel_pb2.Message()
+    gabriel_msg.data = cv2.imencode(ext, np.full(shape, value, np.uint8))[1].tostring()
+    gabriel_msg.index = '{}-0'.format(value)
+    gabriel_msg.reply = reply
+    return gabriel_msg.SerializeToString()
+
+
+class ShapeBatchingHandler(object):
+    """Processes frames of the same shape together, like IkeaHandler.process_batch."""
+
+    def __init__(self):
+        self.stack_sizes = []
+
+    def process_batch(self, imgs):
+        shape_to_indices = {}
+        for (idx, img) in enumerate(imgs):
+            shape_to_indices.setdefault(img.shape, []).append(idx)
+        results = [None] * len(imgs)
+        for indices in shape_to_indices.values():
+            stack = np.stack([imgs[idx] for idx in indices])
+            self.stack_sizes.append(len(stack))
+            for (batch_idx, idx) in enumerate(indices):
+                results[idx] = str(int(stack[batch_idx].mean()))
+        return results
+
+
+def test_batch_replies_reach_their_clients():
+    ctx = zmq.Context()
+    endpoint = _start_broker(ctx)
+    shapes = [(8, 8), (4, 6), (8, 8), (4, 6), (8, 8)]
+    clients = [MajorDomoClient(endpoint, ctx=ctx) for _ in shapes]
+    for (idx, (client, shape)) in enumerate(zip(clients, shapes)):
+        # the last client does not want a reply
+        _queue_request(client, 'batch', _frame(10 * (idx + 1), shape, reply=idx < len(shapes) - 1))
+
+    # the queued requests are sent as one batch once the worker is ready
+    mdworker = MajorDomoWorker(endpoint, 'batch', batch_size=len(shapes), ctx=ctx)
+    mdworker.timeout = TIMEOUT_MS
+    msgs = mdworker.recv_batch()
+    assert len(msgs) == len(shapes)
+    gabriel_msgs = [gabriel_pb2.Message.FromString(msg) for msg in msgs]
+    imgs = [cv2.imdecode(np.frombuffer(gabriel_msg.data, np.uint8), cv2.IMREAD_GRAYSCALE)
+            for gabriel_msg in gabriel_msgs]
+    handler = ShapeBatchingHandler()
+    results = worker._process_batch(handler, imgs, [worker._get_stream_id(m) for m in gabriel_msgs])
+    assert sorted(handler.stack_sizes) == [2, 3]
+
+    replies = [result if gabriel_msg.reply else None for (gabriel_msg, result) in zip(gabriel_msgs, results)]
+    # sending the replies waits for the next batch, which never comes
+    _in_background(mdworker.recv_batch, replies)
+    for (idx, client) in enumerate(clients[:-1]):
+        assert client.recv(TIMEOUT_MS) == ('batch', [str(10 * (idx + 1))])
+    assert clients[-1].recv(100) is None
+
+
+def _wait_until(condition, timeout=TIMEOUT_MS / 1000.):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, 'timed out'
+        time.sleep(0.01)
+
+
+def _service_stats(client, service):
+    client.send('mmi.stats', service)
+    reply = client.recv(TIMEOUT_MS)
+    assert reply[1][0] == '200'
+    return json.loads(reply[1][1])['services'][service]
+
+
+PIPELINED_APP = """
+import threading
+
+# frames being processed, and when to finish them
+started = []
+release = threading.Event()
+
+
+class Handler(object):
+    def process(self, img):
+        started.append(img.shape)
+        release.wait()
+        return '{}x{}'.format(*img.shape[:2])
+"""
+
+
+def test_pipelined_worker_replies_and_frees_slots(tmpdir, monkeypatch):
+    tmpdir.join('pipelinedapp.py').write(textwrap.dedent(PIPELINED_APP))
+    monkeypatch.syspath_prepend(str(tmpdir))
+    import pipelinedapp
+    # workers decode with the OpenCV 2 API
+    monkeypatch.setattr(cv2, 'CV_LOAD_IMAGE_UNCHANGED', cv2.IMREAD_UNCHANGED, raising=False)
+
+    ctx = zmq.Context()
+    endpoint = _start_broker(ctx)
+    monitor = MajorDomoClient(endpoint, ctx=ctx)
+    job_queue = networkutil.ZmqMajorDomoConnector(endpoint, service='pipelined', pipeline_depth=2, ctx=ctx)
+    _in_background(worker.pipelined_work_loop, job_queue, 'pipelinedapp', None, 2)
+    _wait_until(lambda: _service_stats(monitor, 'pipelined')['free_slots'] == 2)
+
+    shapes = [(8, 16), (16, 8), (24, 8)]
+    clients = [MajorDomoClient(endpoint, ctx=ctx) for _ in shapes]
+    for (idx, (client, shape)) in enumerate(zip(clients, shapes)[:2]):
+        _queue_request(client, 'pipelined', _frame(idx, shape, ext='.jpg'))
+    # one frame is processed and the other waits at the worker, decoded
+    _wait_until(lambda: len(pipelinedapp.started) == 1)
+    stats = _service_stats(monitor, 'pipelined')
+    assert (stats['free_slots'], stats['queue_depth']) == (0, 0)
+    _queue_request(clients[2], 'pipelined', _frame(2, shapes[2], ext='.jpg'))
+    assert _service_stats(monitor, 'pipelined')['queue_depth'] == 1
+
+    pipelinedapp.release.set()
+    for (idx, (client, shape)) in enumerate(zip(clients, shapes)):
+        service, reply = client.recv(TIMEOUT_MS)
+        gabriel_msg = gabriel_pb2.Message.FromString(reply[0])
+        assert (service, gabriel_msg.index, gabriel_msg.data) == ('pipelined', '{}-0'.format(idx), '{}x{}'.format(*shape))
+    _wait_until(lambda: _service_stats(monitor, 'pipelined')['free_slots'] == 2)
+    assert _service_stats(monitor, 'pipelined')['dispatched'] == 3
+
+
+class FakeSession(object):
+    """Detects one object per image, with the mean of the image as its box."""
+
+    def __init__(self):
+        self.batch_sizes = []
+
+    def run(self, tensor_dict, feed_dict):
+        (images,) = feed_dict.values()
+        self.batch_sizes.append(len(images))
+        means = images.reshape(len(images), -1).mean(axis=1)
+        return {'detection_classes': np.ones((len(images), 1)),
+                'detection_boxes': means.reshape(-1, 1, 1),
+                'detection_scores': np.ones((len(images), 1))}
+
+
+def test_ikea_batches_keep_frame_order():
+    pytest.importorskip('tensorflow')
+    pytest.importorskip('object_detection')
+    from ikea import handler as ikea_handler
+
+    handler = ikea_handler.IkeaHandler.__new__(ikea_handler.IkeaHandler)
+    handler.category_index = {1: {'name': 'object'}}
+    handler.tensor_dict, handler.image_tensor = {}, 'image_tensor'
+    handler.sess = FakeSession()
+    shapes = [(8, 8, 3), (4, 6, 3), (8, 8, 3), (4, 6, 3), (8, 8, 3)]
+    imgs = [np.full(shape, 10 * (idx + 1), np.uint8) for (idx, shape) in enumerate(shapes)]
+    results = handler.process_batch(imgs)
+    assert sorted(handler.sess.batch_sizes) == [2, 3]
+    assert results == ['Detected Objects: object [{}.]'.format(10 * (idx + 1)) for idx in range(len(shapes))]
+
+
+def test_waiting_queue_removes_workers_lazily():
+    a, b, c = [mdbroker.Worker(identity, identity, 0) for identity in 'abc']
+    waiting = mdbroker.WaitingQueue()
+    for worker in (a, b, a, c):
+        waiting.append(worker)
+    waiting.discard(a)
+    assert (len(waiting), sorted(waiting)) == (2, sorted([b, c]))
+    assert waiting.popleft() is b
+
+    # a worker that comes back only gets its new slots
+    waiting.append(a)
+    assert [waiting.popleft(), waiting.popleft()] == [c, a]
+    assert not waiting
+
+    # entries of removed workers do not pile up
+    waiting.append(b)
+    for _ in range(1000):
+        waiting.append(a)
+        waiting.discard(a)
+    assert len(waiting._entries) <= 2 * len(waiting) + 64
+    assert [waiting.pop() for _ in range(len(waiting))] == [b]
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+"""Make sure packed traces serve the frames and IMU rows they were packed from."""
+
+import numpy as np
+
+from rmexp.client.video import RTImageSequenceClient
+from rmexp.dataset import packedtrace
+
+
+def _frames(n):
+    return ['frame-{}-'.format(idx) * (idx + 1) for idx in range(n)]
+
+
+def test_pack_image_dir_round_trip(tmpdir):
+    frames = _frames(5)
+    image_dir = tmpdir.mkdir('video-images')
+    for (idx, frame) in enumerate(frames):
+        image_dir.join('{:010d}.jpg'.format(idx + 1)).write(frame, mode='wb')
+    tmpdir.join('imu.csv').write(
+        'frame_id,sensor_timestamp,rot_x,rot_y,rot_z,acc_x,acc_y,acc_z\n'
+        '0,2019-04-20 17:35:57,0,1,2,3,4,5\n'
+        '3,2019-04-20 17:35:58,6,7,8,9,10,11\n')
+
+    assert packedtrace.pack_trace_dir(str(tmpdir)) == len(frames)
+    packed_dir = str(tmpdir.join(packedtrace.PACKED_DNAME))
+    assert packedtrace.is_packed_trace(packed_dir)
+
+    trace = packedtrace.PackedTrace(packed_dir)
+    assert len(trace) == len(frames)
+    assert [trace.get_frame(idx).tobytes() for idx in range(len(trace))] == frames
+    assert list(trace.get_imu(3)) == [6, 7, 8, 9, 10, 11]
+    assert np.isnan(trace.get_imu(1)).all()
+    trace.close()
+
+
+def test_client_reads_packed_trace_like_image_dir(tmpdir):
+    frames = _frames(4)
+    packedtrace.pack_frames(frames, str(tmpdir))
+    vc = RTImageSequenceClient('lego', str(tmpdir), loop=True)
+    assert vc._cam_frame_cnt == len(frames)
+    for idx in range(2 * len(frames)):
+        has_frame, frame = vc._get_frame_bytes(idx)
+        assert has_frame and frame.tobytes() == frames[idx % len(frames)]
+
+    vc = RTImageSequenceClient('lego', str(tmpdir), loop=False)
+    assert vc._get_frame_bytes(len(frames)) == (False, None)
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+"""Make sure the result sink writes inserts and upserts in the background."""
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from rmexp import dbutils
+from rmexp.schema import models
+
+
+def test_result_sink(tmpdir):
+    engine = create_engine('sqlite:///{}'.format(tmpdir.join('results.db')))
+    models.Base.metadata.create_all(engine)
+    Session = sessionmaker(bind=engine)
+
+    with dbutils.sink_scope(session_factory=Session, batch_size=2, flush_interval=0.01) as sink:
+        for idx in range(5):
+            sink.insert(models.ExpLatency, {'name': 'exp', 'index': idx, 'reply': 100 + idx})
+        sink.upsert(models.LegoLatency, {'name': 'exp', 'index': '1'}, {'capture': 1.})
+        sink.upsert(models.LegoLatency, {'name': 'exp', 'index': '1'}, {'arrival': 2.})
+        sink.flush()
+        assert sink.written == 7
+
+    with dbutils.sink_scope(session_factory=Session) as sink:
+        sink.upsert(models.LegoLatency, {'name': 'exp', 'index': 1}, {'finished': 3.})
+
+    sess = Session()
+    assert [r.reply for r in sess.query(models.ExpLatency).order_by(models.ExpLatency.index)] == range(100, 105)
+    latencies = sess.query(models.LegoLatency).all()
+    assert [(r.capture, r.arrival, r.finished) for r in latencies] == [(1., 2., 3.)]
+
+
+class FailingStore(object):
+    def write_batch(self, batch):
+        raise TypeError('bad record')
+
+
+def test_result_sink_survives_failed_batches():
+    with dbutils.sink_scope(store=FailingStore(), batch_size=2, max_buffer=2, block_when_full=True) as sink:
+        for idx in range(5):
+            sink.insert(models.ExpLatency, {'name': 'exp', 'index': idx})
+        sink.flush()
+        assert (sink.written, sink.dropped) == (0, 5)
+
+
+def test_result_sink_fails_without_writer(monkeypatch):
+    sink = dbutils.ResultSink(store=FailingStore(), flush_interval=0.01)
+    monkeypatch.setattr(dbutils.ResultSink, '_POLL_INTERVAL', 0.01)
+
+    def stop(batch):
+        raise SystemExit()
+    monkeypatch.setattr(sink, '_write_batch', stop)
+    sink.insert(models.ExpLatency, {'name': 'exp', 'index': 0})
+    sink._writer.join(1.)
+    with pytest.raises(RuntimeError):
+        sink.flush()
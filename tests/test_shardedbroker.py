@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+"""Make sure the sharded broker routes requests and mmi requests to the shards of their services."""
+
+import json
+import threading
+
+import zmq
+
+from rmexp.broker import mdbroker, shardedbroker
+from rmexp.broker.mdcliapi2 import MajorDomoClient
+from rmexp.broker.mdwrkapi import MajorDomoWorker
+
+TIMEOUT_MS = 5000
+ENDPOINT = 'inproc://test-sharded-broker'
+
+
+def _in_background(func, *args):
+    thread = threading.Thread(target=func, args=args)
+    thread.daemon = True
+    thread.start()
+
+
+def _echo(mdworker):
+    reply = None
+    while True:
+        request = mdworker.recv(reply)
+        reply = ['{} {}'.format(mdworker.service, request[0])]
+
+
+def _request(client, service, body):
+    client.send(service, body)
+    return client.recv(TIMEOUT_MS)
+
+
+def test_sharded_broker():
+    ctx = zmq.Context()
+    front = shardedbroker.ShardedBroker(mdbroker.broker_kwargs(), ctx=ctx)
+    front.bind(ENDPOINT)
+    _in_background(front.mediate)
+    for service in ('lego', 'face'):
+        _in_background(_echo, MajorDomoWorker(ENDPOINT, service, ctx=ctx))
+
+    client = MajorDomoClient(ENDPOINT, ctx=ctx)
+    assert _request(client, 'lego', 'frame-1') == ('lego', ['lego frame-1'])
+    assert _request(client, 'face', 'frame-2') == ('face', ['face frame-2'])
+    assert sorted(front.shards) == ['face', 'lego']
+
+    assert _request(client, 'mmi.service', 'lego') == ('mmi.service', ['200'])
+    assert _request(client, 'mmi.service', 'pool') == ('mmi.service', ['404'])
+
+    # stats of one service come from its shard
+    service, (returncode, body) = _request(client, 'mmi.stats', 'lego')
+    assert (service, returncode) == ('mmi.stats', '200')
+    assert json.loads(body)['services'].keys() == ['lego']
+    # stats of all services are gathered from all shards
+    service, (returncode, body) = _request(client, 'mmi.stats', '')
+    stats = json.loads(body)
+    assert (service, returncode) == ('mmi.stats', '200')
+    assert (stats['shards'], stats['workers']) == (2, 2)
+    assert sorted(stats['services']) == ['face', 'lego']
+    assert all(stats['services'][name]['dispatched'] == 1 for name in ('face', 'lego'))
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+"""Make sure sticky routing keeps clients on their workers, within load bounds and spill limits."""
+
+import math
+
+from rmexp.broker import mdbroker
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.
+
+    def __call__(self):
+        return self.now
+
+
+def _service(n_workers, spill_ms=100):
+    clock = FakeClock()
+    service = mdbroker.StickyService('sim', spill_ms=spill_ms, clock=clock)
+    workers = [mdbroker.Worker('w{}'.format(idx), 'w{}'.format(idx), 0) for idx in range(n_workers)]
+    for worker in workers:
+        service.add_waiting_worker(worker)
+    return service, workers, clock
+
+
+def _send(service, client):
+    """Worker the request of client is sent to, or None if it is held."""
+    service.add_request([client, '', 'frame'])
+    if not service.is_ready_to_send():
+        return None
+    msg, worker = service.get_ready_to_send()
+    assert msg[0] == client
+    return worker
+
+
+def _reply(service, worker):
+    service.post_worker_processing(None, worker)
+    service.add_waiting_worker(worker)
+
+
+def test_clients_stay_on_their_workers():
+    service, workers, clock = _service(4)
+    assigned = {}
+    for _ in range(5):
+        for client in ('c{}'.format(idx) for idx in range(8)):
+            worker = _send(service, client)
+            assert assigned.setdefault(client, worker) is worker
+            clock.now += 0.01
+            _reply(service, worker)
+    assert service.stats['spilled'] == 0
+    assert len(set(assigned.values())) > 1
+
+
+def test_client_load_is_bounded():
+    service, workers, clock = _service(2)
+    n_clients = 8
+    for idx in range(n_clients):
+        _reply(service, _send(service, 'c{}'.format(idx)))
+    max_load = math.ceil(service.LOAD_FACTOR * n_clients / len(workers))
+    assert all(0 < service._worker_clients[worker] <= max_load for worker in workers)
+
+
+def test_requests_spill_from_busy_workers():
+    service, workers, clock = _service(2, spill_ms=100)
+    preferred = _send(service, 'c')
+    clock.now += 0.5
+    _reply(service, preferred)
+    # the preferred worker takes about 500 ms per request
+    assert _send(service, 'c') is preferred
+    spilled = _send(service, 'c')
+    assert spilled is not None and spilled is not preferred
+    assert service.stats['spilled'] == 1
+    # the client still prefers its worker
+    _reply(service, preferred)
+    assert _send(service, 'c') is preferred
+
+
+def test_held_requests_spill_after_spill_ms():
+    service, workers, clock = _service(2, spill_ms=1000)
+    preferred = _send(service, 'c')
+    clock.now += 0.5
+    _reply(service, preferred)
+    assert _send(service, 'c') is preferred
+    # held for the preferred worker, which should be done within spill_ms
+    assert _send(service, 'c') is None
+    assert service.get_stats()['held'] == 1
+
+    clock.now += 1.1
+    assert service.is_ready_to_send()
+    msg, worker = service.get_ready_to_send()
+    assert msg[0] == 'c' and worker is not preferred
+    assert service.stats['spilled'] == 1
+
+
+def test_removed_worker_gives_back_clients_and_requests():
+    service, workers, clock = _service(2, spill_ms=1000)
+    preferred = _send(service, 'c')
+    clock.now += 0.5
+    _reply(service, preferred)
+    assert _send(service, 'c') is preferred
+    assert _send(service, 'c') is None
+
+    service.remove_worker(preferred)
+    (other,) = [worker for worker in workers if worker is not preferred]
+    # the held request goes back to the queue and the client moves
+    assert service.is_ready_to_send()
+    msg, worker = service.get_ready_to_send()
+    assert msg[0] == 'c' and worker is other
+    assert service._client_worker['c'] is other
+    assert preferred not in service._worker_clients
+
+    # a request scheduled for a worker goes back to the queue too
+    _reply(service, other)
+    service.add_request(['c', '', 'frame'])
+    assert service.is_ready_to_send()
+    service.remove_worker(other)
+    assert not service.is_ready_to_send()
+    assert len(service._requests) == 1
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+
+"""Make sure trace ingestion reads frames in one sequential pass."""
+
+import pytest
+
+pytest.importorskip('pandas')
+
+from rmexp.dataset import trace
+
+
+class _Cam(object):
+    def __init__(self):
+        self.pos = 0
+        self.decoded = 0
+
+    def grab(self):
+        self.pos += 1
+        return True
+
+    def read(self):
+        self.decoded += 1
+        self.pos += 1
+        return True, [self.pos - 1]
+
+    def set(self, prop, value):
+        raise AssertionError('seeked to {}'.format(value))
+
+
+def test_read_frames():
+    cam = _Cam()
+    assert list(trace._read_frames(cam, [0, 1, 4, 9])) == [(0, [0]), (1, [1]), (4, [4]), (9, [9])]
+    assert cam.decoded == 4
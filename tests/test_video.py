@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+"""Make sure workers tell apart the streams of clients sharing a process."""
+
+import cv2
+
+from rmexp import gabriel_pb2, worker
+from rmexp.client import video
+
+
+class FakeCV(object):
+    CV_CAP_PROP_FPS, CV_CAP_PROP_FRAME_COUNT, CV_CAP_PROP_POS_FRAMES = range(3)
+
+
+class FakeCapture(object):
+    def get(self, prop):
+        return 30
+
+    def set(self, prop, value):
+        pass
+
+
+class FakeConnector(object):
+    def __init__(self):
+        self.sent = []
+
+    def put(self, frames, service):
+        self.sent.append(frames[0])
+
+
+def test_clients_have_their_own_streams(monkeypatch):
+    monkeypatch.setattr(cv2, 'cv', FakeCV, raising=False)
+    monkeypatch.setattr(video.VideoClient, 'get_video_capture', lambda self, uri: FakeCapture())
+    nc = FakeConnector()
+    clients = [video.VideoClient('lego', 'video.mp4', network_connector=nc) for _ in range(2)]
+    for vc in clients:
+        vc.send_frame('frame', 7, reply=True, time=0.)
+
+    msgs = [gabriel_pb2.Message.FromString(body) for body in nc.sent]
+    assert [worker._get_stream_id(msg) for msg in msgs] == [vc.stream_id for vc in clients]
+    assert clients[0].stream_id != clients[1].stream_id
+    assert [video.parse_index(msg.index)[1] for msg in msgs] == ['7', '7']
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+"""Make sure the video index finds the keyframe to seek from, and that clients go without one if it cannot be built."""
+
+import os
+
+import numpy as np
+
+from rmexp.dataset import videoindex
+
+
+def test_keyframe_before(tmpdir):
+    video_fp = str(tmpdir.join('video.mp4'))
+    tmpdir.join('video.mp4').write('')
+    index_dir = str(tmpdir.join('index'))
+    os.makedirs(index_dir)
+    np.savez(videoindex.index_path(video_fp, index_dir), pts=np.arange(40) / 30., keyframes=np.array([0, 12, 24, 36]))
+
+    index = videoindex.load(video_fp, index_dir)
+    assert len(index) == 40
+    assert [index.keyframe_before(fid) for fid in (0, 11, 12, 13, 35, 39)] == [0, 0, 12, 12, 24, 36]
+
+
+def test_no_index(tmpdir, monkeypatch):
+    video_fp = str(tmpdir.join('video.mp4'))
+    tmpdir.join('video.mp4').write('')
+    index_dir = str(tmpdir.join('index'))
+    monkeypatch.setattr(videoindex, '_probe_packets', lambda video_fp: [(0., True), (1 / 30., False)])
+
+    # live streams have no index
+    assert videoindex.load('rtsp://camera/stream', index_dir) is None
+    # while another process builds it
+    os.makedirs(index_dir)
+    lock_path = videoindex.index_path(video_fp, index_dir) + '.lock'
+    open(lock_path, 'w').close()
+    assert videoindex.load(video_fp, index_dir) is None
+    os.remove(lock_path)
+    # nor without ffprobe, as clients would grab the whole video
+    monkeypatch.setattr(videoindex, '_probe_packets', lambda video_fp: None)
+    assert videoindex.load(video_fp, index_dir) is None
+    # nor if it cannot be written
+    monkeypatch.setattr(videoindex, '_probe_packets', lambda video_fp: [(0., True), (1 / 30., False)])
+    tmpdir.join('readonly').write('')
+    assert videoindex.load(video_fp, str(tmpdir.join('readonly', 'index'))) is None
+
+    assert len(videoindex.load(video_fp, index_dir)) == 2
+    assert not os.path.exists(lock_path)